@@ -0,0 +1,652 @@
+""" Runs the Dasymetry pipeline for many regions and years at once, e.g.
+    every county for every ACS vintage, from a manifest of jobs. The jobs
+    are spread over a pool of worker processes.
+
+    The manifest is a CSV file with a row per job and these columns:
+    name: name of the job, unique. Also the default output file name,
+    <name>.csv in the job's output_dir.
+    namelist: a namelist.config, or the directory holding one. Relative
+    paths are relative to the manifest.
+    output: optional, name of the output file (see Dasymetry.writeOutput)
+    Any other column replaces the namelist parameter of the same name, e.g.
+    parcels_file and population_file to run one namelist on many input
+    pairs. Empty cells keep the namelist value.
+
+    Jobs that use the same parcel layer (same file, fields and study area)
+    run one after another in the same worker, which loads the parcels only
+    once. Within a group, the blocks of the next job are loaded in the
+    background while a job is disaggregated, and the output of a job is
+    written in the background while the next one loads. Every worker
+    process runs a single group of jobs and then exits, so memory isn't
+    carried over between groups. With --memory-limit, a worker that uses
+    more memory than that is stopped, and its job recorded as failed,
+    rather than taking the machine down.
+
+    A record of every job (status, error, time and peak memory per stage,
+    see Dasymetry.startProfiling) is appended to a JSON lines file as soon
+    as the job ends, and the output of the job goes to <name>.log next to
+    its output file. With --resume, jobs that already finished with the
+    same parameters and input files (same size and modification time),
+    and whose output is still there, are skipped, so a failed batch can be
+    rerun after fixing what went wrong. At the end a summary table, one
+    row per job, is printed and written as CSV.
+
+    With --plan, the namelists and input files of the jobs are only
+    checked, and the memory use and run time of each job estimated (see
+    namelist.Config.plan), without running anything.
+
+    Usage:
+    ------
+    python batch.py manifest.csv --workers 4 --memory-limit 8000
+    python batch.py manifest.csv --resume
+    python batch.py manifest.csv --report
+    python batch.py manifest.csv --plan --memory-limit 8000
+"""
+
+import argparse
+import contextlib
+import csv
+import datetime
+import hashlib
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import dasymetry
+from namelist import Config
+
+# Stages shown in the summary, besides the total
+STAGES = ['load_source_files', 'buildSpatialRelation', 'getOverpopParcels',
+          'assignParcels', 'blocksToOverpop', 'disaggregate',
+          'disaggregate_leftover', 'round_counts', 'writeOutput']
+
+
+def read_manifest(manifest):
+    """ Reads the jobs of a manifest file.
+
+        Input:
+        ------
+        manifest: path of the manifest CSV file
+
+        Output:
+        -------
+        List of jobs, dicts with keys name, namelist (Path of the namelist
+        file), output (file name) and overrides (dict of namelist
+        parameters).
+    """
+
+    manifest = Path(manifest).resolve()
+    with open(manifest, newline='') as f:
+        lines = [line for line in f if not line.lstrip().startswith('#')]
+    table = [[cell.strip() for cell in row] for row
+             in csv.reader(lines, skipinitialspace=True) if any(row)]
+    columns = table[0] if table else []
+    if 'namelist' not in columns:
+        raise Exception('manifest ' + manifest.name + ' has no namelist '
+                        'column')
+
+    jobs = []
+    for n, cells in enumerate(table[1:]):
+        row = dict(zip(columns, cells + ['']*(len(columns) - len(cells))))
+        name = row.pop('name', '') or 'job' + str(n + 1)
+
+        namelist = manifest.parent / row.pop('namelist')
+        if namelist.is_dir():
+            namelist = namelist / 'namelist.config'
+
+        jobs.append({'name': name,
+                     'namelist': namelist.resolve(),
+                     'output': row.pop('output', '') or name + '.csv',
+                     'overrides': {key: value for key, value in row.items()
+                                   if value != ''}})
+
+    names = [job['name'] for job in jobs]
+    assert len(set(names)) == len(names), 'job names must be unique'
+
+    return jobs
+
+
+def load_job(job):
+    """ Dasymetry object with the namelist of job loaded. """
+
+    dasy = dasymetry.Dasymetry(job['namelist'].parent)
+    dasy.load_namelist(job['namelist'], overrides=job['overrides'])
+
+    return dasy
+
+
+def load_blocks(job):
+    """ Blocks of job, as its preprocess would load them, see
+        Dasymetry.load_source_blocks. Run in the background while the job
+        before it is disaggregated.
+    """
+
+    dasy = load_job(job)
+
+    return dasy.load_source_blocks(dasy.configdict)
+
+
+def job_hash(job):
+    """ Fingerprint of everything that defines the results of a job: its
+        namelist file, overrides and output name, and its input files, as
+        fingerprinted by the pre-processing cache (see
+        dasymetry.PreprocessCache.fingerprints).
+    """
+
+    namelist = job['namelist']
+    try:
+        configdict = Config.read(namelist,
+                                 overrides=job['overrides']).to_dict()
+        inputs = dasymetry.PreprocessCache.fingerprints(configdict)
+    except Exception:
+        inputs = None
+    description = {'namelist': (namelist.read_text() if namelist.exists()
+                                else None),
+                   'overrides': job['overrides'],
+                   'output': job['output'],
+                   'inputs': inputs}
+    description = json.dumps(description, sort_keys=True)
+
+    return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+
+def parcel_key(configdict):
+    """ Jobs with the same key load the same parcels. """
+
+    inputs = configdict['run_dir'] / configdict['input_dir']
+    description = {field: configdict.get(field) for field in
+                   ('parcels_fid', 'parcel_fields', 'study_area_bbox',
+                    'study_area_crs', 'study_area_mask')}
+    description['parcels'] = (inputs
+                              / configdict['parcels_file']).resolve()
+
+    return json.dumps(description, sort_keys=True, default=str)
+
+
+def group_jobs(jobs):
+    """ Groups the jobs by parcel layer, see parcel_key. Groups come
+        largest first (by parcel file size times number of jobs), so the
+        long ones don't end up last in the pool.
+    """
+
+    groups = {}
+    cost = {}
+    for job in jobs:
+        try:
+            configdict = Config.read(job['namelist'],
+                                     overrides=job['overrides']).to_dict()
+        except Exception:
+            # Left to fail in a worker, where the error gets recorded
+            key = job['name']
+            groups[key] = [job]
+            cost[key] = 0
+            continue
+
+        key = parcel_key(configdict)
+        groups.setdefault(key, []).append(job)
+
+        parcels = (configdict['run_dir'] / configdict['input_dir']
+                   / configdict['parcels_file'])
+        cost[key] = parcels.stat().st_size if parcels.exists() else 0
+
+    keys = sorted(groups, key=lambda key: cost[key]*len(groups[key]),
+                  reverse=True)
+
+    return [groups[key] for key in keys]
+
+
+def read_results(results):
+    """ Latest record of every job in a results file, by job name. """
+
+    latest = {}
+    if not Path(results).exists():
+        return latest
+
+    with open(results) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                latest[record['name']] = record
+
+    return latest
+
+
+def finished(job, latest):
+    """ Whether job finished, with the same parameters, according to the
+        latest records, and its output is still there.
+    """
+
+    record = latest.get(job['name'])
+    return (record is not None and record['status'] == 'done'
+            and record['hash'] == job_hash(job)
+            and Path(record['output']).exists())
+
+
+def append_record(results, record):
+    """ Appends a record to the results file, in a single write so that
+        workers finishing at the same time don't mix their lines.
+    """
+
+    with open(results, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+    return None
+
+
+def watch_memory(megabytes, results, running):
+    """ Ends the worker process once its resident memory has gone over
+        megabytes, recording the job it was running as failed. Runs in a
+        thread of the worker, see run_group. (A hard limit with setrlimit
+        makes the Arrow readers hang or abort instead of failing.)
+    """
+
+    while True:
+        time.sleep(0.1)
+        peak = dasymetry.StageProfiler.peak_rss()
+        if peak is None or peak <= megabytes:
+            continue
+
+        job = running.get('job')
+        if job is not None:
+            append_record(results, {
+                'name': job['name'],
+                'hash': job_hash(job),
+                'date': running['date'],
+                'pid': os.getpid(),
+                'reused_parcels': running['reused_parcels'],
+                'status': 'failed',
+                'error': ('MemoryError: over the limit of '
+                          + str(megabytes) + ' MB'),
+                'total_s': time.perf_counter() - running['start'],
+                'peak_rss_mb': peak})
+        os._exit(3)
+
+
+def run_job(job, parcel_df=None, block_df=None, ahead=None,
+            engine='vectorized', lean=False, integer=False, cache_entries=0):
+    """ Runs the pipeline for one job: preprocess, blocksToOverpop,
+        disaggregate, disaggregate_leftover, round_counts if integer, and
+        writeOutput, in the background.
+
+        Input:
+        ------
+        job: job from read_manifest
+        parcel_df: parcels loaded by an earlier job of the same group, see
+        Dasymetry.load_source_files
+        block_df: the job's blocks loaded ahead (see load_blocks), or a
+        Future of them
+        ahead: function called once the inputs are loaded, before the
+        disaggregation, see run_group
+        engine (str): engine passed to disaggregate and
+        disaggregate_leftover
+        lean (bool): see Dasymetry.preprocess. Parcels aren't reused then.
+        integer (bool): see Dasymetry.round_counts
+        cache_entries (int): keep this many pre-processed inputs in the
+        on-disk cache (see Dasymetry.preprocess). 0 doesn't cache.
+
+        Output:
+        -------
+        The record of the job, the parcels for the next job of the group,
+        and the ParcelWriter writing the output (see finish_job). The last
+        two are None after a failure.
+    """
+
+    start = time.perf_counter()
+    record = {'name': job['name'],
+              'hash': job_hash(job),
+              'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'pid': os.getpid(),
+              'reused_parcels': parcel_df is not None}
+
+    try:
+        dasy = load_job(job)
+        configdict = dasy.configdict
+        output = Path(configdict['output_dir']) / job['output']
+        output.parent.mkdir(parents=True, exist_ok=True)
+        record['output'] = str(output.resolve())
+        log = output.parent / (job['name'] + '.log')
+
+        profiler = dasy.startProfiling()
+        with open(log, 'w') as f, contextlib.redirect_stdout(f):
+            try:
+                dasy.preprocess(configdict, cache=cache_entries > 0,
+                                max_cache_entries=max(cache_entries, 1),
+                                lean=lean, parcel_df=parcel_df,
+                                block_df=block_df)
+                if ahead is not None:
+                    ahead()
+                dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+                dasy.disaggregate(dasy.parcel_df, dasy.block_df,
+                                  engine=engine)
+                dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df,
+                                           engine=engine)
+                if integer:
+                    dasy.round_counts(dasy.parcel_df, dasy.block_df)
+                writer = dasy.writeOutput(job['output'], dasy.parcel_df,
+                                          background=True)
+            except Exception:
+                traceback.print_exc(file=f)
+                raise
+        dasy.profiler = None
+    except Exception as error:
+        record.update({'status': 'failed',
+                       'error': type(error).__name__ + ': ' + str(error),
+                       'total_s': time.perf_counter() - start,
+                       'peak_rss_mb': dasymetry.StageProfiler.peak_rss()})
+        return record, None, None
+
+    report = profiler.report()
+    stages = {}
+    for stage in report['stages']:
+        stages[stage['stage']] = (stages.get(stage['stage'], 0)
+                                  + stage['wall_time_s'])
+
+    record.update({'status': 'done',
+                   'error': None,
+                   'total_s': time.perf_counter() - start,
+                   'stages_s': stages,
+                   'peak_rss_mb': report['peak_rss_mb'],
+                   'parcels': len(dasy.parcel_df),
+                   'blocks': len(dasy.block_df),
+                   'population': float(
+                       dasy.parcel_df[configdict['pop_name']].sum())})
+
+    return record, None if lean else dasy.parcel_df, writer
+
+
+def finish_job(record, writer, results):
+    """ Waits for the output of a job to be written, see run_job, and
+        appends the record of the job to results.
+    """
+
+    try:
+        writer.close()
+    except Exception as error:
+        record.update({'status': 'failed',
+                       'error': type(error).__name__ + ': ' + str(error)})
+    append_record(results, record)
+
+    return None
+
+
+def run_group(jobs, results, options, memory_limit=None):
+    """ Runs jobs that share a parcel layer one after another, loading the
+        parcels once, and appends their records to results. The target of
+        the worker processes. With memory_limit (in MB), the worker ends as
+        soon as it uses more, see watch_memory.
+
+        Consecutive jobs overlap: once a job's inputs are loaded, the
+        blocks of the next job are loaded in a background thread while it
+        is disaggregated, and its output is written in the background while
+        the next job loads its inputs.
+    """
+
+    running = {}
+    if memory_limit:
+        threading.Thread(target=watch_memory,
+                         args=(memory_limit, results, running),
+                         daemon=True).start()
+
+    parcel_df = None
+    block_df = None
+    # (record, writer) of the job whose output is being written
+    writing = []
+    loader = ThreadPoolExecutor(max_workers=1)
+    # Output of the background loads goes to the log of whichever job is
+    # running, or nowhere
+    with loader, open(os.devnull, 'w') as f, contextlib.redirect_stdout(f):
+        for n, job in enumerate(jobs):
+            upcoming = jobs[n + 1:n + 2]
+            loading = []
+
+            def ahead(upcoming=upcoming, loading=loading):
+                """ Finishes the job before, and starts loading the
+                    blocks of the next one.
+                """
+                while writing:
+                    finish_job(*writing.pop(), results)
+                for following in upcoming:
+                    loading.append(loader.submit(load_blocks, following))
+
+            running.update({'job': job,
+                            'date': datetime.datetime.now().isoformat(
+                                timespec='seconds'),
+                            'start': time.perf_counter(),
+                            'reused_parcels': parcel_df is not None})
+            record, parcel_df, writer = run_job(
+                job, parcel_df=parcel_df, block_df=block_df, ahead=ahead,
+                **options)
+            running['job'] = None
+
+            # When the job failed before its inputs were loaded
+            while writing:
+                finish_job(*writing.pop(), results)
+            if writer is None:
+                append_record(results, record)
+            else:
+                writing.append((record, writer))
+            block_df = loading[0] if loading else None
+
+        while writing:
+            finish_job(*writing.pop(), results)
+
+    return None
+
+
+def run(manifest, results=None, summary=None, workers=1, memory_limit=None,
+        resume=False, **options):
+    """ Runs the jobs of a manifest in worker processes, see the module
+        documentation. options go to run_job.
+
+        Output:
+        -------
+        Number of jobs that didn't finish.
+    """
+
+    manifest = Path(manifest).resolve()
+    results = Path(results or manifest.with_name(manifest.stem
+                                                 + '_results.jsonl'))
+    summary = Path(summary or manifest.with_name(manifest.stem
+                                                 + '_summary.csv'))
+
+    jobs = read_manifest(manifest)
+    todo = jobs
+    if resume:
+        latest = read_results(results)
+        todo = [job for job in jobs if not finished(job, latest)]
+        print(str(len(jobs) - len(todo)) + ' of ' + str(len(jobs))
+              + ' jobs already done')
+
+    groups = group_jobs(todo)
+    print('Running ' + str(len(todo)) + ' jobs in ' + str(len(groups))
+          + ' groups on ' + str(workers) + ' workers...')
+
+    # A fresh process per group, so memory is given back in between, and a
+    # worker that dies only takes its own group down
+    context = multiprocessing.get_context('spawn')
+    running = {}
+    while groups or running:
+        while groups and len(running) < workers:
+            group = groups.pop(0)
+            process = context.Process(target=run_group,
+                                      args=(group, results, options,
+                                            memory_limit))
+            process.start()
+            running[process.sentinel] = (process, group)
+
+        for sentinel in multiprocessing.connection.wait(list(running)):
+            process, group = running.pop(sentinel)
+            process.join()
+
+            latest = read_results(results)
+            for job in group:
+                record = latest.get(job['name'])
+                if record is None or record['pid'] != process.pid:
+                    # Jobs without a record are run again by --resume
+                    print(job['name'] + ': not run')
+                    continue
+
+                message = job['name'] + ': ' + record['status']
+                if record['status'] == 'done':
+                    message += ' in {:.1f} s'.format(record['total_s'])
+                else:
+                    message += ' (' + record['error'] + ')'
+                print(message)
+
+            if process.exitcode != 0:
+                print('Worker exited with code ' + str(process.exitcode))
+
+    table = report(jobs, results, summary)
+
+    return int((table['status'] != 'done').sum())
+
+
+def report(jobs, results, summary=None):
+    """ Prints the latest record of every job as a table, and writes it to
+        summary as CSV. Times are in seconds, summed over the calls of
+        each stage.
+    """
+
+    import pandas as pd
+
+    latest = read_results(results)
+
+    rows = []
+    for job in jobs:
+        record = latest.get(job['name'], {'name': job['name'],
+                                          'status': 'not run'})
+        row = {'name': job['name'],
+               'status': record['status'],
+               'total_s': record.get('total_s')}
+        stages = record.get('stages_s') or {}
+        for stage in STAGES:
+            row[stage] = stages.get(stage)
+        row.update({'peak_rss_mb': record.get('peak_rss_mb'),
+                    'reused_parcels': record.get('reused_parcels'),
+                    'population': record.get('population'),
+                    'error': record.get('error')})
+        rows.append(row)
+
+    table = pd.DataFrame(rows)
+    table = table.dropna(axis=1, how='all')
+    if summary is not None:
+        table.to_csv(summary, index=False)
+
+    print(table.drop(columns='error', errors='ignore').round(2)
+          .to_string(index=False))
+    print(str((table['status'] == 'done').sum()) + ' of ' + str(len(table))
+          + ' jobs done')
+
+    return table
+
+
+def plan(jobs, memory_limit=None, lean=False):
+    """ Checks the namelist and input files of every job, and prints its
+        estimated peak memory use and run time, see namelist.Config.plan.
+
+        Input:
+        ------
+        jobs: jobs from read_manifest
+        memory_limit (float): memory limit per worker, in MB
+        lean (bool): whether the jobs run with --lean
+
+        Output:
+        -------
+        Number of jobs with problems
+    """
+
+    problems = 0
+    for job in jobs:
+        try:
+            config = Config.read(job['namelist'], overrides=job['overrides'])
+            errors = config.check_inputs()
+        except Exception as error:
+            errors = [str(error)]
+        if errors:
+            problems += 1
+            print(job['name'] + ': ' + '; '.join(errors))
+            continue
+
+        estimate = config.plan(memory_limit=memory_limit)
+        if estimate['mode'] is None:
+            print(job['name'] + ': ok, cannot count the parcels')
+            continue
+
+        memory = estimate['lean_memory_mb' if lean else 'memory_mb']
+        message = (job['name'] + ': ok, '
+                   + format(estimate['parcels_count'], ',') + ' parcels, ~'
+                   + format(memory, ',.0f') + ' MB, ~'
+                   + format(estimate['time_s'], ',.1f') + ' s')
+        if memory_limit is not None and memory > memory_limit:
+            problems += 1
+            message += ', over the memory limit'
+            if not lean and estimate['mode'] == 'lean':
+                message += ' (fits with --lean)'
+        print(message)
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('manifest', help='CSV file with a row per job')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='resident memory limit per worker, in MB')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the jobs that already finished')
+    parser.add_argument('--engine', default='vectorized',
+                        choices=['vectorized', 'legacy'])
+    parser.add_argument('--lean', action='store_true',
+                        help='memory-lean preprocessing, see '
+                        'Dasymetry.preprocess')
+    parser.add_argument('--integer', action='store_true',
+                        help='write whole numbers, see Dasymetry.round_counts')
+    parser.add_argument('--cache-entries', type=int, default=0,
+                        help='pre-processed inputs to keep in each '
+                        'output_dir/cache, 0 for no cache. Use at least '
+                        'the number of jobs if workers share an output_dir')
+    parser.add_argument('--results', default=None,
+                        help='JSON lines file the job records are appended '
+                        'to. Default <manifest>_results.jsonl')
+    parser.add_argument('--summary', default=None,
+                        help='CSV file for the summary table. Default '
+                        '<manifest>_summary.csv')
+    parser.add_argument('--report', action='store_true',
+                        help='print the summary of the recorded jobs and '
+                        'exit')
+    parser.add_argument('--plan', action='store_true',
+                        help='check the jobs and estimate their memory use '
+                        'and run time, without running them')
+    args = parser.parse_args()
+
+    manifest = Path(args.manifest).resolve()
+    if args.plan:
+        problems = plan(read_manifest(manifest),
+                        memory_limit=args.memory_limit, lean=args.lean)
+        sys.exit(1 if problems else 0)
+
+    if args.report:
+        report(read_manifest(manifest),
+               args.results or manifest.with_name(manifest.stem
+                                                  + '_results.jsonl'))
+        return None
+
+    failed = run(manifest, results=args.results, summary=args.summary,
+                 workers=args.workers, memory_limit=args.memory_limit,
+                 resume=args.resume, engine=args.engine, lean=args.lean,
+                 integer=args.integer, cache_entries=args.cache_entries)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
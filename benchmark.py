@@ -0,0 +1,406 @@
+""" Benchmarks the Dasymetry pipeline on synthetic parcels and blocks, so
+    that changes to the disaggregation can be checked for speed and
+    correctness across commits. Runs offline: the inputs are generated
+    (and kept in the work directory for later runs), not downloaded.
+
+    Each run times every pipeline stage (see Dasymetry.startProfiling),
+    checks that the population of the input blocks ends up in the parcels,
+    and appends a record to a JSON lines file, together with the current
+    git commit and a checksum of the parcel results. Same checksum, same
+    results.
+
+    Usage:
+    ------
+    python benchmark.py --parcels 10000 100000 1000000
+    python benchmark.py --parcels 100000 --engine legacy --repeat 3
+    python benchmark.py --compare
+"""
+
+import argparse
+import contextlib
+import datetime
+import hashlib
+import io
+import json
+import subprocess
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+import dasymetry
+
+# Bump when make_city changes, so old generated inputs aren't reused
+GENERATOR_VERSION = 2
+
+# Block size and street width, in feet (EPSG:2263 units)
+BLOCK_WIDTH = 600.0
+BLOCK_HEIGHT = 200.0
+STREET_WIDTH = 60.0
+
+# PLUTO land use codes and how common they are
+LANDUSE_CODES = ['01', '02', '03', '04', '05', '06', '07', '08', '09',
+                 '10', '11']
+LANDUSE_SHARES = [0.33, 0.20, 0.12, 0.04, 0.07, 0.03, 0.02, 0.04, 0.02,
+                  0.05, 0.08]
+
+COUNTY_CODES = ['005', '047', '061', '081', '085']
+
+NAMELIST = """run_dir = {run_dir}/
+input_dir = in/
+output_dir = {run_dir}/out/
+
+parcels_file = {parcels_file}
+parcels_fid = bbl
+res_units = unitsres
+parcel_fields = numfloors, landuse, lotarea, unitsres, geometry
+
+population_file = {population_file}
+population_fid = geoid
+pop_name = totpop_e
+block_fields = totpop_e, geometry
+
+top_hh_size = 2.8
+lot_types = residential, misc, parks
+lot_codes_1 = 01, 02, 03, 04
+lot_codes_2 = 08,
+lot_codes_3 = 09, 11
+top_den_allowed = 55, 5, 5
+"""
+
+
+def make_city(nparcels, seed=0):
+    """ Generates about nparcels tax lots on a grid of census blocks.
+
+        Blocks are 600 x 200 ft, split into two rows of 3 to 12 lots. About
+        2% of the blocks are merged in pairs into a single large elevator
+        building lot (an overpopulated parcel), 3% have no lots (parks), and
+        some of the blocks have population but no residential units (group
+        quarters).
+
+        Input:
+        ------
+        nparcels (int): number of parcels to generate
+        seed (int): seed of the random number generator
+
+        Output:
+        -------
+        parcel_df, block_df: GeoDataFrames in EPSG:2263
+    """
+
+    rng = np.random.default_rng(seed)
+
+    nblocks = int(np.ceil(nparcels/14)) + 1
+    nx = max(2, int(np.ceil(np.sqrt(nblocks*BLOCK_HEIGHT/BLOCK_WIDTH))))
+    ny = int(np.ceil(nblocks/nx))
+    nblocks = nx*ny
+
+    col = np.arange(nblocks) % nx
+    row = np.arange(nblocks) // nx
+    x0 = col*(BLOCK_WIDTH + STREET_WIDTH)
+    y0 = row*(BLOCK_HEIGHT + STREET_WIDTH)
+
+    # Pairs of blocks (col, col + 1) merged into one lot
+    merged = (col % 2 == 0) & (col < nx - 1) & (rng.random(nblocks) < 0.01)
+    covered = merged | np.roll(merged, 1)
+    park = ~covered & (rng.random(nblocks) < 0.03)
+
+    # Regular lots
+    ncols = rng.integers(3, 13, nblocks)
+    ncols[covered | park] = 0
+    nlots = 2*ncols
+
+    block = np.repeat(np.arange(nblocks), nlots)
+    within = np.arange(len(block)) - np.repeat(np.cumsum(nlots) - nlots,
+                                               nlots)
+    width = BLOCK_WIDTH/ncols[block]
+    xmin = x0[block] + (within // 2)*width
+    ymin = y0[block] + (within % 2)*BLOCK_HEIGHT/2
+    geometry = shapely.box(xmin, ymin, xmin + width,
+                           ymin + BLOCK_HEIGHT/2)
+
+    landuse = rng.choice(LANDUSE_CODES, len(block), p=LANDUSE_SHARES)
+    unitsres = np.select(
+        [landuse == '01', landuse == '02', landuse == '03',
+         landuse == '04', landuse == '05', landuse == '08'],
+        [1, 2, 3 + rng.poisson(5, len(block)),
+         10 + rng.lognormal(np.log(40), 0.8, len(block)).astype(int),
+         1 + rng.poisson(4, len(block)),
+         np.where(rng.random(len(block)) < 0.05,
+                  rng.poisson(50, len(block)), 0)],
+        0)
+    numfloors = np.select(
+        [landuse == '01', landuse == '02', landuse == '03',
+         landuse == '04', landuse == '05'],
+        [rng.integers(1, 4, len(block)), rng.integers(2, 4, len(block)),
+         rng.integers(3, 7, len(block)), 6 + rng.geometric(0.1, len(block)),
+         rng.integers(2, 7, len(block))],
+        rng.integers(0, 4, len(block)))
+
+    # Merged lots
+    first = np.flatnonzero(merged)
+    big = shapely.box(x0[first], y0[first],
+                      x0[first] + 2*BLOCK_WIDTH + STREET_WIDTH,
+                      y0[first] + BLOCK_HEIGHT)
+    block = np.concatenate([block, first])
+    geometry = np.concatenate([geometry, big])
+    landuse = np.concatenate([landuse, np.full(len(first), '04')])
+    unitsres = np.concatenate([unitsres, rng.integers(100, 1500, len(first))])
+    numfloors = np.concatenate([numfloors, rng.integers(6, 31, len(first))])
+
+    # Lots in block order, each merged lot with its first block
+    order = np.argsort(block, kind='stable')
+    block = block[order]
+    geometry = geometry[order]
+    landuse = landuse[order]
+    unitsres = unitsres[order]
+    numfloors = numfloors[order]
+
+    # Data gaps, as in PLUTO
+    unitsres[rng.random(len(block)) < 0.03] = 0
+    numfloors[rng.random(len(block)) < 0.03] = 0
+
+    lotarea = shapely.area(geometry)*rng.normal(1, 0.05, len(block))
+
+    parcel_df = gpd.GeoDataFrame(
+        {'bbl': 1000000001 + np.arange(len(block)),
+         'landuse': landuse,
+         'unitsres': unitsres.astype(np.int64),
+         'numfloors': numfloors.astype(float),
+         'lotarea': np.round(lotarea)},
+        geometry=geometry, crs='EPSG:2263')
+
+    # Block population follows its residential units, split evenly
+    # between the two halves of a merged lot
+    units = np.bincount(block, weights=unitsres, minlength=nblocks)
+    units[first + 1] = units[first]/2
+    units[first] = units[first]/2
+    hh_size = 2.6*rng.gamma(4, 1/4, nblocks)
+    pop = rng.poisson(units*hh_size)
+    group_quarters = rng.random(nblocks) < 0.05
+    pop[group_quarters] += rng.poisson(30, group_quarters.sum())
+
+    county = np.array(COUNTY_CODES)[row*len(COUNTY_CODES) // ny]
+    geoid = pd.Series(np.arange(nblocks)).astype(str).str.zfill(10)
+    block_df = gpd.GeoDataFrame(
+        {'geoid': '36' + county + geoid.values,
+         'totpop_e': pop},
+        geometry=shapely.box(x0, y0, x0 + BLOCK_WIDTH, y0 + BLOCK_HEIGHT),
+        crs='EPSG:2263')
+
+    # Drop whole blocks past the block of the nparcels-th lot, keeping both
+    # blocks of a merged lot
+    last = block[min(nparcels, len(block)) - 1]
+    if merged[last]:
+        last = last + 1
+    parcel_df = parcel_df[block <= last]
+    block_df = block_df.iloc[:last + 1]
+
+    return parcel_df, block_df
+
+
+def make_run_dir(workdir, nparcels, seed=0):
+    """ Writes the synthetic inputs and a namelist.config for them to
+        workdir, unless they are already there, and returns the run
+        directory.
+    """
+
+    run_dir = (Path(workdir) / ('v' + str(GENERATOR_VERSION) + '_'
+                                + str(nparcels) + '_' + str(seed))).resolve()
+    namelist = run_dir / 'namelist.config'
+    if namelist.exists():
+        return run_dir
+
+    print('Generating ' + str(nparcels) + ' parcels...')
+    (run_dir / 'in').mkdir(parents=True, exist_ok=True)
+    (run_dir / 'out').mkdir(exist_ok=True)
+
+    parcel_df, block_df = make_city(nparcels, seed=seed)
+
+    if dasymetry.pq is not None:
+        names = ('parcels.parquet', 'blocks.parquet')
+        parcel_df.to_parquet(run_dir / 'in' / names[0])
+        block_df.to_parquet(run_dir / 'in' / names[1])
+    else:
+        names = ('parcels.shp', 'blocks.shp')
+        parcel_df.to_file(run_dir / 'in' / names[0])
+        block_df.to_file(run_dir / 'in' / names[1])
+
+    namelist.write_text(NAMELIST.format(run_dir=run_dir,
+                                        parcels_file=names[0],
+                                        population_file=names[1]))
+
+    return run_dir
+
+
+def git_commit():
+    """ Short hash of the checked out commit, with -dirty if there are
+        uncommitted changes. None outside of a git repository.
+    """
+
+    here = Path(__file__).resolve().parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=here, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain',
+                                '--untracked-files=no'],
+                               cwd=here, capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return commit + '-dirty' if dirty else commit
+
+
+def run_once(run_dir, engine='vectorized'):
+    """ Runs the pipeline on run_dir, returning the stage report and the
+        population check.
+    """
+
+    dasy = dasymetry.Dasymetry(run_dir)
+    dasy.load_namelist(run_dir)
+    pop_name = dasy.configdict['pop_name']
+    profiler = dasy.startProfiling()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        dasy.preprocess(dasy.configdict, cache=False)
+        block_pop = dasy.block_df[pop_name].copy()
+
+        dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+        overpop_left = dasy.block_df[pop_name].copy()
+        dasy.disaggregate(dasy.parcel_df, dasy.block_df, engine=engine)
+        dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df,
+                                   engine=engine)
+        dasy.writeOutput('parcels.csv', dasy.parcel_df)
+
+    dasy.profiler = None
+
+    # Blocks without parcels are dropped with what blocksToOverpop left
+    # them, and blocks with less than 0.25 people left after
+    # blocksToOverpop are zeroed; everything else has to end up in a
+    # parcel or be left in its block.
+    kept = block_pop.sum() - overpop_left.drop(dasy.block_df.index).sum()
+    placed = dasy.parcel_df[pop_name].sum()
+    left = dasy.block_df[pop_name].sum()
+    residual = kept - placed - left
+    tolerance = 1e-6*max(1, kept)
+
+    # Rounded, so that float noise between engines doesn't change it, and
+    # + 0 turns -0.0 into 0.0
+    values = np.round(dasy.parcel_df[pop_name].values.astype(float), 8) + 0
+    checksum = hashlib.sha1(values.tobytes()).hexdigest()[:12]
+
+    population = {'blocks_in': float(block_pop.sum()),
+                  'blocks_dropped': float(block_pop.sum() - kept),
+                  'parcels_out': float(placed),
+                  'blocks_left': float(left),
+                  'zeroed': float(residual)}
+    conserved = bool(-tolerance <= residual
+                     <= 0.25*len(dasy.block_df) + tolerance)
+
+    return profiler.report(), population, conserved, checksum, dasy
+
+
+def benchmark(nparcels, seed=0, engine='vectorized', repeat=1,
+              workdir='benchmark_data'):
+    """ Benchmarks one dataset size, returning a record for the results
+        file. Stage times are the best of repeat runs, summed over the
+        calls of each stage (stages run within other stages, like
+        load_source_files within preprocess, are also counted in those).
+    """
+
+    run_dir = make_run_dir(workdir, nparcels, seed=seed)
+
+    times = {}
+    for _ in range(repeat):
+        report, population, conserved, checksum, dasy = run_once(
+            run_dir, engine=engine)
+        run_times = {}
+        for stage in report['stages']:
+            run_times[stage['stage']] = (run_times.get(stage['stage'], 0)
+                                         + stage['wall_time_s'])
+        run_times['total'] = report['total_wall_time_s']
+        for name, value in run_times.items():
+            times[name] = min(times.get(name, value), value)
+
+    return {'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'parcels': len(dasy.parcel_df),
+            'blocks': len(dasy.block_df),
+            'seed': seed,
+            'engine': engine,
+            'repeat': repeat,
+            'generator': GENERATOR_VERSION,
+            'stages_s': times,
+            'peak_rss_mb': report['peak_rss_mb'],
+            'population': population,
+            'conserved': conserved,
+            'checksum': checksum}
+
+
+def compare(results):
+    """ Prints the total and per-stage times of every recorded run, one
+        table per dataset, oldest run first.
+    """
+
+    with open(results) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+
+    runs = pd.json_normalize(records)
+    runs.columns = [column.replace('stages_s.', '') for column in
+                    runs.columns]
+    stages = ['total', 'load_source_files', 'buildSpatialRelation',
+              'getOverpopParcels', 'assignParcels', 'blocksToOverpop',
+              'disaggregate', 'disaggregate_leftover', 'writeOutput']
+    columns = (['commit', 'date'] + [s for s in stages if s in runs]
+               + ['peak_rss_mb', 'conserved', 'checksum'])
+
+    for key, group in runs.groupby(['parcels', 'seed', 'engine']):
+        print('parcels={}, seed={}, engine={}'.format(*key))
+        print(group[columns].round(3).to_string(index=False))
+        print()
+
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--parcels', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='dataset sizes, in parcels')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', default='vectorized',
+                        choices=['vectorized', 'legacy'])
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='runs per size, the best time is kept')
+    parser.add_argument('--workdir', default='benchmark_data',
+                        help='where the generated inputs are kept')
+    parser.add_argument('--results', default='benchmark_results.jsonl',
+                        help='JSON lines file the results are appended to')
+    parser.add_argument('--compare', action='store_true',
+                        help='print the recorded results and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args.results)
+        return None
+
+    for nparcels in args.parcels:
+        record = benchmark(nparcels, seed=args.seed, engine=args.engine,
+                           repeat=args.repeat, workdir=args.workdir)
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        status = 'ok' if record['conserved'] else 'POPULATION NOT CONSERVED'
+        print('{} parcels: {:.2f} s, {} ({})'.format(
+            record['parcels'], record['stages_s']['total'],
+            record['checksum'], status))
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -1,119 +1,1023 @@
 from pathlib import Path
-import geopandas as gpd
-from tqdm import tqdm
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+import cProfile
+import functools
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import numpy as np
+
+from namelist import Config, SQFT_PER_ACRE
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class LazyModule:
+
+    """ Stands in for a module, which is only imported when one of its
+        attributes is first used. The geospatial stack takes most of a
+        second to import, so it is only loaded once a pipeline stage needs
+        it, not to e.g. read a namelist or print a batch report.
+    """
 
+    __slots__ = ('_name', '_module')
 
-class Dasymetry:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
 
-    """ Class collecting tools to disaggregate socio-demographic data into
-        discrete parcels.
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+def optional(name):
+    """ LazyModule for an optional dependency, or None if it isn't
+        installed.
     """
 
-    def __init__(self, rundir):
+    if importlib.util.find_spec(name.split('.')[0]) is None:
+        return None
 
-        # Add any top-level parameters here.
-        self.rundir = rundir
+    return LazyModule(name)
+
+
+pd = LazyModule('pandas')
+gpd = LazyModule('geopandas')
+shapely = LazyModule('shapely')
+pyproj = LazyModule('pyproj')
+tqdm = LazyModule('tqdm')
+
+# Optional, faster readers. See Dasymetry.load_geodataframe.
+pyogrio = optional('pyogrio')
+pa = optional('pyarrow')
+pq = optional('pyarrow.parquet')
+
+# Optional, compiles the allocation kernels (see area_shares)
+numba = optional('numba')
+
+# Set to False to use the NumPy kernels even when Numba is installed
+USE_NUMBA = True
+
+
+class TransferLedger:
+
+    """ Holds parcel and block populations in contiguous NumPy arrays while
+        a pipeline stage moves people around, and keeps a record of every
+        transfer as (block, parcel, numpeople) batches. Populations are only
+        written back to the GeoDataFrames when the stage is done, see
+        Dasymetry.openLedger and Dasymetry.closeLedger.
+
+        Any other count variables (count_names) are kept as parcel x
+        variable and block x variable matrices, and move along with
+        pop_name: a transfer of some fraction of a block's population also
+        moves that fraction of each of the block's other counts.
+    """
+
+    def __init__(self, pop_name, count_names=()):
+
+        self.pop_name = pop_name
+        self.count_names = list(count_names)
+        self.stage = None
+
+        self.parcel_index = None
+        self.block_index = None
+        self.parcel_pop = None
+        self.block_pop = None
+        self.parcel_counts = None
+        self.block_counts = None
+
+        # Each batch is (stage, block_index, parcel_index, block positions,
+        # parcel positions, numpeople). We keep the indexes the positions
+        # refer to, since block_df loses rows along the pipeline.
+        self.batches = []
+        # Scalar transfers made by blockToParcel, as label tuples.
+        self.single = []
+        # Block counts before the first stage, see Dasymetry.round_counts
+        self.initial = None
 
         return None
 
-    def load_namelist(self, rundir):
-        """ Load the configuration file that contains location of input files,
-            as well as user selected parameters (e.g., max household size).
+    def load(self, parcel_df, block_df):
+        """ Copy the current populations from the GeoDataFrames into the
+            arrays. The label -> position maps are only rebuilt when the
+            GeoDataFrame index has changed since the last load.
+        """
 
-            Input:
+        if (self.parcel_index is None
+                or not self.parcel_index.equals(parcel_df.index)):
+            self.parcel_index = parcel_df.index
+        if (self.block_index is None
+                or not self.block_index.equals(block_df.index)):
+            self.block_index = block_df.index
+
+        if self.initial is None:
+            self.initial = pd.DataFrame(
+                block_df[[self.pop_name] + self.count_names], copy=True)
+
+        self.parcel_pop = parcel_df[self.pop_name].to_numpy(dtype=float,
+                                                            copy=True)
+        self.block_pop = block_df[self.pop_name].to_numpy(dtype=float,
+                                                          copy=True)
+
+        if self.count_names:
+            self.parcel_counts = parcel_df[self.count_names].to_numpy(
+                dtype=float, copy=True)
+            self.block_counts = block_df[self.count_names].to_numpy(
+                dtype=float, copy=True)
+
+        return None
+
+    def parcel_positions(self, parcels):
+        """ Integer positions of parcel indices (e.g., bbl) in the arrays.
+        """
+        return self.parcel_index.get_indexer(parcels)
+
+    def block_positions(self, blocks):
+        """ Integer positions of block indices (e.g., geoid) in the arrays.
+        """
+        return self.block_index.get_indexer(blocks)
+
+    def record(self, block_pos, parcel_pos, numpeople):
+        """ Transfer numpeople[i] from block position block_pos[i] to parcel
+            position parcel_pos[i], for every i.
+        """
+
+        block_pos = np.asarray(block_pos, dtype=np.int64)
+        parcel_pos = np.asarray(parcel_pos, dtype=np.int64)
+        numpeople = np.asarray(numpeople, dtype=float)
+
+        if self.count_names:
+            # Fraction of the block's current population being moved
+            block_pop = self.block_pop[block_pos]
+            share = np.divide(numpeople, block_pop,
+                              out=np.zeros(len(numpeople)),
+                              where=block_pop != 0)
+            moved = self.block_counts[block_pos]*share[:, np.newaxis]
+
+            for n in range(len(self.count_names)):
+                self.parcel_counts[:, n] += np.bincount(
+                    parcel_pos, weights=moved[:, n],
+                    minlength=len(self.parcel_pop))
+                self.block_counts[:, n] -= np.bincount(
+                    block_pos, weights=moved[:, n],
+                    minlength=len(self.block_pop))
+
+        self.parcel_pop += np.bincount(parcel_pos, weights=numpeople,
+                                       minlength=len(self.parcel_pop))
+        self.block_pop -= np.bincount(block_pos, weights=numpeople,
+                                      minlength=len(self.block_pop))
+
+        self.batches.append((self.stage, self.block_index, self.parcel_index,
+                             block_pos, parcel_pos, numpeople))
+
+        return None
+
+    def clear_blocks(self, block_pos):
+        """ Set the population and counts of the given blocks to zero.
+        """
+        self.block_pop[block_pos] = 0
+        if self.count_names:
+            self.block_counts[block_pos] = 0
+
+        return None
+
+    def log(self, block, parcel, numpeople):
+        """ Keep track of a transfer that was written straight to the
+            GeoDataFrames (see Dasymetry.blockToParcel).
+        """
+        stage = 'blockToParcel' if self.stage is None else self.stage
+        self.single.append((stage, block, parcel, numpeople))
+
+        return None
+
+    def flush(self, parcel_df, block_df):
+        """ Write the array populations back to the GeoDataFrames.
+        """
+        parcel_df[self.pop_name] = self.parcel_pop
+        block_df[self.pop_name] = self.block_pop
+
+        for n, name in enumerate(self.count_names):
+            parcel_df[name] = self.parcel_counts[:, n]
+            block_df[name] = self.block_counts[:, n]
+
+        return None
+
+    def to_frame(self, aggregate=True):
+        """ Returns all recorded transfers as a DataFrame with columns stage,
+            block, parcel and numpeople. With aggregate=True, transfers
+            between the same block and parcel in the same stage are added up.
+        """
+
+        frames = [pd.DataFrame({'stage': stage,
+                                'block': block_index[block_pos],
+                                'parcel': parcel_index[parcel_pos],
+                                'numpeople': numpeople})
+                  for (stage, block_index, parcel_index,
+                       block_pos, parcel_pos, numpeople) in self.batches]
+        columns = ['stage', 'block', 'parcel', 'numpeople']
+        if self.single:
+            frames.append(pd.DataFrame(self.single, columns=columns))
+        if not frames:
+            return pd.DataFrame(columns=columns)
+
+        transfers = pd.concat(frames, ignore_index=True)
+
+        if aggregate:
+            transfers = transfers.groupby(['stage', 'block', 'parcel'],
+                                          sort=False, as_index=False).sum()
+
+        return transfers
+
+
+class SpatialRelation:
+
+    """ Parcel <-> block containment relation, computed once per run and
+        shared by getOverpopParcels, assignParcels and blocksToOverpop.
+        Parcel and block centroids are computed once and kept as (n, 2)
+        coordinate arrays, and each relation is a pair of integer position
+        arrays into parcel_index and block_index.
+    """
+
+    def __init__(self, parcel_index, block_index, blocks_in_parcels,
+                 parcels_in_blocks, parcel_xy=None, block_xy=None):
+
+        self.parcel_index = parcel_index
+        self.block_index = block_index
+
+        # (parcel positions, block positions) of block centroids that fall
+        # within each parcel, sorted by parcel.
+        self.blocks_in_parcels = blocks_in_parcels
+        # (block positions, parcel positions) of parcel centroids that fall
+        # within each block, sorted by block.
+        self.parcels_in_blocks = parcels_in_blocks
+
+        self.parcel_xy = parcel_xy
+        self.block_xy = block_xy
+
+        return None
+
+    @classmethod
+    def from_frames(cls, parcel_df, block_df):
+        """ Compute the centroids and both containment relations, querying
+            a spatial index of each layer once. The indexes and centroid
+            points are let go afterwards, rather than cached on the
+            GeoDataFrames (as .sindex does) for the rest of the run.
+        """
+
+        print('Building spatial index...')
+
+        parcels = np.asarray(parcel_df.geometry.values)
+        blocks = np.asarray(block_df.geometry.values)
+        parcel_xy = centroid_xy(parcels)
+        block_xy = centroid_xy(blocks)
+
+        block_pos, parcel_pos = shapely.STRtree(parcels).query(
+            shapely.points(block_xy), predicate='intersects')
+        order = np.lexsort((block_pos, parcel_pos))
+        blocks_in_parcels = (parcel_pos[order], block_pos[order])
+
+        parcel_pos, block_pos = shapely.STRtree(blocks).query(
+            shapely.points(parcel_xy), predicate='intersects')
+        order = np.lexsort((parcel_pos, block_pos))
+        parcels_in_blocks = (block_pos[order], parcel_pos[order])
+
+        return cls(parcel_df.index, block_df.index, blocks_in_parcels,
+                   parcels_in_blocks, parcel_xy, block_xy)
+
+    def matches(self, parcel_df, block_df):
+        """ Whether the relation was built for these parcels and blocks.
+        """
+        return (self.parcel_index.equals(parcel_df.index)
+                and self.block_index.equals(block_df.index))
+
+
+class BlockMembership:
+
+    """ Block -> parcel membership in compressed sparse row (CSR) layout.
+        The parcels of the block at position i are
+        parcel_pos[offsets[i]:offsets[i + 1]], given as positions into
+        parcel_index. This replaces a column of Python lists in block_df.
+    """
+
+    def __init__(self, block_index, parcel_index, offsets, parcel_pos):
+
+        self.block_index = block_index
+        self.parcel_index = parcel_index
+        self.offsets = offsets
+        self.parcel_pos = parcel_pos
+
+        return None
+
+    @classmethod
+    def from_pairs(cls, block_index, parcel_index, block_pos, parcel_pos):
+        """ Build the membership from (block position, parcel position)
+            pairs. Parcels keep their relative order within each block.
+        """
+
+        counts = np.bincount(block_pos, minlength=len(block_index))
+        offsets = np.zeros(len(block_index) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        order = np.argsort(block_pos, kind='stable')
+
+        return cls(block_index, parcel_index, offsets,
+                   np.asarray(parcel_pos, dtype=np.int64)[order])
+
+    @property
+    def counts(self):
+        """ Number of parcels in each block.
+        """
+        return np.diff(self.offsets)
+
+    @property
+    def has_parcels(self):
+        """ Boolean array, True for blocks that contain at least one parcel.
+        """
+        return self.offsets[1:] > self.offsets[:-1]
+
+    def matches(self, block_df):
+        """ Whether the membership was built for these blocks.
+        """
+        return self.block_index.equals(block_df.index)
+
+    def parcels_of(self, block):
+        """ Parcel positions of the block at position block.
+        """
+        return self.parcel_pos[self.offsets[block]:self.offsets[block + 1]]
+
+    def parcels_in(self, blockid):
+        """ Parcel indices (e.g., bbl) of the block with index blockid (e.g.,
+            geoid).
+        """
+        return self.parcel_index[self.parcels_of(
+            self.block_index.get_loc(blockid))]
+
+    def pairs(self, blocks=None):
+        """ Expands the membership of the blocks at positions blocks (all
+            blocks by default) into one (block position, parcel position)
+            row per contained parcel, grouped by block.
+        """
+
+        if blocks is None:
+            blocks = np.arange(len(self.block_index))
+        blocks = np.asarray(blocks, dtype=np.int64)
+
+        counts = self.offsets[blocks + 1] - self.offsets[blocks]
+        block_pos = np.repeat(blocks, counts)
+
+        # Position of each row within its block, added to the block offset
+        first_row = np.repeat(np.cumsum(counts) - counts, counts)
+        within = np.arange(len(block_pos)) - first_row
+        parcel_pos = self.parcel_pos[np.repeat(self.offsets[blocks], counts)
+                                     + within]
+
+        return block_pos, parcel_pos
+
+    def sum(self, values):
+        """ Per-block sum of a parcel array (e.g. residential units) over
+            each block's parcels. Blocks without parcels sum to zero.
+        """
+
+        values = np.asarray(values)[self.parcel_pos]
+        sums = np.zeros(len(self.block_index), dtype=np.result_type(values,
+                                                                    float))
+        if len(values) == 0:
+            return sums
+
+        nonempty = self.has_parcels
+        sums[nonempty] = np.add.reduceat(values, self.offsets[:-1][nonempty])
+
+        return sums
+
+    def take(self, blocks):
+        """ Membership restricted to the blocks at positions blocks.
+        """
+
+        blocks = np.asarray(blocks, dtype=np.int64)
+        block_pos, parcel_pos = self.pairs(blocks)
+        counts = self.offsets[blocks + 1] - self.offsets[blocks]
+
+        offsets = np.zeros(len(blocks) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        return BlockMembership(self.block_index[blocks], self.parcel_index,
+                               offsets, parcel_pos)
+
+
+class PreprocessCache:
+
+    """ On-disk cache of the loaded and pre-processed inputs, i.e. the state
+        after load_source_files, getOverpopParcels and assignParcels. Entries
+        live in their own folder under cache_dir and are keyed by a
+        fingerprint of the input files, study area mask included (size and
+        modification time), and of the namelist fields used to load them.
+        Allocation parameters such as top_hh_size or top_den_allowed are not
+        part of the key, so changing them reuses the cached inputs.
+
+        GeoDataFrames are stored as GeoParquet, which needs pyarrow.
+    """
+
+    # Bump when the layout of a cache entry changes
+    version = 2
+
+    key_fields = ('parcels_file', 'parcels_fid', 'parcel_fields',
+                  'population_file', 'population_fid', 'block_fields',
+                  'pop_name', 'study_area_bbox', 'study_area_crs',
+                  'study_area_mask')
+
+    def __init__(self, cache_dir, max_entries=3):
+
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+
+        return None
+
+    @staticmethod
+    def available():
+        """ Whether the GeoParquet backend (pyarrow) is installed.
+        """
+        return pq is not None
+
+    @staticmethod
+    def fingerprint(filename):
+        """ Size and modification time of filename and of the files sharing
+            its stem (e.g. the .dbf, .shx and .prj of a shapefile).
+        """
+
+        filename = Path(filename).resolve()
+        files = sorted(filename.parent.glob(filename.stem + '.*'))
+
+        return [(f.name, f.stat().st_size, f.stat().st_mtime_ns)
+                for f in files]
+
+    @classmethod
+    def fingerprints(cls, configdict):
+        """ fingerprint of every input file described by configdict: the
+            parcels, the population and, when given, the study area mask.
+        """
+
+        inputs = configdict['run_dir'] / configdict['input_dir']
+        files = {'parcels': configdict['parcels_file'],
+                 'population': configdict['population_file']}
+        if configdict.get('study_area_mask') is not None:
+            files['study_area_mask'] = configdict['study_area_mask']
+
+        return {name: cls.fingerprint(inputs / filename)
+                for name, filename in files.items()}
+
+    def key(self, configdict, lean=False):
+        """ Cache key for the inputs described by configdict. Lean entries
+            (see Dasymetry.preprocess) hold parcel centroids instead of
+            polygons, so they are kept apart.
+        """
+
+        description = {field: configdict.get(field)
+                       for field in self.key_fields}
+        description['version'] = self.version
+        description['lean'] = lean
+        description.update(self.fingerprints(configdict))
+
+        description = json.dumps(description, sort_keys=True, default=str)
+
+        return hashlib.sha256(description.encode()).hexdigest()[:16]
+
+    def load(self, key):
+        """ Returns the cached entry as a dict with keys parcel_df, block_df,
+            relation and membership, or None if there is no entry for key.
+        """
+
+        entry = self.cache_dir / key
+        if not (entry / 'arrays.npz').exists():
+            return None
+
+        parcel_df = gpd.read_parquet(entry / 'parcels.parquet')
+        block_df = gpd.read_parquet(entry / 'blocks.parquet')
+
+        with np.load(entry / 'arrays.npz') as arrays:
+            relation = SpatialRelation(
+                parcel_df.index, block_df.index,
+                (arrays['bip_parcel'], arrays['bip_block']),
+                (arrays['pib_block'], arrays['pib_parcel']),
+                arrays['parcel_xy'], arrays['block_xy'])
+            membership = BlockMembership(block_df.index, parcel_df.index,
+                                         arrays['offsets'],
+                                         arrays['parcel_pos'])
+
+        # Mark the entry as recently used
+        entry.touch()
+
+        return {'parcel_df': parcel_df, 'block_df': block_df,
+                'relation': relation, 'membership': membership}
+
+    def save(self, key, parcel_df, block_df, relation, membership):
+        """ Store a cache entry for key, then evict the oldest entries.
+        """
+
+        entry = self.cache_dir / key
+        partial = self.cache_dir / (key + '.partial')
+        partial.mkdir(parents=True, exist_ok=True)
+
+        parcel_df.to_parquet(partial / 'parcels.parquet')
+        block_df.to_parquet(partial / 'blocks.parquet')
+        np.savez(partial / 'arrays.npz',
+                 bip_parcel=relation.blocks_in_parcels[0],
+                 bip_block=relation.blocks_in_parcels[1],
+                 pib_block=relation.parcels_in_blocks[0],
+                 pib_parcel=relation.parcels_in_blocks[1],
+                 parcel_xy=relation.parcel_xy,
+                 block_xy=relation.block_xy,
+                 offsets=membership.offsets,
+                 parcel_pos=membership.parcel_pos)
+
+        # Only complete entries get the final name
+        if entry.exists():
+            shutil.rmtree(entry)
+        partial.rename(entry)
+
+        self.evict()
+
+        return None
+
+    def evict(self):
+        """ Remove all but the max_entries most recently used entries.
+        """
+
+        entries = [d for d in self.cache_dir.iterdir()
+                   if d.is_dir() and not d.name.endswith('.partial')]
+        entries.sort(key=lambda d: d.stat().st_mtime, reverse=True)
+
+        # Other processes may be evicting from the same folder
+        for entry in entries[self.max_entries:]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+        return None
+
+
+class ParcelWriter:
+
+    """ Writes parcel results to a CSV or Parquet file, at once or in chunks
+        (see Dasymetry.writeOutput and Dasymetry.disaggregate_streaming).
+        The format follows the file name: .csv, optionally compressed
+        (e.g. .csv.gz), or .parquet/.geoparquet. Parquet output needs
+        pyarrow, and is written as GeoParquet if geometry is kept.
+
+        With partition_by, the output is a directory with a sub-directory
+        per partition value (<column>=<value>/, as read by pyarrow, pandas
+        and most query engines), each holding a file per chunk written.
+
+        With background=True, chunks are written by a thread of their own,
+        in order, while the caller goes on with the next chunk. Call close
+        to wait for the last one.
+    """
+
+    def __init__(self, outfile, geometry=False, compression=None,
+                 partition_by=None, background=False):
+        """ Input:
             ------
-            rundir: running directory containing the file 'namelist.config'
+            outfile: output file, or directory with partition_by. Replaced
+            if it exists.
+            geometry (bool): also write the parcel geometries, as WKT in
+            CSV files
+            compression (str): compression codec, e.g. 'gzip' for CSV or
+            'zstd' for Parquet. Default None infers it from the file name
+            for CSV, and uses snappy for Parquet.
+            partition_by: column to partition by, or an int n to partition
+            by the first n characters of the parcel id (e.g. 1 for the
+            borough digit of BBLs)
+            background (bool): write in a background thread
+        """
 
-            Output:
-            -------
-            Creates dictionary with name, parameter pairs as a class attribute
+        self.outfile = Path(outfile)
+        self.geometry = geometry
+        self.compression = compression
+        self.partition_by = partition_by
+        self.chunks = 0
+        self.writer = None
+        self.pool = ThreadPoolExecutor(max_workers=1) if background else None
+        self.pending = None
+
+        suffixes = [suffix.lower() for suffix in self.outfile.suffixes]
+        if '.csv' in suffixes:
+            self.format = 'csv'
+        elif suffixes and suffixes[-1] in ('.parquet', '.geoparquet'):
+            if pq is None:
+                raise Exception('Parquet output needs pyarrow')
+            self.format = 'parquet'
+        else:
+            raise Exception('Output format of ' + self.outfile.name
+                            + ' is not supported')
+
+        if self.outfile.is_dir():
+            shutil.rmtree(self.outfile)
+        elif self.outfile.exists():
+            self.outfile.unlink()
+
+        return None
+
+    def to_table(self, df):
+        """ Arrow table of df, with the geometry as WKB and GeoParquet
+            metadata if there is one.
         """
 
-        def clean_lot_list(lot_list):
-            """ Function to remove empty items from namelist.config fields.
-                We do this because it's easier to remove empty items than
-                it is to turn 1-item fields into a list.
+        if not isinstance(df, gpd.GeoDataFrame):
+            return pa.Table.from_pandas(df, preserve_index=True)
+
+        name = df.geometry.name
+        table = pa.Table.from_pandas(pd.DataFrame(df.drop(columns=name)),
+                                     preserve_index=True)
+        table = table.append_column(
+            name, pa.array(shapely.to_wkb(np.asarray(df.geometry.values))))
+
+        geo = {'version': '1.0.0',
+               'primary_column': name,
+               'columns': {name: {
+                   'encoding': 'WKB',
+                   'geometry_types': [],
+                   'crs': (None if df.crs is None
+                           else df.crs.to_json_dict())}}}
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'geo'] = json.dumps(geo).encode()
+
+        return table.replace_schema_metadata(metadata)
+
+    def write_file(self, df, outfile):
+        """ Writes (or appends) df to outfile. """
+
+        if self.format == 'csv':
+            if isinstance(df, gpd.GeoDataFrame):
+                df = pd.DataFrame(df.assign(
+                    **{df.geometry.name: df.geometry.to_wkt()}))
+            df.to_csv(outfile, mode='a', header=not outfile.exists(),
+                      compression=self.compression or 'infer')
+            return None
+
+        table = self.to_table(df)
+        if self.partition_by is not None:
+            pq.write_table(table, outfile,
+                           compression=self.compression or 'snappy')
+            return None
 
-                Input:
-                ------
-                lot_list: list read from namelist.config
-            """
-            newlist = [item for item in lot_list if item != '']
-            return newlist
+        # Later chunks have to match the schema of the first one
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(
+                outfile, table.schema,
+                compression=self.compression or 'snappy')
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
 
-        def acre_to_sqft(area_val, conversion=43560):
-            """ Converts from area_val (in people/acre) to people/sqft
+        return None
 
-                Input:
-                ------
-                area_val: Array-like values representing parcel data in people
-                per square feet (EPSG 2263 native units)
-            """
+    def write(self, df):
+        """ Writes a chunk of parcel results, see output_frame. In the
+            background, df must not be modified afterwards.
+        """
 
-            return area_val/conversion
+        if self.pool is None:
+            return self.write_chunk(df)
 
-        def assign_lot_codes():
-            """ Assign the list of landuse codes belonging to each lot type
-                in the namelist.config field lot_types
+        # Only one chunk is queued at a time, so memory stays bounded and
+        # a failed write surfaces at the next call
+        self.wait()
+        self.pending = self.pool.submit(self.write_chunk, df)
 
-                lot_types are in order of population assignment priority,
-                (e.g., lot_code_1 corresponds to the first item in lot_types)
-            """
+        return None
+
+    def wait(self):
+        """ Waits for the chunk being written in the background, if any.
+        """
 
-            for n, lot in enumerate(self.configdict['lot_types']):
-                code_name = lot + '_codes'
-                codes = 'lot_codes_' + str(n + 1)
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
 
-                lot_list = clean_lot_list(self.configdict[codes])
-                self.configdict[code_name] = lot_list
+        return None
+
+    def write_chunk(self, df):
+        """ Writes a chunk of parcel results, see write. """
+
+        if len(df) == 0:
+            return None
 
-                # Remove original lot_code entry from configdict
-                del self.configdict['lot_codes_' + str(n + 1)]
+        if not self.geometry and isinstance(df, gpd.GeoDataFrame):
+            df = pd.DataFrame(df.drop(columns=df.geometry.name))
+
+        if self.partition_by is None:
+            self.write_file(df, self.outfile)
+        else:
+            if isinstance(self.partition_by, int):
+                column = str(df.index.name) + '_' + str(self.partition_by)
+                keys = df.index.astype(str).str[:self.partition_by]
+            else:
+                column = self.partition_by
+                keys = df[column]
+
+            # As usual in this layout, the partition column is only kept in
+            # the directory names
+            if column in df:
+                df = df.drop(columns=column)
+
+            suffix = ''.join(self.outfile.suffixes)
+            for key, part in df.groupby(np.asarray(keys)):
+                folder = self.outfile / (column + '=' + str(key))
+                folder.mkdir(parents=True, exist_ok=True)
+                self.write_file(part, folder / ('part-' + str(self.chunks)
+                                                + suffix))
+
+        self.chunks += 1
+
+        return None
+
+    def close(self):
+
+        if self.pool is not None:
+            try:
+                self.wait()
+            finally:
+                self.pool.shutdown()
+                self.pool = None
+
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        return None
+
+
+class StageProfiler:
+
+    """ Records the pipeline stages run by a Dasymetry object while it is
+        attached to it (see Dasymetry.startProfiling): wall time, resident
+        memory at the start of the stage and at its peak during the stage
+        (sampled every 10 ms, see sample), the peak of the whole process so
+        far, parcel and block rows before and after, transfers
+        recorded in the ledger, and total population (parcels + blocks)
+        before and after, to check that it is conserved (disaggregate
+        drops the population of blocks without parcels, and of blocks with
+        less than 0.25 people). With profile=True the stages also run under
+        cProfile.
+    """
+
+    def __init__(self, profile=False):
+
+        self.stages = []
+        self.depth = 0
+        self.start = time.perf_counter()
+        # [peak] of every stage that is running, by id, see sample
+        self.running = {}
+        self.profile = cProfile.Profile() if profile else None
+
+        return None
+
+    @staticmethod
+    def peak_rss():
+        """ Peak resident memory of this process so far, in MB. """
+
+        if resource is None:
+            return None
+
+        # ru_maxrss is in kB on Linux, and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == 'darwin':
+            peak = peak/1024
+
+        return peak/1024
+
+    @staticmethod
+    def current_rss():
+        """ Resident memory of this process now, in MB, or None where
+            /proc isn't available.
+        """
 
+        try:
+            with open('/proc/self/statm') as f:
+                pages = int(f.read().split()[1])
+        except (OSError, IndexError, ValueError):
             return None
 
-        rundir = Path(rundir)
+        return pages*os.sysconf('SC_PAGE_SIZE')/2**20
 
-        with open(rundir / 'namelist.config') as f:
-            lines = f.readlines()
+    def sample(self, stop):
+        """ Raises the peak of every running stage to the current resident
+            memory, every 10 ms until stop is set. Runs in a thread during
+            the outermost stage.
+        """
+
+        while not stop.wait(0.01):
+            rss = self.current_rss()
+            for peak in list(self.running.values()):
+                peak[0] = max(peak[0], rss)
+
+        return None
+
+    @staticmethod
+    def snapshot(dasy):
+        """ Rows, population and ledger transfers of a Dasymetry object. """
+
+        parcels = getattr(dasy, 'parcel_df', None)
+        blocks = getattr(dasy, 'block_df', None)
+        ledger = dasy.ledger
+        pop_name = getattr(dasy, 'configdict', {}).get('pop_name')
+
+        population = None
+        if (parcels is not None and blocks is not None
+                and pop_name in parcels and pop_name in blocks):
+            population = float(parcels[pop_name].sum()
+                               + blocks[pop_name].sum())
+
+        transfers = 0
+        if ledger is not None:
+            transfers = (sum(len(batch[-1]) for batch in ledger.batches)
+                         + len(ledger.single))
+
+        return {'parcels': None if parcels is None else len(parcels),
+                'blocks': None if blocks is None else len(blocks),
+                'population': population,
+                'transfers': transfers,
+                'ledger': ledger}
+
+    @contextlib.contextmanager
+    def measure(self, stage, dasy):
+        """ Records the code run within the with block as one stage. """
+
+        before = self.snapshot(dasy)
+        process_peak = self.peak_rss()
+        rss = self.current_rss()
+        peak = [rss]
+        start = time.perf_counter()
+        outermost = self.depth == 0
+        sampler = None
+        if outermost and rss is not None:
+            stop = threading.Event()
+            sampler = threading.Thread(target=self.sample, args=(stop,),
+                                       daemon=True)
+            sampler.start()
+        if outermost and self.profile is not None:
+            self.profile.enable()
+        self.depth += 1
+        self.running[id(peak)] = peak
+
+        try:
+            yield
+        finally:
+            del self.running[id(peak)]
+            self.depth -= 1
+            if outermost and self.profile is not None:
+                self.profile.disable()
+            if sampler is not None:
+                stop.set()
+                sampler.join()
+
+        wall_time = time.perf_counter() - start
+        after = self.snapshot(dasy)
+
+        if rss is not None:
+            peak[0] = max(peak[0], self.current_rss())
+        # A new process peak can only have been reached during this stage,
+        # and is exact where sampling may miss a short spike
+        if process_peak is not None and self.peak_rss() > process_peak:
+            peak[0] = max(peak[0] or 0, self.peak_rss())
+
+        transfers = after['transfers']
+        if after['ledger'] is before['ledger']:
+            transfers = transfers - before['transfers']
+
+        change = None
+        conserved = None
+        population = before['population']
+        if population is not None and after['population'] is not None:
+            change = after['population'] - population
+            conserved = abs(change) <= 1e-6*max(1, abs(population))
+
+        self.stages.append({
+            'stage': stage,
+            'depth': self.depth,
+            'start_s': start - self.start,
+            'wall_time_s': wall_time,
+            'rss_start_mb': rss,
+            'peak_rss_mb': peak[0],
+            'peak_rss_change_mb': (None if rss is None or peak[0] is None
+                                   else peak[0] - rss),
+            'process_peak_rss_mb': self.peak_rss(),
+            'parcels_in': before['parcels'],
+            'parcels_out': after['parcels'],
+            'blocks_in': before['blocks'],
+            'blocks_out': after['blocks'],
+            'transfers': transfers,
+            'population_in': before['population'],
+            'population_out': after['population'],
+            'population_change': change,
+            'conserved': conserved})
+
+        return None
+
+    def report(self):
+        """ The recorded stages, in the order they started. Stages run
+            within another stage (e.g. load_source_files within preprocess)
+            have depth > 0.
+        """
+
+        stages = sorted(self.stages, key=lambda record: record['start_s'])
+        total = sum(record['wall_time_s'] for record in stages
+                    if record['depth'] == 0)
+
+        return {'stages': stages,
+                'total_wall_time_s': total,
+                'peak_rss_mb': self.peak_rss()}
+
+
+def instrumented(method):
+    """ Makes a Dasymetry method report to the StageProfiler attached to
+        the object, if any, as a pipeline stage.
+    """
 
-            # Now that the namelist is a list, we don't need whitespace or
-            # empty lines
-            lines = [l.strip() for l in lines]
-            lines = list(filter(None, lines))
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        profiler = getattr(self, 'profiler', None)
+        if profiler is None:
+            return method(self, *args, **kwargs)
 
-            linesplit = [l.replace(' ', '').split('=') for l in lines]
-            params = {l[0]: l[1:][0] for
-                      l in linesplit}
+        with profiler.measure(method.__name__, self):
+            return method(self, *args, **kwargs)
 
-            params = {key: params[key].split(',') for key in params.keys()}
+    return wrapper
 
-            # Some parameters should be floats rather than strings.
-            numerical_params = ('top_hh_size', 'top_den_allowed')
-            for key in numerical_params:
-                params[key] = [float(val) for val in params[key]]
 
-            params = {key: params[key][0] if len(params[key]) == 1 else
-                      params[key] for key in params.keys()}
+class Dasymetry:
 
-            for key in ('run_dir', 'input_dir', 'output_dir'):
+    """ Class collecting tools to disaggregate socio-demographic data into
+        discrete parcels.
+    """
 
-                params[key] = Path(params[key])
+    # Block columns disaggregate only needs while it computes the shares
+    scratch_columns = ('contained_resunits', 'pop_resunits_ratio')
 
-        # Allowed densities are in units of people/acre. Convertt to projection
-        # units (1 acre = 43560 sq. ft)
-        params['top_den_allowed'] = [acre_to_sqft(val) for val
-                                     in params['top_den_allowed']]
-        self.configdict = params
-        self.res_units = params['res_units']
+    def __init__(self, rundir):
+
+        # Add any top-level parameters here.
+        self.rundir = rundir
+        self.config = None
+        self.ledger = None
+        self.relation = None
+        self.membership = None
+        self.profiler = None
+        self.lean = False
 
-        # Call function to assign landuse codes to their corresponding names
-        assign_lot_codes()
+        return None
 
-    def load_geodataframe(self, filename, fid='bbl'):
-        """ Method to load geometric data. Uses geopandas to load a shapefile
-            into a GeoDataFrame, then performs some light cleaning of column
-            names.
+    def load_namelist(self, rundir, overrides=None):
+        """ Load the configuration file that contains location of input files,
+            as well as user selected parameters (e.g., max household size).
+            The file is read and checked by namelist.Config, see there for
+            the parameters and checks.
+
+            Input:
+            ------
+            rundir: running directory containing the file 'namelist.config',
+            or the path of a namelist file
+            overrides (dict): parameters that replace (or add to) those in the
+            file, written as in the file, e.g. {'population_file':
+            'acs2019.shp', 'top_den_allowed': '55, 5, 5'}. Used by batch.py.
+
+            Output:
+            -------
+            Creates dictionary with name, parameter pairs as a class attribute,
+            and keeps the Config as self.config
+        """
+
+        self.config = Config.read(rundir, overrides=overrides)
+        for warning in self.config.warnings:
+            print('Warning: ' + warning)
+
+        # Densities in people/sq. ft and the codes of each lot type as
+        # <lot>_codes, see Config.to_dict
+        self.configdict = self.config.to_dict()
+        self.res_units = self.configdict['res_units']
+
+        return None
+
+    def load_geodataframe(self, filename, fid='bbl', columns=None, bbox=None,
+                          mask=None):
+        """ Method to load geometric data. Uses geopandas to load a shapefile,
+            GeoPackage or GeoParquet file into a GeoDataFrame, then performs
+            some light cleaning of column names. Column selection and the
+            study area are passed down to the reader, so unused columns and
+            features are never loaded. pyogrio (with Arrow, when pyarrow is
+            installed) is used when available.
 
             Input:
             ------
@@ -122,41 +1026,208 @@ class Dasymetry:
             fid (str): Column name of parcel identifier.
             Default bbl from NYC MapPLUTO.
 
+            columns (list): Lowercase names of the columns to load, besides
+            fid and the geometry. Default None loads every column.
+
+            bbox (GeoSeries): Only load features that intersect the bounds of
+            bbox. Reprojected to the file's CRS when bbox has a CRS.
+
+            mask (GeoSeries): Only load features that intersect mask.
+            Reprojected to the file's CRS when mask has a CRS. With both
+            bbox and mask, features that intersect the part of mask within
+            bbox, as in load_parcels_lean.
+
             Output:
             -------
             gdf: GeoDataFrame object containing data and geometry.
         """
 
+        def to_file_crs(area, crs):
+            """ Reproject a study area GeoSeries to the CRS of the file.
+            """
+            if area is None or area.crs is None or crs is None:
+                return area
+            return area.to_crs(crs)
+
+        def select(names):
+            """ Map the requested lowercase column names to the names used in
+                the file.
+            """
+            if columns is None:
+                return None
+            wanted = set(columns) | {fid}
+            return [name for name in names if name.lower() in wanted]
+
+        def read_parquet():
+            schema = pq.read_schema(filename)
+            geo = json.loads(schema.metadata[b'geo'])
+            geometry = geo['primary_column']
+
+            names = select([n for n in schema.names if n != geometry])
+            df = gpd.read_parquet(filename, columns=(None if names is None
+                                                     else names + [geometry]))
+
+            # Parquet readers don't filter spatially, so do it here.
+            for area, use_bounds in ((bbox, True), (mask, False)):
+                area = to_file_crs(area, df.crs)
+                if area is None:
+                    continue
+                geom = (shapely.box(*area.total_bounds) if use_bounds else
+                        shapely.union_all(np.asarray(area.values)))
+                hits = np.sort(df.sindex.query(geom, predicate='intersects'))
+                df = df.iloc[hits]
+
+            return df
+
+        def read_pyogrio():
+            info = pyogrio.read_info(filename)
+            area = to_file_crs(bbox, info['crs'])
+            area_mask = to_file_crs(mask, info['crs'])
+
+            return pyogrio.read_dataframe(
+                filename,
+                columns=select(list(info['fields'])),
+                bbox=None if area is None else tuple(area.total_bounds),
+                mask=(None if area_mask is None else
+                      shapely.union_all(np.asarray(area_mask.values))),
+                use_arrow=pq is not None)
+
+        def read_fiona():
+            # geopandas reprojects bbox and mask itself on this path
+            df = gpd.read_file(filename, bbox=bbox, mask=mask)
+            names = select([n for n in df.columns if n != 'geometry'])
+            if names is not None:
+                df = df.loc[:, names + ['geometry']]
+            return df
+
         # Make the feature id a class attribute
         # self.parcel_fid = fid
 
+        # The readers take a bbox or a mask, not both, so clip the mask
+        if bbox is not None and mask is not None:
+            bounds = bbox if bbox.crs is None else to_file_crs(bbox, mask.crs)
+            mask = gpd.GeoSeries([shapely.intersection(
+                shapely.box(*bounds.total_bounds),
+                shapely.union_all(np.asarray(mask.values)))], crs=mask.crs)
+            bbox = None
+
         print('Loading data...')
 
-        df = gpd.read_file(filename)
+        filename = Path(filename)
+        if filename.suffix.lower() in ('.parquet', '.geoparquet'):
+            df = read_parquet()
+        elif pyogrio is not None:
+            df = read_pyogrio()
+        else:
+            df = read_fiona()
 
         print(filename.name + ' loaded!')
 
         # Make all column names lowercase
         df.columns = map(str.lower, df.columns)
 
-        # Make fid into the GeoDataFrame index.
+        # Make fid into the GeoDataFrame index. GeoParquet files written
+        # from a GeoDataFrame may already have it as index.
         # df[fid] = df[fid].astype(int)
-        df.set_index(fid, inplace=True)
+        if str(df.index.name).lower() == fid:
+            df.index.name = fid
+        else:
+            df.set_index(fid, inplace=True)
 
         return df
 
-    def load_source_files(self, configdict):
-        """ Loads the source population and parcel datasets. Calls
-            load_geodataframe using parameters in the configuration dict.
+    def iter_geodataframe(self, filename, fid='bbl', columns=None,
+                          chunk_size=200000):
+        """ Loads a shapefile, GeoPackage or GeoParquet file chunk_size
+            features at a time, in file order, with the same cleaning as
+            load_geodataframe. This way only one chunk of geometries is in
+            memory at once.
 
             Input:
             ------
-            configdict: configuration dictionary from load_namelist
+            filename, fid, columns: see load_geodataframe
+            chunk_size (int): number of features per chunk
 
             Output:
             -------
-            Creates a GeoDataFrame object for each input file as a class
-            attribute.
+            Generator of GeoDataFrames.
+        """
+
+        def select(names):
+            if columns is None:
+                return None
+            wanted = set(columns) | {fid}
+            return [name for name in names if name.lower() in wanted]
+
+        def clean(df):
+            df.columns = map(str.lower, df.columns)
+            if str(df.index.name).lower() == fid:
+                df.index.name = fid
+            else:
+                df.set_index(fid, inplace=True)
+            return df
+
+        def read_parquet():
+            parquet = pq.ParquetFile(filename)
+            geo = json.loads(parquet.schema_arrow.metadata[b'geo'])
+            geometry = geo['primary_column']
+            crs = geo['columns'][geometry].get('crs', 'OGC:CRS84')
+            crs = None if crs is None else pyproj.CRS.from_user_input(crs)
+
+            names = select([n for n in parquet.schema_arrow.names
+                            if n != geometry])
+            batches = parquet.iter_batches(
+                batch_size=chunk_size,
+                columns=None if names is None else names + [geometry])
+            for batch in batches:
+                table = pa.Table.from_batches([batch])
+                df = table.drop_columns([geometry]).to_pandas()
+                geoms = shapely.from_wkb(
+                    table[geometry].to_numpy(zero_copy_only=False))
+                yield gpd.GeoDataFrame(df, geometry=geoms, crs=crs)
+
+        def read_pyogrio():
+            names = select(list(pyogrio.read_info(filename)['fields']))
+            start = 0
+            while True:
+                df = pyogrio.read_dataframe(filename, columns=names,
+                                            skip_features=start,
+                                            max_features=chunk_size,
+                                            use_arrow=pq is not None)
+                if len(df) == 0:
+                    return
+                yield df
+                start += chunk_size
+
+        def read_fiona():
+            start = 0
+            while True:
+                df = gpd.read_file(filename,
+                                   rows=slice(start, start + chunk_size))
+                if len(df) == 0:
+                    return
+                names = select([n for n in df.columns if n != 'geometry'])
+                if names is not None:
+                    df = df.loc[:, names + ['geometry']]
+                yield df
+                start += chunk_size
+
+        filename = Path(filename)
+        if filename.suffix.lower() in ('.parquet', '.geoparquet'):
+            chunks = read_parquet()
+        elif pyogrio is not None:
+            chunks = read_pyogrio()
+        else:
+            chunks = read_fiona()
+
+        for df in chunks:
+            yield clean(df)
+
+        print(filename.name + ' loaded!')
+
+    def load_blocks(self, configdict, bbox=None, mask=None):
+        """ Loads the configured fields of the source population dataset.
+            See load_geodataframe for bbox and mask.
         """
 
         population = (configdict['run_dir']
@@ -164,21 +1235,231 @@ class Dasymetry:
                       / configdict['population_file'])
 
         block_df = self.load_geodataframe(population,
-                                          configdict['population_fid'])
-        block_df = block_df.loc[:, self.configdict['block_fields']]
+                                          configdict['population_fid'],
+                                          columns=configdict['block_fields'],
+                                          bbox=bbox, mask=mask)
+        block_df = block_df.loc[:, configdict['block_fields']]
+
+        return block_df
+
+    def load_parcels(self, configdict, bbox=None, mask=None):
+        """ Loads the configured fields of the parcel dataset, and adds the
+            population column. See load_geodataframe for bbox and mask.
+        """
 
         parcels = (configdict['run_dir']
                    / configdict['input_dir']
                    / configdict['parcels_file'])
 
         parcel_df = self.load_geodataframe(parcels,
-                                           configdict['parcels_fid'])
+                                           configdict['parcels_fid'],
+                                           columns=configdict['parcel_fields'],
+                                           bbox=bbox, mask=mask)
+
+        parcel_df = parcel_df.loc[:, configdict['parcel_fields']]
+        # Create a new column in parcel_df for pop_name and each other count
+        # variable, to hold populations. Initialize with zero.
+        for name in count_fields(configdict):
+            parcel_df[name] = 0
+        parcel_df.loc[parcel_df['numfloors'] < 1, 'numfloors'] = 1
+
+        return parcel_df
+
+    def load_parcels_lean(self, configdict, block_df, bbox=None, mask=None,
+                          chunk_size=200000):
+        """ Memory-lean load_parcels followed by buildSpatialRelation. The
+            parcels are loaded chunk_size at a time (see iter_geodataframe),
+            each chunk is related to the blocks, and then only its centroids
+            are kept as geometry. The parcel polygons of just one chunk are
+            ever in memory.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            block_df: block GeoDataFrame, from load_blocks, or a Future of
+            one. The first chunk of parcels is read while it loads.
+            bbox, mask: study area, see load_geodataframe
+            chunk_size (int): number of parcels per chunk
+
+            Output:
+            -------
+            parcel_df (with centroid points as geometry), and block_df in the
+            CRS of the parcels. The relation is stored as self.relation.
+        """
+
+        parcels = (configdict['run_dir']
+                   / configdict['input_dir']
+                   / configdict['parcels_file'])
+
+        chunks, bip, pib, parcel_xy = [], [], [], []
+        block_tree = None
+        offset = 0
+        chunks_of = self.iter_geodataframe(parcels,
+                                           configdict['parcels_fid'],
+                                           columns=configdict['parcel_fields'],
+                                           chunk_size=chunk_size)
+        for chunk in chunks_of:
+            if block_tree is None:
+                if isinstance(block_df, Future):
+                    block_df = block_df.result()
+                # Blocks go to the parcels' map projection, once
+                if block_df.crs != chunk.crs:
+                    block_df = block_df.to_crs(chunk.crs)
+                blocks = np.asarray(block_df.geometry.values)
+                block_tree = shapely.STRtree(blocks)
+                block_xy = centroid_xy(blocks)
+                block_points = shapely.points(block_xy)
+
+                area = None
+                if bbox is not None:
+                    bounds = (bbox if bbox.crs is None
+                              else bbox.to_crs(chunk.crs))
+                    area = shapely.box(*bounds.total_bounds)
+                if mask is not None:
+                    shape = (mask if mask.crs is None
+                             else mask.to_crs(chunk.crs))
+                    shape = shapely.union_all(np.asarray(shape.values))
+                    area = (shape if area is None
+                            else shapely.intersection(area, shape))
+
+            geoms = np.asarray(chunk.geometry.values)
+            if area is not None:
+                inside = shapely.intersects(geoms, area)
+                chunk = chunk[inside]
+                geoms = geoms[inside]
+
+            xy = centroid_xy(geoms)
+            block_pos, parcel_pos = shapely.STRtree(geoms).query(
+                block_points, predicate='intersects')
+            bip.append((parcel_pos + offset, block_pos))
+            parcel_pos, block_pos = block_tree.query(shapely.points(xy),
+                                                     predicate='intersects')
+            pib.append((block_pos, parcel_pos + offset))
+            del geoms
+
+            chunk = chunk.loc[:, configdict['parcel_fields']]
+            chunk[chunk.geometry.name] = gpd.points_from_xy(
+                xy[:, 0], xy[:, 1], crs=chunk.crs)
+            downcast(chunk, skip=count_fields(configdict))
+
+            chunks.append(chunk)
+            parcel_xy.append(xy)
+            offset += len(chunk)
+
+        parcel_df = concat_downcast(chunks)
+        del chunks
+        for name in count_fields(configdict):
+            parcel_df[name] = 0
+        parcel_df.loc[parcel_df['numfloors'] < 1, 'numfloors'] = 1
+
+        parcel_pos, block_pos = map(np.concatenate, zip(*bip))
+        order = np.lexsort((block_pos, parcel_pos))
+        blocks_in_parcels = (parcel_pos[order], block_pos[order])
+        block_pos, parcel_pos = map(np.concatenate, zip(*pib))
+        order = np.lexsort((parcel_pos, block_pos))
+        parcels_in_blocks = (block_pos[order], parcel_pos[order])
+
+        self.relation = SpatialRelation(parcel_df.index, block_df.index,
+                                        blocks_in_parcels, parcels_in_blocks,
+                                        np.concatenate(parcel_xy), block_xy)
+
+        return parcel_df, block_df
+
+    def study_area(self, configdict):
+        """ The optional study area of the namelist, as the bbox and mask
+            GeoSeries taken by load_geodataframe. None when not given.
+        """
+
+        inputs = configdict['run_dir'] / configdict['input_dir']
+
+        bbox = None
+        mask = None
+        if 'study_area_bbox' in configdict:
+            bbox = gpd.GeoSeries([shapely.box(*configdict['study_area_bbox'])],
+                                 crs=configdict.get('study_area_crs'))
+        if 'study_area_mask' in configdict:
+            mask = gpd.read_file(inputs
+                                 / configdict['study_area_mask']).geometry
+
+        return bbox, mask
+
+    def load_source_blocks(self, configdict, area=None):
+        """ Loads the blocks as load_source_files does: within the study
+            area, in the CRS of the parcel file. It only reads files, so it
+            can run in a background thread, e.g. to load the blocks of the
+            next job of a batch (see batch.py) while this one runs.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            area: (bbox, mask) from study_area. Default None reads them.
+        """
 
-        parcel_df = parcel_df.loc[:, self.configdict['parcel_fields']]
-        # Create a new column in parcel_df, pop_name, to hold populations.
-        # Initialize with zero.
-        parcel_df[configdict['pop_name']] = 0
-        parcel_df.loc[:, 'numfloors'][parcel_df.loc[:, 'numfloors'] < 1] = 1
+        inputs = configdict['run_dir'] / configdict['input_dir']
+        bbox, mask = self.study_area(configdict) if area is None else area
+        crs = layer_crs(inputs / configdict['parcels_file'])
+
+        block_df = self.load_blocks(configdict, bbox=bbox, mask=mask)
+        if crs is not None and block_df.crs != crs:
+            block_df = block_df.to_crs(crs)
+
+        return block_df
+
+    @instrumented
+    def load_source_files(self, configdict, lean=False, chunk_size=200000,
+                          parcel_df=None, block_df=None):
+        """ Loads the source population and parcel datasets. Calls
+            load_geodataframe using parameters in the configuration dict.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            lean (bool): load the parcels with load_parcels_lean, keeping
+            only their centroids
+            chunk_size (int): number of parcels per chunk when lean
+            parcel_df: parcels loaded before with the same parcel namelist
+            parameters (e.g. self.parcel_df of a run on another population
+            file), to reuse instead of loading them again. Only the blocks
+            are loaded then. Not with lean.
+            block_df: blocks loaded ahead by load_source_blocks, or a Future
+            of them, to use instead of loading them
+
+            Output:
+            -------
+            Creates a GeoDataFrame object for each input file as a class
+            attribute.
+        """
+
+        # Optional study area, used to only load the features within it
+        bbox, mask = self.study_area(configdict)
+
+        # The two layers don't depend on each other, so the blocks are read
+        # in a second thread. Most of the reading, decoding and reprojecting
+        # happens outside the GIL.
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            if block_df is None:
+                blocks = pool.submit(self.load_source_blocks, configdict,
+                                     area=(bbox, mask))
+            elif isinstance(block_df, Future):
+                blocks = block_df
+            else:
+                blocks = Future()
+                blocks.set_result(block_df)
+
+            if parcel_df is not None:
+                assert not lean, 'parcel_df cannot be reused with lean=True'
+                parcel_df = parcel_df.loc[:, configdict['parcel_fields']]
+                for name in count_fields(configdict):
+                    parcel_df[name] = 0
+                block_df = blocks.result()
+            elif lean:
+                parcel_df, block_df = self.load_parcels_lean(
+                    configdict, blocks, bbox=bbox, mask=mask,
+                    chunk_size=chunk_size)
+            else:
+                parcel_df = self.load_parcels(configdict, bbox=bbox,
+                                              mask=mask)
+                block_df = blocks.result()
 
         # Make sure the blocks and parcels are in the same map projection
         if block_df.crs != parcel_df.crs:
@@ -191,101 +1472,398 @@ class Dasymetry:
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
 
-    def writeOutput(self, filename, parcels, subset=None):
-        pop_name = self.configdict['pop_name']
-        print('Writing output to CSV...')
-        outfile = self.configdict['output_dir'] / filename
-        parcels[pop_name].to_csv(outfile, header=True)
-        print('Done!')
+    @instrumented
+    def preprocess(self, configdict, cache=True, max_cache_entries=3,
+                   lean=False, chunk_size=200000, parcel_df=None,
+                   block_df=None):
+        """ Loads the source files and prepares them for disaggregation, i.e.
+            runs load_source_files, buildSpatialRelation, getOverpopParcels
+            and assignParcels. With cache=True the result is stored in
+            output_dir/cache (see PreprocessCache), and later runs on the
+            same inputs load it from there instead.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            cache (bool): use the on-disk cache. Needs pyarrow.
+            max_cache_entries (int): number of cache entries to keep
+            lean (bool): load the parcels in chunks and keep only their
+            centroids as geometry (see load_parcels_lean), and store the
+            parcel and block fields in the smallest dtypes that hold them
+            exactly, with landuse as a categorical (see downcast). The
+            disaggregation then drops its scratch block columns (see
+            drop_scratch). Results are unchanged, but
+            writeOutput(geometry=True) writes centroids.
+            chunk_size (int): number of parcels per chunk when lean
+            parcel_df: parcels to reuse, see load_source_files
+            block_df: blocks loaded ahead, see load_source_files
+
+            Output:
+            -------
+            Creates self.parcel_df, self.block_df, self.relation and
+            self.membership.
+        """
+
+        self.lean = lean
+
+        if cache and not PreprocessCache.available():
+            print('pyarrow not found, not caching pre-processed inputs')
+            cache = False
+
+        if cache:
+            store = PreprocessCache(configdict['output_dir'] / 'cache',
+                                    max_entries=max_cache_entries)
+            key = store.key(configdict, lean=lean)
+            cached = store.load(key)
+
+            if cached is not None:
+                print('Loaded pre-processed inputs from cache ' + key)
+                self.parcel_df = cached['parcel_df']
+                self.block_df = cached['block_df']
+                self.relation = cached['relation']
+                self.membership = cached['membership']
+                if lean:
+                    self.shrink(configdict)
+                return None
+
+        self.load_source_files(configdict, lean=lean, chunk_size=chunk_size,
+                               parcel_df=parcel_df, block_df=block_df)
+        self.buildSpatialRelation(self.parcel_df, self.block_df)
+        self.getOverpopParcels(self.parcel_df, self.block_df)
+        self.assignParcels(self.parcel_df, self.block_df)
+
+        if cache:
+            store.save(key, self.parcel_df, self.block_df, self.relation,
+                       self.membership)
+            print('Pre-processed inputs cached as ' + key)
+
+        if lean:
+            self.shrink(configdict)
+
+        return None
+
+    def shrink(self, configdict):
+        """ Downcasts the fields of self.parcel_df and self.block_df, except
+            for the count variables, see downcast.
+        """
+
+        skip = count_fields(configdict)
+        downcast(self.parcel_df, skip=skip)
+        downcast(self.block_df, skip=skip)
+
+        return None
+
+    def drop_scratch(self, blocks):
+        """ With lean=True (see preprocess), drops the scratch columns of
+            blocks (contained_resunits and pop_resunits_ratio) once the
+            shares are computed.
+        """
+
+        if self.lean:
+            blocks.drop(columns=[column for column in self.scratch_columns
+                                 if column in blocks], inplace=True)
+
+        return None
+
+    @instrumented
+    def writeOutput(self, filename, parcels, subset=None, rows=None,
+                    geometry=False, compression=None, partition_by=None,
+                    background=False):
+        """ Writes the disaggregated counts to output_dir, as CSV or
+            (Geo)Parquet depending on the file name (see ParcelWriter).
+
+            Input:
+            ------
+            filename (str): name of the output file, e.g. test.csv,
+            test.csv.gz or test.parquet
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            subset: columns to write. Default None writes the count
+            variables (see count_fields), 'all' every column.
+            rows: boolean mask or index labels of the parcels to write.
+            Default None writes all parcels.
+            geometry (bool): also write the parcel geometries
+            compression (str): compression codec, see ParcelWriter
+            partition_by: column, or number of leading parcel id
+            characters, to partition the output by. See ParcelWriter.
+            background (bool): write the file in a background thread, and
+            return at once. parcels must not be modified until it is done.
+
+            Output:
+            -------
+            With background=True, the ParcelWriter; its close method waits
+            for the file to be written (and raises if writing failed).
+        """
+
+        outfile = self.configdict['output_dir'] / filename
+        writer = ParcelWriter(outfile, geometry=geometry,
+                              compression=compression,
+                              partition_by=partition_by,
+                              background=background)
+
+        print('Writing output to ' + writer.format.upper() + '...')
+        writer.write(output_frame(parcels, self.configdict, subset=subset,
+                                  rows=rows, geometry=geometry,
+                                  partition_by=partition_by))
+        if background:
+            return writer
+
+        writer.close()
+        print('Done!')
+
+    def buildSpatialRelation(self, parcel_df, block_df):
+        """ Computes parcel and block centroids and the parcel <-> block
+            containment relation (see SpatialRelation) once, so that
+            getOverpopParcels, assignParcels and blocksToOverpop don't each
+            redo the geometry work. Those methods call this one themselves
+            if needed. Only the call that builds the relation is recorded
+            as a stage by the profiler.
+
+            Output:
+            -------
+            relation: SpatialRelation, also stored as self.relation
+        """
+
+        if self.relation is None or not self.relation.matches(parcel_df,
+                                                               block_df):
+            stage = (contextlib.nullcontext() if self.profiler is None
+                     else self.profiler.measure('buildSpatialRelation',
+                                                self))
+            with stage:
+                self.relation = SpatialRelation.from_frames(parcel_df,
+                                                            block_df)
+
+        return self.relation
+
+    @instrumented
+    def getOverpopParcels(self, parcel_df, block_df):
+        """ Uses the parcel <-> block relation to find the parcels that
+            contain > 1 population blocks.
+        """
+        relation = self.buildSpatialRelation(parcel_df, block_df)
+
+        # Parcels that contain more than one block centroid are considered
+        # overpopulated.
+        parcel_pos, block_pos = relation.blocks_in_parcels
+        nblocks = np.bincount(parcel_pos, minlength=len(parcel_df))
+        parcel_df['overpopulated'] = nblocks > 1
+
+        print('Blocks assigned to overpopulated parcels')
+
+        return None
+
+    @instrumented
+    def assignParcels(self, parcel_df, block_df):
+        """ Assigns parcels to the block that contains them, excluding where
+            parcel_df['overpolated'] is True. The result is stored as a
+            BlockMembership in self.membership.
+        """
+
+        relation = self.buildSpatialRelation(parcel_df, block_df)
+
+        # Keep the (block, parcel) pairs of non-overpopulated parcels
+        block_pos, parcel_pos = relation.parcels_in_blocks
+        keep = ~parcel_df['overpopulated'].values[parcel_pos]
+        block_pos = block_pos[keep]
+        parcel_pos = parcel_pos[keep]
+
+        self.membership = BlockMembership.from_pairs(relation.block_index,
+                                                     relation.parcel_index,
+                                                     block_pos, parcel_pos)
+
+        return None
+
+    def blockToParcel(self, block, parcel, numpeople):
+        """ Method to transfer a number of people from a census block
+            to a parcel contained within it. The block's population value
+            is decreased by numpeople, while the parcel's population value
+            is increased by numpeople.
+
+            Input:
+            ------
+            block: index of source census block (np.int64)
+            parcel: index of source parcel (np.int64)
+            numpeople: Number of people to be transfered (np.int64)
+
+            Output:
+            -------
+            None
+        """
+
+        # First, check that the parcel is actually contained in the block
+        # missingmsg = 'Selected parcel not found in this block'
+        # assert parcel in self.membership.parcels_in(block), missingmsg
+
+        parcels = self.parcel_df
+        blocks = self.block_df
+
+        pop_name = self.configdict['pop_name']
+
+        parcels.loc[parcel, pop_name] = (parcels.loc[parcel, pop_name]
+                                         + numpeople)
+        blocks.loc[block, pop_name] = blocks.loc[block, pop_name] - numpeople
+
+        if self.ledger is not None:
+            self.ledger.log(block, parcel, numpeople)
+
+        return None
+
+    def openLedger(self, stage):
+        """ Start a pipeline stage that records its transfers in the
+            TransferLedger (self.ledger) instead of writing to the
+            GeoDataFrames one transfer at a time. The ledger is created on
+            first use and keeps the transfers of all stages, so it can be
+            exported with writeLedger.
+
+            Input:
+            ------
+            stage (str): name of the stage, stored with each transfer
+
+            Output:
+            -------
+            ledger: the TransferLedger, loaded with current populations
+        """
+
+        if self.ledger is None:
+            fields = count_fields(self.configdict)
+            self.ledger = TransferLedger(fields[0], fields[1:])
+
+        self.ledger.load(self.parcel_df, self.block_df)
+        self.ledger.stage = stage
+
+        return self.ledger
+
+    def closeLedger(self):
+        """ End the current ledger stage, writing the ledger populations
+            back to self.parcel_df and self.block_df.
+        """
+
+        self.ledger.flush(self.parcel_df, self.block_df)
+        self.ledger.stage = None
+
+        return None
+
+    def writeLedger(self, filename, aggregate=True):
+        """ Writes every recorded block to parcel transfer to a CSV file in
+            output_dir, so it can be checked where each parcel's population
+            came from.
+
+            Input:
+            ------
+            filename (str): name of the output file
+            aggregate (bool): add up transfers between the same block and
+            parcel within a stage
+        """
+
+        print('Writing transfer ledger to CSV...')
+        outfile = self.configdict['output_dir'] / filename
+        self.ledger.to_frame(aggregate=aggregate).to_csv(outfile, index=False)
+        print('Done!')
+
+        return None
+
+    def startProfiling(self, profile=False):
+        """ Attaches a StageProfiler, which records every pipeline stage run
+            from now on (load_source_files, getOverpopParcels,
+            assignParcels, blocksToOverpop, disaggregate,
+            disaggregate_leftover, writeOutput, ...) until writeProfile.
+
+            Input:
+            ------
+            profile (bool): also run the stages under cProfile
+
+            Output:
+            -------
+            profiler: the StageProfiler, also stored as self.profiler
+        """
 
-    def getOverpopParcels(self, parcel_df, block_df):
-        """ Performs a spatial left join between parcels and blocks dataset.
-            Then keep only the parcels that contain > 1 population blocks.
-        """
-        # Create a copy of block_df with block centroids as geometry
-        parcel_df['overpopulated'] = False
-        block_centroid = block_df.copy()
-        block_centroid['geometry'] = block_centroid.centroid
-
-        # Find the lots that have > 1 census block within
-        overpop_parcels = gpd.sjoin(parcel_df, block_centroid)
-        # Parcels that have more than one entry are considered overpopulated,
-        # since they have > 1 census block within them.
-        overpop_bool = overpop_parcels.index.duplicated(keep=False)
-        overpop_index = overpop_parcels.loc[overpop_bool].index
-        overpop_index = list(set(overpop_index))
-        parcel_df['overpopulated'].loc[overpop_index] = True
+        self.profiler = StageProfiler(profile=profile)
 
-        print('Blocks assigned to overpopulated parcels')
+        return self.profiler
 
-        return None
+    def writeProfile(self, filename):
+        """ Writes the stages recorded since startProfiling as JSON to
+            output_dir, and detaches the profiler. With profile=True, the
+            cProfile statistics are written next to it with a .prof suffix,
+            which can be read with pstats or turned into a flame graph
+            (e.g. with snakeviz or flameprof).
 
-    def assignParcels(self, parcel_df, block_df):
-        """ Assigns parcels to the block that contains them, excluding where
-            parcel_df['overpolated'] is True.
+            Input:
+            ------
+            filename (str): name of the JSON file
         """
 
-        # Create a new column in block_df to store contained parcels
-        block_df['parcels'] = [[]] * len(block_df)
-        block_df['parcels'] = block_df['parcels'].astype(object)
+        profiler = self.profiler
+        self.profiler = None
 
-        # Get subset of non-overpopulated parcels, then sjoin to block_df
-        parcels_no_overpop = parcel_df[parcel_df['overpopulated'] == False]
-        parcels_centroid = parcels_no_overpop.copy()
+        print('Writing stage profile...')
+        outfile = self.configdict['output_dir'] / filename
+        with open(outfile, 'w') as f:
+            json.dump(profiler.report(), f, indent=2)
 
-        # To perform the sjoin we need a column named 'geometry'
-        parcels_centroid['geometry'] = parcels_centroid.centroid
-        blocks_joined = gpd.sjoin(block_df, parcels_centroid)
+        if profiler.profile is not None:
+            profiler.profile.dump_stats(outfile.with_suffix('.prof'))
+        print('Done!')
 
-        blocks_unique_index = list(set(blocks_joined.index))
+        return None
 
-        # For each block, list all parcels. Then convert to a GeoSeries to
-        # append to block_df
-        parcel_dict = {key: [blocks_joined.loc[key, 'index_right']] if
-                       not hasattr(blocks_joined.loc[key, 'index_right'],
-                                   '__iter__') else
-                       list(blocks_joined.loc[key, 'index_right'].values)
-                       for key in blocks_unique_index}
+    def writeState(self, filename):
+        """ Saves what disaggregate_incremental needs from this run: the
+            per-parcel and per-block results and the parcel-block pairs the
+            allocation went through. Call it after disaggregate_leftover
+            (or disaggregate_partitioned).
 
-        block_df['parcels'] = gpd.GeoSeries(parcel_dict)
+            Input:
+            ------
+            filename (str): name of the pickle file written to output_dir
+        """
 
-        # Remove census blocks that intersect no parcels
-        # block_df.dropna(subset=['parcels'], inplace=True)
+        print('Writing run state...')
+        fields = count_fields(self.configdict)
+        block_columns = [column for column in
+                         fields + list(self.scratch_columns)
+                         if column in self.block_df]
+
+        state = {'parcels': pd.DataFrame(self.parcel_df[fields]),
+                 'blocks': pd.DataFrame(self.block_df[block_columns]),
+                 'pairs': component_pairs(self.relation, self.membership,
+                                          self.parcel_df['overpopulated'])}
+        pd.to_pickle(state, self.configdict['output_dir'] / filename)
+        print('Done!')
 
         return None
 
-    def blockToParcel(self, block, parcel, numpeople):
-        """ Method to transfer a number of people from a census block
-            to a parcel contained within it. The block's population value
-            is decreased by numpeople, while the parcel's population value
-            is increased by numpeople.
+    def blocksToParcels(self, blocks, parcels, numpeople):
+        """ Bulk version of blockToParcel. Transfers numpeople[i] from
+            census block blocks[i] to parcel parcels[i] for every i. The
+            transfers are recorded in the ledger of the running stage, or
+            written to the GeoDataFrames right away when no stage is open.
 
             Input:
             ------
-            block: index of source census block (np.int64)
-            parcel: index of source parcel (np.int64)
-            numpeople: Number of people to be transfered (np.int64)
+            blocks: Array-like of source census block indices
+            parcels: Array-like of destination parcel indices
+            numpeople: Array-like of number of people to be transfered
 
             Output:
             -------
             None
         """
 
-        # First, check that the parcel is actually contained in the block
-        # missingmsg = 'Selected parcel not found in this block'
-        # assert parcel in self.block_df.loc[block, 'parcels'], missingmsg
-
-        parcels = self.parcel_df
-        blocks = self.block_df
+        standalone = self.ledger is None or self.ledger.stage is None
+        if standalone:
+            self.openLedger('blocksToParcels')
 
-        pop_name = self.configdict['pop_name']
+        ledger = self.ledger
+        ledger.record(ledger.block_positions(blocks),
+                      ledger.parcel_positions(parcels),
+                      numpeople)
 
-        parcels.loc[parcel, pop_name] = (parcels.loc[parcel, pop_name]
-                                         + numpeople)
-        blocks.loc[block, pop_name] = blocks.loc[block, pop_name] - numpeople
+        if standalone:
+            self.closeLedger()
 
         return None
 
+    @instrumented
     def blocksToOverpop(self, parcels, blocks):
         """ Add the population of blocks within overpopulated parcels (ie,
             parcels that contain > 1 census block) and add to parcel.
@@ -294,52 +1872,54 @@ class Dasymetry:
         msg = 'Run getOverpopParcels method!'
         assert check, msg
 
-        pop_name = self.configdict['pop_name']
-        # Get a copy withof blocks with centroids as geometry
-        block_centroid = blocks.copy()
-        block_centroid['geometry'] = block_centroid.centroid
-
-        # We only want to operate on overpopulated parcels.
-        overpop_parcels = parcels[parcels['overpopulated'].__eq__(True)]
-
-        # Spatial join of the overpopulated parcels with the source blocks.
-        overpop_join = gpd.sjoin(overpop_parcels, block_centroid)
+        relation = self.buildSpatialRelation(parcels, blocks)
 
-        # Add the populations of all blocks, by containing parcel, then
-        # assign added value to parcels_df.
-        popname_right = pop_name + '_right'
-        pop = overpop_join.groupby(by=overpop_join.index).sum()[popname_right]
+        # We only want to operate on the blocks within overpopulated parcels.
+        parcel_pos, block_pos = relation.blocks_in_parcels
+        keep = parcels['overpopulated'].values[parcel_pos]
+        overpop_parcels = relation.parcel_index[parcel_pos[keep]]
+        overpop_blocks = relation.block_index[block_pos[keep]]
 
-        parcels.loc[pop.index, pop_name] = pop
+        # Move the populations of all blocks to their containing parcel.
+        ledger = self.openLedger('blocksToOverpop')
+        block_pos = ledger.block_positions(overpop_blocks)
+        ledger.record(block_pos,
+                      ledger.parcel_positions(overpop_parcels),
+                      ledger.block_pop[block_pos])
 
-        # Now we "empty" out the census blocks in the overpop parcels
-        blocks.loc[overpop_join['index_right'], pop_name] = 0
+        # Now we "empty" out the census blocks in the overpop parcels. A
+        # block whose centroid falls in more than one parcel was handed out
+        # more than once, so set it to zero rather than leave it negative.
+        ledger.clear_blocks(block_pos)
+        self.closeLedger()
 
+        pop_name = self.configdict['pop_name']
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
 
         return None
 
-    def disaggregate(self, parcels, blocks):
+    @instrumented
+    def disaggregate(self, parcels, blocks, engine='vectorized'):
         """ Method containing main disaggregation logic. Based on Khila et al
             (2019).
 
+            Input:
+            ------
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            blocks: census block GeoDataFrame (self.block_df)
+            engine (str): 'vectorized' computes every parcel's share at once
+            and applies all transfers in one bulk update. 'legacy' loops
+            through every block and parcel calling blockToParcel. Both give
+            the same per-parcel totals.
         """
 
-        # Define functions used in the disaggregation logic
-        def sum_units(parcel_list):
-            """ Function to sum the number of residential units of all parcels
-                contained in a single census block.
-
-                Input:
-                ------
-                blockid: Census block ID, used as index in self.blocks_df
-            """
-            contained = parcels.loc[parcel_list,
-                                    self.configdict['res_units']]
-            contained_sum = contained.sum()
-            return contained_sum
+        membership = self.membership
+        check = membership is not None and membership.matches(blocks)
+        msg = 'Run assignParcels method!'
+        assert check, msg
 
+        # Define functions used in the disaggregation logic
         def compute_pop_resunit(blocks):
             """ Compute the number of people per contained residential units
             """
@@ -358,10 +1938,10 @@ class Dasymetry:
 
             # Looping through all blocks for now. We can think of other ways
             # to do this (maybe an "apply"?) to speed it up.
-            for blockid, row in tqdm(blocks.iterrows()):
+            for blockid, row in tqdm.tqdm(blocks.iterrows()):
                 total_resunits = blocks.loc[blockid, 'contained_resunits']
                 # Call blockToParcel
-                for parcel in blocks.loc[blockid, 'parcels']:
+                for parcel in membership.parcels_in(blockid):
                     # Compute proportion of res units per parcel
                     if how == 'compute':
                         proportion = parcels.loc[parcel,
@@ -375,17 +1955,48 @@ class Dasymetry:
                     # Call blockToParcel to assign numpeople to parcel
                     self.blockToParcel(blockid, parcel, numpeople)
 
-        top_hh_size = self.configdict['top_hh_size']
-        pop_name = self.configdict['pop_name']
-        # Subset blocks to only those that contain parcels. We do this in Case
-        # our census block data does not perfectly align with parcels data.
-        blocks_withparcels = blocks.dropna(subset=['parcels'])
+        def distribute_by_resunits_vectorized(blocks, how='compute'):
+            """ Same as distribute_by_resunits, but builds one parcel->block
+                mapping for all blocks and computes every parcel's share
+                with array operations instead of looping.
+            """
+            unitresname = self.configdict['res_units']
+            pop_name = self.configdict['pop_name']
+            top_hhsize = self.configdict['top_hh_size']
 
-        # create a new column to hold the total residential units in a block
-        # blocks_withparcels.loc[:, 'contained_resunits'] = 0
+            # One row per (block, parcel) pair, grouped by block. The
+            # ledger and membership share the block_df and parcel_df
+            # positions.
+            block_ids = membership.block_index.get_indexer(blocks.index)
+            block_pos, parcel_pos = membership.pairs(block_ids)
+            offsets = np.zeros(len(block_ids) + 1, dtype=np.int64)
+            np.cumsum(membership.counts[block_ids], out=offsets[1:])
+
+            total_resunits = self.block_df['contained_resunits'].values
+            numpeople = resunit_shares(
+                offsets, parcels[unitresname].values[parcel_pos],
+                self.ledger.block_pop[block_ids], total_resunits[block_ids],
+                how=how, top_hh_size=top_hhsize)
+
+            self.ledger.record(block_pos, parcel_pos, numpeople)
+
+        if engine == 'vectorized':
+            distribute = distribute_by_resunits_vectorized
+        elif engine == 'legacy':
+            distribute = distribute_by_resunits
+            if len(count_fields(self.configdict)) > 1:
+                raise Exception('engine legacy only disaggregates pop_name')
+        else:
+            raise Exception('kwarg engine ' + engine + ' is invalid')
 
-        block_res = blocks_withparcels.loc[:, 'parcels'].apply(sum_units)
-        blocks.loc[block_res.index, 'contained_resunits'] = block_res.values
+        top_hh_size = self.configdict['top_hh_size']
+        pop_name = self.configdict['pop_name']
+        # Only blocks that contain parcels get a residential unit count. We
+        # do this in case our census block data does not perfectly align
+        # with parcels data.
+        block_res = membership.sum(parcels[self.configdict['res_units']])
+        blocks['contained_resunits'] = np.where(membership.has_parcels,
+                                                block_res, np.nan)
 
         # Compute the block population per residential units ratio
         compute_pop_resunit(blocks)
@@ -395,30 +2006,55 @@ class Dasymetry:
         below_tophh = blocks[blocks['pop_resunits_ratio'] <= top_hh_size]
         above_tophh = blocks[blocks['pop_resunits_ratio'] > top_hh_size]
 
+        if engine == 'vectorized':
+            self.openLedger('disaggregate')
+
         # Distribute population based on proportion of residential units.
-        distribute_by_resunits(below_tophh, how='compute')
+        distribute(below_tophh, how='compute')
 
         # For lots where hh_size is above allowed value
-        distribute_by_resunits(above_tophh, how='max')
+        distribute(above_tophh, how='max')
+
+        if engine == 'vectorized':
+            self.closeLedger()
 
-        blocks.loc[:, pop_name][blocks[pop_name] < 0.25] = 0
-        blocks.dropna(subset=['parcels'], inplace=True)
+        blocks.loc[blocks[pop_name] < 0.25, count_fields(self.configdict)] = 0
+
+        # Remove census blocks that contain no parcels
+        withparcels = membership.has_parcels
+        blocks.drop(blocks.index[~withparcels], inplace=True)
+        self.membership = membership.take(np.flatnonzero(withparcels))
+        self.drop_scratch(blocks)
 
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
 
         return None
 
-    def disaggregate_leftover(self, parcels, blocks):
+    @instrumented
+    def disaggregate_leftover(self, parcels, blocks, engine='vectorized'):
         """ This method collects all populations in blocks that was not
             assigned to parcels with residential units, and assigns them
             to parcels of various lot types, in the order found in the
             namelist variable called lot_types. Population is assigned, by
             area proportion, up to a density of top_den_allowed.
+
+            Input:
+            ------
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            blocks: census block GeoDataFrame (self.block_df)
+            engine (str): 'vectorized' handles each lot type pass for all
+            leftover blocks at once. 'legacy' loops through every leftover
+            block calling blockToParcel. Both give the same per-parcel totals.
         """
 
         pop_name = self.configdict['pop_name']
 
+        membership = self.membership
+        check = membership is not None and membership.matches(blocks)
+        msg = 'Run assignParcels method!'
+        assert check, msg
+
         def allowable():
 
             area = parcels.loc[:, 'lotarea']
@@ -431,7 +2067,7 @@ class Dasymetry:
             return allowed
 
         def distribute_by_areaproportion(blockid, remainder=False):
-            subset = parcels.loc[blocks_left.loc[blockid, 'parcels']]
+            subset = parcels.loc[membership.parcels_in(blockid)]
             subset = subset[subset['landuse'].isin(code)]
 
             if remainder is False:
@@ -471,15 +2107,70 @@ class Dasymetry:
 
             return None
 
+        def distribute_by_areaproportion_vectorized(remainder=False):
+            """ Same as distribute_by_areaproportion, but for all leftover
+                blocks at once, see area_shares.
+            """
+            # Populations are read from the ledger, which is only written
+            # back to the GeoDataFrames once the whole method is done.
+            blocks_left = np.flatnonzero(ledger.block_pop > 0)
+
+            # One row per (block, parcel) pair, in the same order the legacy
+            # loop visits them.
+            blockids, parcelids = membership.pairs(blocks_left)
+
+            # isin over the whole column is cheap once landuse is a
+            # categorical (see downcast)
+            keep = parcels['landuse'].isin(code).to_numpy()[parcelids]
+            if remainder is False:
+                area = parcels['lotarea'].values[parcelids]
+                numfloors = parcels['numfloors'].values[parcelids]
+                current_pop = ledger.parcel_pop[parcelids]
+                allowed = np.maximum(max_dens*area*numfloors - current_pop, 0)
+                keep = keep & (allowed > 0)
+                allowed = allowed[keep]
+
+            blockids = blockids[keep]
+            parcelids = parcelids[keep]
+            if len(parcelids) == 0:
+                return None
+
+            # The rows are still grouped by block, so they are in CSR
+            # layout
+            block_pos, block_index = pd.factorize(blockids)
+            offsets = np.zeros(len(block_index) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(block_pos), out=offsets[1:])
+
+            numpeople = area_shares(
+                offsets, parcels['lotarea'].values[parcelids],
+                ledger.block_pop[block_index],
+                allowed=None if remainder else allowed)
+
+            ledger.record(blockids, parcelids, numpeople)
+
+            return None
+
+        if engine == 'vectorized':
+            ledger = self.openLedger('disaggregate_leftover')
+        elif engine != 'legacy':
+            raise Exception('kwarg engine ' + engine + ' is invalid')
+        elif len(count_fields(self.configdict)) > 1:
+            raise Exception('engine legacy only disaggregates pop_name')
+
         for n, lot_type in enumerate(self.configdict['lot_types']):
             max_dens = self.configdict['top_den_allowed'][n]
             codename = '_'.join([lot_type, 'codes'])
             code = self.configdict[codename]
+
+            print('Distributing by area proportion')
+            if engine == 'vectorized':
+                distribute_by_areaproportion_vectorized()
+                continue
+
             parcels['allowed'] = allowable()
 
             blocks_left = blocks[blocks[pop_name] > 0]
-            print('Distributing by area proportion')
-            for blockid, row in tqdm(blocks_left.iterrows()):
+            for blockid, row in tqdm.tqdm(blocks_left.iterrows()):
                 distribute_by_areaproportion(blockid)
 
         # We take whatever folks are left from the previous step, and we
@@ -489,12 +2180,1185 @@ class Dasymetry:
             codename = '_'.join([lot_type, 'codes'])
             code = self.configdict[codename]
 
-            blocks_left = blocks[blocks[pop_name] > 0]
             print('Distributing the leftovers...')
-            for blockid, row in tqdm(blocks_left.iterrows()):
+            if engine == 'vectorized':
+                distribute_by_areaproportion_vectorized(remainder=True)
+                continue
+
+            blocks_left = blocks[blocks[pop_name] > 0]
+            for blockid, row in tqdm.tqdm(blocks_left.iterrows()):
                 distribute_by_areaproportion(blockid, remainder=True)
 
+        if engine == 'vectorized':
+            self.closeLedger()
+        else:
+            parcels.drop(columns='allowed', inplace=True)
+
+        remaining = str(self.parcel_df[pop_name].sum())
+        print('Total population disaggregated: ' + remaining)
+
+        return None
+
+    @instrumented
+    def round_counts(self, parcels, blocks):
+        """ Rounds the disaggregated counts to whole numbers that add up to
+            each block's original count exactly. Run after
+            disaggregate_leftover (or use integer=True with
+            disaggregate_partitioned and disaggregate_streaming). This is a
+            rounding step on top of the float stages, which still compute
+            the shares: it adds to the run time, and it rounds away their
+            float noise rather than avoiding it.
+
+            Each block's count is split between the parcels it sent people
+            to, in proportion to what they got (summed over all stages in
+            the ledger), with the largest remainder method. So the
+            population that the float stages leave in a block, lose to the
+            0.25 cutoff, or hand out twice (blocks within two overpopulated
+            parcels) goes to the same parcels as the rest. Blocks that sent
+            nobody anywhere keep their count. Blocks without parcels were
+            dropped by disaggregate, and their population is not allocated.
+            The ledger keeps the fractional transfers. Not supported after
+            disaggregate_incremental, which doesn't record the transfers of
+            the blocks it keeps.
+
+            Input:
+            ------
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            blocks: census block GeoDataFrame (self.block_df)
+        """
+
+        check = self.ledger is not None and self.ledger.initial is not None
+        msg = ('Run blocksToOverpop, disaggregate and disaggregate_leftover!'
+               ' (not disaggregate_incremental)')
+        assert check, msg
+
+        fields = count_fields(self.configdict)
+        initial = self.ledger.initial
+
+        transfers = self.ledger.to_frame(aggregate=False)
+        transfers = transfers.groupby(['block', 'parcel'], sort=False,
+                                      as_index=False)['numpeople'].sum()
+
+        group = initial.index.get_indexer(transfers['block'])
+        parcel_pos = parcels.index.get_indexer(transfers['parcel'])
+        weights = transfers['numpeople'].to_numpy(dtype=float)
+
+        for name in fields:
+            totals = np.rint(initial[name].to_numpy(dtype=float))
+            parts = largest_remainder(group, weights, totals, parcel_pos)
+
+            parcels[name] = np.bincount(parcel_pos, weights=parts,
+                                        minlength=len(parcels)).astype(
+                                            np.int64)
+            left = totals - np.bincount(group, weights=parts,
+                                        minlength=len(initial))
+            left = pd.Series(left.astype(np.int64), index=initial.index)
+            blocks[name] = left.reindex(blocks.index, fill_value=0).values
+
+            if name == fields[0]:
+                dropped = left[~left.index.isin(blocks.index)].sum()
+                print('Population not allocated (blocks without parcels): '
+                      + str(dropped))
+
+        pop_name = fields[0]
+
+        remaining = str(self.parcel_df[pop_name].sum())
+        print('Total population disaggregated: ' + remaining)
+
+        return None
+
+    @instrumented
+    def disaggregate_partitioned(self, parcels, blocks, by='county',
+                                 prefix=5, tile_size=None, processes=None,
+                                 engine='vectorized', integer=False):
+        """ Runs blocksToOverpop, disaggregate and disaggregate_leftover on
+            partitions of the blocks in a process pool, then merges the
+            results back into parcels and blocks. Gives the same results as
+            running the three methods on the whole dataset.
+
+            Blocks are partitioned by the first prefix characters of their
+            index (e.g. state + county FIPS of geoid), or by square tiles of
+            their centroids. Blocks that share a parcel (e.g. the blocks
+            within an overpopulated parcel) always end up in the same
+            partition, along with all their parcels.
+
+            Input:
+            ------
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            blocks: census block GeoDataFrame (self.block_df)
+            by (str): 'county' to partition by index prefix, 'tile' to
+            partition by tiles of tile_size (in projection units)
+            prefix (int): number of leading index characters used with
+            by='county'
+            tile_size (float): tile width and height used with by='tile'
+            processes (int): number of worker processes. Default None uses
+            all cores, 1 runs the partitions one after the other in this
+            process.
+            engine (str): engine passed to disaggregate and
+            disaggregate_leftover
+            integer (bool): also run round_counts on each partition, which
+            gives the same whole numbers as a serial run would
+        """
+
+        check = self.membership is not None and 'overpopulated' in parcels
+        msg = 'Run getOverpopParcels and assignParcels methods!'
+        assert check, msg
+
+        relation = self.buildSpatialRelation(parcels, blocks)
+        membership = self.membership
+        pop_name = self.configdict['pop_name']
+
+        if by == 'county':
+            keys = blocks.index.astype(str).str[:prefix]
+        elif by == 'tile':
+            keys = pd.MultiIndex.from_arrays(
+                [np.floor(relation.block_xy[:, 0]/tile_size),
+                 np.floor(relation.block_xy[:, 1]/tile_size)])
+        else:
+            raise Exception('kwarg by ' + by + ' is invalid')
+        keys = pd.factorize(keys)[0]
+
+        # Blocks connected through a shared parcel must stay together, so
+        # each group of connected blocks joins the partition of its first
+        # block.
+        keys = keys[self.blockComponents()]
+
+        partitions = []
+        for key in np.unique(keys):
+            block_pos = np.flatnonzero(keys == key)
+            partitions.append(self.partition(block_pos))
+
+        print('Disaggregating ' + str(len(partitions)) + ' partitions...')
+
+        if processes == 1:
+            results = [run_partition(*args, engine=engine, integer=integer)
+                       for args in partitions]
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = [pool.submit(run_partition, *args, engine=engine,
+                                       integer=integer)
+                           for args in partitions]
+                results = [future.result() for future in futures]
+
+        # Merge the partitions back
+        fields = count_fields(self.configdict)
+        for name in fields:
+            if parcels[name].dtype.kind != 'f':
+                parcels[name] = parcels[name].astype(float)
+
+        if self.ledger is None:
+            self.ledger = TransferLedger(fields[0], fields[1:])
+
+        block_results = []
+        initial = [] if self.ledger.initial is None else [self.ledger.initial]
+        for parcel_pop, block_result, ledger in results:
+            parcels.loc[parcel_pop.index, fields] = parcel_pop.values
+            block_results.append(block_result)
+            self.ledger.batches.extend(ledger.batches)
+            self.ledger.single.extend(ledger.single)
+            initial.append(ledger.initial)
+        self.ledger.initial = pd.concat(initial)
+
+        if integer:
+            parcels[fields] = parcels[fields].astype(np.int64)
+
+        block_results = pd.concat(block_results)
+        kept = blocks.index.isin(block_results.index)
+        blocks.drop(blocks.index[~kept], inplace=True)
+        for column in block_results.columns:
+            blocks[column] = block_results.loc[blocks.index, column].values
+        self.membership = membership.take(np.flatnonzero(kept))
+        self.drop_scratch(blocks)
+
+        remaining = str(self.parcel_df[pop_name].sum())
+        print('Total population disaggregated: ' + remaining)
+
+        return None
+
+    @instrumented
+    def disaggregate_incremental(self, parcels, blocks, previous,
+                                 changed_parcels=(), changed_blocks=(),
+                                 engine='vectorized'):
+        """ Updates a previous run after some parcels or blocks changed
+            (e.g. a new PLUTO release, or corrected block counts), redoing
+            the allocation only where it can differ. Gives the same results
+            as running blocksToOverpop, disaggregate and
+            disaggregate_leftover on the whole dataset. round_counts is not
+            supported after it, since the ledger only holds the transfers
+            of the blocks redone.
+
+            Load and pre-process the new inputs first (preprocess). The
+            blocks to redo are the changed blocks and the blocks paired,
+            before or after the change, with a changed parcel or with a
+            parcel paired with a changed block, extended to every block
+            they share parcels with (see blockComponents). Every other
+            parcel and block keeps its previous result.
+
+            Input:
+            ------
+            parcels: parcel GeoDataFrame (self.parcel_df)
+            blocks: census block GeoDataFrame (self.block_df)
+            previous: state written by writeState, as a file name in
+            output_dir or the loaded dict
+            changed_parcels: index labels of the parcels that were added,
+            removed or modified
+            changed_blocks: index labels of the blocks that were added,
+            removed or modified
+            engine (str): engine passed to disaggregate and
+            disaggregate_leftover
+        """
+
+        check = self.membership is not None and 'overpopulated' in parcels
+        msg = 'Run getOverpopParcels and assignParcels methods!'
+        assert check, msg
+
+        if not isinstance(previous, dict):
+            previous = pd.read_pickle(self.configdict['output_dir'] / previous)
+
+        relation = self.buildSpatialRelation(parcels, blocks)
+        membership = self.membership
+        fields = count_fields(self.configdict)
+        pop_name = fields[0]
+
+        pairs = component_pairs(relation, membership, parcels['overpopulated'])
+        old_pairs = previous['pairs']
+        both = pd.concat([old_pairs, pairs])
+
+        # Parcels whose pairs or results may have changed, and the blocks
+        # they are paired with before or after the change
+        dirty = both['parcel'].isin(changed_parcels)
+        dirty |= both['parcel'].isin(
+            both.loc[both['block'].isin(changed_blocks), 'parcel'])
+        seeds = blocks.index.isin(changed_blocks)
+        seeds |= blocks.index.isin(both.loc[dirty, 'block'])
+
+        components = self.blockComponents()
+        redo = np.isin(components, components[seeds])
+        block_pos = np.flatnonzero(redo)
+
+        print('Redoing ' + str(len(block_pos)) + ' of '
+              + str(len(blocks)) + ' blocks...')
+
+        if len(block_pos):
+            parcel_pop, block_result, ledger = run_partition(
+                *self.partition(block_pos), engine=engine)
+        else:
+            parcel_pop = pd.DataFrame(columns=fields)
+            block_result = previous['blocks'].iloc[:0]
+            ledger = None
+
+        # Parcels of the blocks kept keep their results, the others start
+        # from zero
+        kept = pairs.loc[~pairs['block'].isin(blocks.index[redo]), 'parcel']
+        kept = parcels.index.isin(kept) & parcels.index.isin(
+            previous['parcels'].index)
+        for name in fields:
+            parcels[name] = 0.0
+            parcels.loc[kept, name] = previous['parcels'].loc[
+                parcels.index[kept], name].values
+        parcels.loc[parcel_pop.index, fields] = parcel_pop.values
+
+        old_blocks = previous['blocks']
+        old_blocks = old_blocks[old_blocks.index.isin(blocks.index[~redo])]
+        block_results = pd.concat([old_blocks, block_result])
+        keep = blocks.index.isin(block_results.index)
+        blocks.drop(blocks.index[~keep], inplace=True)
+        for column in block_results.columns:
+            blocks[column] = block_results.loc[blocks.index, column].values
+        self.membership = membership.take(np.flatnonzero(keep))
+        self.drop_scratch(blocks)
+
+        # The ledger only covers the blocks that were redone, so it has no
+        # initial block counts: round_counts can't be run on it
+        if self.ledger is None:
+            self.ledger = TransferLedger(fields[0], fields[1:])
+        if ledger is not None:
+            self.ledger.batches.extend(ledger.batches)
+            self.ledger.single.extend(ledger.single)
+        self.ledger.initial = None
+
         remaining = str(self.parcel_df[pop_name].sum())
         print('Total population disaggregated: ' + remaining)
 
         return None
+
+    @instrumented
+    def sweep(self, scenarios, processes=None, engine='vectorized',
+              field=None):
+        """ Runs the disaggregation for several sets of parameters, reusing
+            the loaded and pre-processed inputs. Call it after preprocess (or
+            getOverpopParcels and assignParcels); self.parcel_df and
+            self.block_df are left untouched.
+
+            blocksToOverpop does not depend on the parameters, so it runs
+            once. Each scenario then runs disaggregate and
+            disaggregate_leftover on its own geometry-free copy of the
+            result, in a process pool.
+
+            Input:
+            ------
+            scenarios: dict mapping scenario names to parameter dicts, or a
+            list of parameter dicts (named by position). Parameters can be
+            top_hh_size, and top_den_allowed in people/acre as in the
+            namelist. Missing parameters keep their namelist values.
+            processes (int): number of worker processes. Default None uses
+            all cores, 1 runs the scenarios one after the other in this
+            process.
+            engine (str): engine passed to disaggregate and
+            disaggregate_leftover
+            field (str): count variable to return. Default pop_name.
+
+            Output:
+            -------
+            DataFrame with a row per parcel and a column per scenario.
+        """
+
+        check = (self.membership is not None
+                 and 'overpopulated' in self.parcel_df)
+        msg = 'Run getOverpopParcels and assignParcels methods!'
+        assert check, msg
+
+        if not isinstance(scenarios, dict):
+            scenarios = dict(enumerate(scenarios))
+        if field is None:
+            field = self.configdict['pop_name']
+
+        self.buildSpatialRelation(self.parcel_df, self.block_df)
+        base = list(self.partition(np.arange(len(self.block_df))))
+        configdict, parcel_df, block_df, relation, membership = base
+
+        print('Assigning blocks to overpopulated parcels...')
+        fields = count_fields(configdict)
+        with contextlib.redirect_stdout(io.StringIO()):
+            dasy = Dasymetry(configdict['run_dir'])
+            dasy.configdict = configdict
+            dasy.parcel_df = parcel_df
+            dasy.block_df = block_df
+            dasy.relation = relation
+            dasy.membership = membership
+            dasy.blocksToOverpop(parcel_df, block_df)
+
+        tasks = {}
+        for name, params in scenarios.items():
+            unknown = set(params) - {'top_hh_size', 'top_den_allowed'}
+            if unknown:
+                raise Exception('Unknown scenario parameters '
+                                + ', '.join(sorted(unknown)))
+
+            scenario = dict(configdict)
+            if 'top_hh_size' in params:
+                scenario['top_hh_size'] = float(params['top_hh_size'])
+            if 'top_den_allowed' in params:
+                scenario['top_den_allowed'] = [
+                    float(val)/SQFT_PER_ACRE
+                    for val in params['top_den_allowed']]
+
+            tasks[name] = (scenario, parcel_df, block_df, relation,
+                           membership)
+
+        print('Running ' + str(len(tasks)) + ' scenarios...')
+
+        if processes == 1:
+            # The stages modify the frames in place, so each scenario gets
+            # its own copy.
+            results = {name: run_partition(scenario, parcel_df.copy(),
+                                           block_df.copy(), relation,
+                                           membership, engine=engine,
+                                           overpop=False)
+                       for name, (scenario, parcel_df, block_df, relation,
+                                  membership) in tasks.items()}
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                futures = {name: pool.submit(run_partition, *args,
+                                             engine=engine, overpop=False)
+                           for name, args in tasks.items()}
+                results = {name: future.result()
+                           for name, future in futures.items()}
+
+        table = pd.DataFrame({name: result[0][field]
+                              for name, result in results.items()})
+
+        # Parcels outside every block keep their current value
+        table = table.reindex(self.parcel_df.index)
+        for name in table.columns:
+            table[name] = table[name].fillna(self.parcel_df[field])
+
+        return table
+
+    def blockComponents(self):
+        """ Labels the groups of blocks in self.block_df that have to be
+            disaggregated together, because they share a parcel: the blocks
+            within one overpopulated parcel, or the blocks listing the same
+            parcel in self.membership. See block_components.
+        """
+
+        relation = self.relation
+        bip_parcel, bip_block = relation.blocks_in_parcels
+        overpop = self.parcel_df['overpopulated'].values[bip_parcel]
+        member_block, member_parcel = self.membership.pairs()
+
+        return block_components(
+            len(self.block_df),
+            np.concatenate([bip_parcel[overpop], member_parcel]),
+            np.concatenate([bip_block[overpop], member_block]))
+
+    def partition(self, block_pos):
+        """ Cuts out the blocks at positions block_pos, together with their
+            parcels and the overpopulated parcels containing them, as a
+            self-contained input for run_partition. Geometries are left
+            out, since the disaggregation stages only use the precomputed
+            relation and membership.
+
+            Output:
+            -------
+            Tuple (configdict, parcel_df, block_df, relation, membership)
+        """
+
+        parcels = self.parcel_df
+        blocks = self.block_df
+        relation = self.relation
+        membership = self.membership.take(block_pos)
+
+        in_partition = np.zeros(len(blocks), dtype=bool)
+        in_partition[block_pos] = True
+
+        # Blocks within overpopulated parcels of this partition
+        bip_parcel, bip_block = relation.blocks_in_parcels
+        overpop = (parcels['overpopulated'].values[bip_parcel]
+                   & in_partition[bip_block])
+
+        parcel_pos = np.union1d(membership.parcel_pos, bip_parcel[overpop])
+
+        # Global -> local positions
+        local_parcel = np.full(len(parcels), -1, dtype=np.int64)
+        local_parcel[parcel_pos] = np.arange(len(parcel_pos))
+        local_block = np.full(len(blocks), -1, dtype=np.int64)
+        local_block[block_pos] = np.arange(len(block_pos))
+
+        parcel_df = pd.DataFrame(parcels.iloc[parcel_pos].drop(
+            columns=parcels.geometry.name))
+        block_df = pd.DataFrame(blocks.iloc[block_pos].drop(
+            columns=blocks.geometry.name))
+
+        def subset_pairs(pairs, block_first):
+            block, parcel = pairs if block_first else pairs[::-1]
+            keep = (local_block[block] >= 0) & (local_parcel[parcel] >= 0)
+            block = local_block[block[keep]]
+            parcel = local_parcel[parcel[keep]]
+            return (block, parcel) if block_first else (parcel, block)
+
+        sub_relation = SpatialRelation(
+            parcel_df.index, block_df.index,
+            subset_pairs(relation.blocks_in_parcels, block_first=False),
+            subset_pairs(relation.parcels_in_blocks, block_first=True))
+        sub_membership = BlockMembership(block_df.index, parcel_df.index,
+                                         membership.offsets,
+                                         local_parcel[membership.parcel_pos])
+
+        return (self.configdict, parcel_df, block_df, sub_relation,
+                sub_membership)
+
+    @instrumented
+    def disaggregate_streaming(self, configdict, filename,
+                               chunk_size=200000, engine='vectorized',
+                               integer=False, subset=None, geometry=False,
+                               compression=None, partition_by=None,
+                               prefetch=True):
+        """ Disaggregates datasets too large to hold in memory. The parcel
+            layer's extent is cut into square-ish tiles of about chunk_size
+            parcels each, and every tile is loaded, disaggregated and
+            appended to the output on its own, so memory use depends on
+            chunk_size rather than on the size of the dataset. Replaces
+            load_source_files up to writeOutput; the study area namelist
+            keys are not used.
+
+            A tile owns the blocks whose centroid falls within it. It loads
+            the parcels touching its blocks, and the blocks touching those
+            parcels, which is everything needed to disaggregate its blocks
+            exactly as a full run would. Groups of blocks that share a
+            parcel but straddle a tile boundary (see blockComponents) are
+            set aside and disaggregated together at the end.
+
+            The inputs of the next tile are loaded in a background thread
+            while the current one is disaggregated, and the results are
+            written in another. This keeps up to two tiles in memory; use
+            prefetch=False to load one tile at a time.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            filename (str): name of the output file, in output_dir
+            chunk_size (int): approximate number of parcels per tile
+            engine (str): engine passed to disaggregate and
+            disaggregate_leftover
+            integer (bool): write whole numbers, see round_counts
+            subset, geometry, compression, partition_by: see writeOutput
+            prefetch (bool): load the next tile while disaggregating
+        """
+
+        parcels = (configdict['run_dir']
+                   / configdict['input_dir']
+                   / configdict['parcels_file'])
+        crs, bounds, count = layer_info(parcels)
+
+        ntiles = max(1, int(np.ceil(count/chunk_size)))
+        nx = int(np.ceil(np.sqrt(ntiles)))
+        ny = int(np.ceil(ntiles/nx))
+        xs = np.linspace(bounds[0], bounds[2], nx + 1)
+        ys = np.linspace(bounds[1], bounds[3], ny + 1)
+
+        writer = ParcelWriter(configdict['output_dir'] / filename,
+                              geometry=geometry, compression=compression,
+                              partition_by=partition_by, background=True)
+
+        def tile_of(xy):
+            """ Tile (column, row) of each point of an (n, 2) coordinate
+                array. Tiles are closed on their lower and left edges, and
+                the outer tiles on all edges.
+            """
+            tile_x = np.searchsorted(xs, xy[:, 0], 'right') - 1
+            tile_y = np.searchsorted(ys, xy[:, 1], 'right') - 1
+            return np.clip(tile_x, 0, nx - 1), np.clip(tile_y, 0, ny - 1)
+
+        def load_tile(i, j):
+            """ The tile (i, j), its owned blocks and its inputs, see
+                load_region.
+            """
+            tile = gpd.GeoSeries(
+                [shapely.box(xs[i], ys[j], xs[i + 1], ys[j + 1])], crs=crs)
+            blocks = self.load_blocks(configdict, bbox=tile)
+            if blocks.crs != crs:
+                blocks = blocks.to_crs(crs)
+
+            tile_x, tile_y = tile_of(centroid_xy(
+                np.asarray(blocks.geometry.values)))
+            owned = blocks[(tile_x == i) & (tile_y == j)]
+
+            return tile, owned, self.load_region(configdict, owned, crs,
+                                                 tile=tile)
+
+        tiles = [(i, j) for i in range(nx) for j in range(ny)]
+        deferred = []
+        total = 0
+        try:
+            with ThreadPoolExecutor(max_workers=1) as pool:
+                ahead = None
+                for k, (i, j) in enumerate(tiles):
+                    print('Tile ' + str(k + 1) + ' of ' + str(len(tiles)))
+
+                    if ahead is None:
+                        ahead = pool.submit(load_tile, i, j)
+                    tile, owned, inputs = ahead.result()
+                    ahead = None
+                    if prefetch and k + 1 < len(tiles):
+                        ahead = pool.submit(load_tile, *tiles[k + 1])
+
+                    def in_tile(xy, i=i, j=j):
+                        tile_x, tile_y = tile_of(xy)
+                        return (tile_x == i) & (tile_y == j)
+
+                    written, straddling = self.disaggregate_region(
+                        configdict, owned, writer, crs, engine=engine,
+                        integer=integer, tile=tile, in_tile=in_tile,
+                        subset=subset, inputs=inputs)
+                    total += written
+                    deferred.append(straddling)
+
+            deferred = [blocks for blocks in deferred if len(blocks) > 0]
+            if deferred:
+                print('Disaggregating blocks on tile boundaries...')
+                written, straddling = self.disaggregate_region(
+                    configdict, pd.concat(deferred), writer, crs,
+                    engine=engine, integer=integer, subset=subset)
+                total += written
+        finally:
+            writer.close()
+        print('Total population disaggregated: ' + str(total))
+
+        return None
+
+    def load_region(self, configdict, owned, crs, tile=None):
+        """ Loads the parcels touching the blocks in owned (and the tile,
+            for the parcels without blocks), then every block touching those
+            parcels. Used by disaggregate_region; it only reads files, so it
+            can run in a background thread.
+
+            Output:
+            -------
+            Tuple of parcel_df and block_df, or None if there are no
+            parcels.
+        """
+
+        if tile is None:
+            area = {'mask': owned.geometry}
+        else:
+            bounds = pd.concat([owned.geometry, tile]).total_bounds
+            area = {'bbox': gpd.GeoSeries([shapely.box(*bounds)], crs=crs)}
+        parcel_df = self.load_parcels(configdict, **area)
+        if len(parcel_df) == 0:
+            return None
+
+        if tile is None:
+            area = {'mask': parcel_df.geometry}
+        else:
+            area = {'bbox': gpd.GeoSeries(
+                [shapely.box(*parcel_df.total_bounds)], crs=crs)}
+        block_df = self.load_blocks(configdict, **area)
+        if block_df.crs != parcel_df.crs:
+            block_df = block_df.to_crs(parcel_df.crs)
+
+        return parcel_df, block_df
+
+    def disaggregate_region(self, configdict, owned, writer, crs,
+                            engine='vectorized', integer=False, tile=None,
+                            in_tile=None, subset=None, inputs=None):
+        """ Disaggregates the blocks in owned for disaggregate_streaming and
+            writes the parcel results with writer.
+
+            Input:
+            ------
+            configdict: configuration dictionary from load_namelist
+            owned: GeoDataFrame of the blocks to disaggregate
+            writer: ParcelWriter of the output
+            crs: CRS of the parcel layer
+            engine (str): engine passed to disaggregate and
+            disaggregate_leftover
+            integer (bool): also run round_counts
+            tile (GeoSeries): the tile that owns the blocks. Groups of
+            blocks reaching outside the tile are returned rather than
+            disaggregated, and parcels without blocks whose centroid is in
+            the tile are written with zero population. Default None
+            disaggregates every group.
+            in_tile (function): takes an (n, 2) array of point coordinates
+            and returns whether each is in the tile. Required with tile.
+            subset: columns to write, see writeOutput
+            inputs: result of load_region for these arguments, if it was
+            loaded ahead. Default None loads it here.
+
+            Output:
+            -------
+            Tuple of the population written and the GeoDataFrame of owned
+            blocks that were set aside.
+        """
+
+        pop_name = configdict['pop_name']
+        fields = count_fields(configdict)
+
+        if inputs is None:
+            inputs = self.load_region(configdict, owned, crs, tile=tile)
+        if inputs is None:
+            return 0, owned.iloc[:0]
+        parcel_df, block_df = inputs
+
+        self.configdict = configdict
+        self.parcel_df = parcel_df
+        self.block_df = block_df
+        self.relation = None
+        self.membership = None
+        self.ledger = None
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.buildSpatialRelation(parcel_df, block_df)
+            self.getOverpopParcels(parcel_df, block_df)
+            self.assignParcels(parcel_df, block_df)
+
+        # A group of blocks is disaggregated here if all its blocks are
+        # owned, and set aside if only some are.
+        components = self.blockComponents()
+        is_owned = block_df.index.isin(owned.index)
+        nowned = np.bincount(components, weights=is_owned,
+                             minlength=len(block_df))
+        nblocks = np.bincount(components, minlength=len(block_df))
+        if tile is None:
+            process = nowned > 0
+        else:
+            process = (nowned > 0) & (nowned == nblocks)
+        straddling = (nowned > 0) & ~process
+
+        block_pos = np.flatnonzero(process[components])
+        if len(block_pos) > 0:
+            parcel_pop, block_result, ledger = run_partition(
+                *self.partition(block_pos), engine=engine, integer=integer)
+        else:
+            parcel_pop = parcel_df[fields].iloc[:0].astype(float)
+
+        if tile is not None:
+            # Parcels that are in no block at all still get a row, written
+            # by the tile that holds their centroid.
+            centroid_in_tile = in_tile(self.relation.parcel_xy)
+            related = parcel_df['overpopulated'].values.copy()
+            related[self.membership.parcel_pos] = True
+            unrelated = parcel_df.loc[centroid_in_tile & ~related, fields]
+            parcel_pop = pd.concat([parcel_pop, unrelated.astype(float)])
+
+        if integer:
+            parcel_pop = parcel_pop.astype(np.int64)
+
+        # The other columns (and geometries) come from the loaded parcels
+        parcel_out = parcel_df.loc[parcel_pop.index].copy()
+        parcel_out[fields] = parcel_pop[fields].values
+        writer.write(output_frame(parcel_out, configdict, subset=subset,
+                                  geometry=writer.geometry,
+                                  partition_by=writer.partition_by))
+
+        set_aside = owned.index.isin(
+            block_df.index[straddling[components]])
+
+        return parcel_pop[pop_name].sum(), owned[set_aside]
+
+
+def block_components(nblocks, parcel_pos, block_pos):
+    """ Labels groups of blocks that are connected through shared parcels.
+        (parcel_pos[i], block_pos[i]) are parcel-block pairs; blocks that
+        share a parcel, directly or through other blocks, get the same
+        label, which is the smallest block position in the group.
+    """
+
+    labels = np.arange(nblocks)
+    if len(parcel_pos) == 0:
+        return labels
+
+    # Link each block to the next block of the same parcel
+    order = np.lexsort((block_pos, parcel_pos))
+    parcel_pos = parcel_pos[order]
+    block_pos = block_pos[order]
+    same = parcel_pos[1:] == parcel_pos[:-1]
+    left = block_pos[:-1][same]
+    right = block_pos[1:][same]
+
+    while True:
+        smallest = np.minimum(labels[left], labels[right])
+        new = labels.copy()
+        np.minimum.at(new, left, smallest)
+        np.minimum.at(new, right, smallest)
+        # Follow the labels to their root
+        new = new[new]
+        if np.array_equal(new, labels):
+            return labels
+        labels = new
+
+
+def component_pairs(relation, membership, overpopulated):
+    """ Parcel-block pairs that population can move through: blocks within
+        overpopulated parcels, and the parcels listed for each block in
+        membership. Returned as a DataFrame of parcel and block labels, so
+        it can be compared across runs on different inputs.
+    """
+
+    bip_parcel, bip_block = relation.blocks_in_parcels
+    overpop = overpopulated.values[bip_parcel]
+    member_block, member_parcel = membership.pairs()
+
+    return pd.DataFrame({
+        'parcel': np.concatenate([
+            relation.parcel_index[bip_parcel[overpop]],
+            membership.parcel_index[member_parcel]]),
+        'block': np.concatenate([
+            relation.block_index[bip_block[overpop]],
+            membership.block_index[member_block]])})
+
+
+def centroid_xy(geometries):
+    """ Centroids of an array of geometries, as an (n, 2) array of
+        coordinates (NaN for missing or empty geometries).
+    """
+
+    centroids = shapely.centroid(geometries)
+
+    return np.column_stack([shapely.get_x(centroids),
+                            shapely.get_y(centroids)])
+
+
+def downcast(df, skip=()):
+    """ Stores the columns of df in the smallest dtypes that hold their
+        values exactly, in place: whole numbers in the smallest integer
+        type, other floats as float32 when that loses nothing, and text as
+        categoricals. Columns in skip, and the geometry, are left alone.
+    """
+
+    for name in df.columns:
+        column = df[name]
+        if name in skip or isinstance(column, gpd.GeoSeries):
+            continue
+
+        kind = column.dtype.kind
+        if kind == 'f':
+            values = column.to_numpy()
+            if (np.isfinite(values).all()
+                    and np.array_equal(values, np.round(values))):
+                df[name] = pd.to_numeric(values.astype(np.int64),
+                                         downcast='integer')
+            elif np.array_equal(values.astype(np.float32), values,
+                                equal_nan=True):
+                df[name] = values.astype(np.float32)
+        elif kind in 'iu':
+            df[name] = pd.to_numeric(column, downcast='integer')
+        elif kind == 'O' and column.map(type).eq(str).all():
+            df[name] = column.astype('category')
+
+    return df
+
+
+def concat_downcast(chunks):
+    """ Concatenates frames made smaller by downcast. Chunks downcast on
+        their own can end up with different integer widths, or categoricals
+        with different categories, which pd.concat would widen to int64 or
+        object. Instead, each column is first brought to one dtype in every
+        chunk: the smallest that holds every chunk's values (np.result_type)
+        or a categorical with the union of the categories.
+    """
+
+    for name in chunks[0].columns:
+        columns = [chunk[name] for chunk in chunks]
+        if isinstance(columns[0], gpd.GeoSeries):
+            continue
+
+        dtypes = [column.dtype for column in columns]
+        if all(isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes):
+            categories = set()
+            for dtype in dtypes:
+                categories.update(dtype.categories)
+            dtype = pd.CategoricalDtype(sorted(categories))
+        elif all(isinstance(dtype, np.dtype) and dtype.kind in 'biuf'
+                 for dtype in dtypes):
+            dtype = np.result_type(*dtypes)
+        else:
+            continue
+
+        for chunk in chunks:
+            if chunk[name].dtype != dtype:
+                chunk[name] = chunk[name].astype(dtype)
+
+    return pd.concat(chunks)
+
+
+def largest_remainder(group, weights, totals, tiebreak):
+    """ Splits the whole number totals[g] of each group g between its rows
+        (group[i] == g) in proportion to weights. Every row gets the whole
+        part of its quota, and the rows with the largest fractional parts
+        one more, until the parts add up to totals[g] exactly. Ties go to
+        the row with the smallest tiebreak. Groups whose weights add up to
+        zero get nothing.
+
+        Output:
+        -------
+        Integer array of the part of each row
+    """
+
+    weight_sum = np.bincount(group, weights=weights, minlength=len(totals))
+    share = np.divide(weights, weight_sum[group],
+                      out=np.zeros(len(weights)),
+                      where=weight_sum[group] > 0)
+    quota = totals[group]*share
+    parts = np.floor(quota)
+
+    # Rounded, so that float noise (e.g. between serial and partitioned
+    # runs) doesn't decide who gets the remainder
+    fraction = np.round(quota - parts, 9)
+    missing = totals - np.bincount(group, weights=parts,
+                                   minlength=len(totals))
+    missing = np.where(weight_sum > 0, np.rint(missing), 0)
+
+    # Rank of each row within its group, largest fraction first
+    order = np.lexsort((tiebreak, -fraction, group))
+    sizes = np.bincount(group, minlength=len(totals))
+    first = np.cumsum(sizes) - sizes
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - first[group[order]]
+
+    return parts.astype(np.int64) + (rank < missing[group])
+
+
+def resunit_shares(offsets, units, block_pop, total_units, how='compute',
+                   top_hh_size=None):
+    """ People each parcel gets from its block in
+        Dasymetry.disaggregate: with how='compute' its share of the block
+        population by residential units, with how='max' top_hh_size people
+        per unit. Blocks are given in CSR layout (see BlockMembership), so
+        the parcels of block i are rows offsets[i]:offsets[i + 1] of units.
+
+        Input:
+        ------
+        offsets: array of nblocks + 1 row offsets
+        units: residential units of each row's parcel
+        block_pop: population of each block
+        total_units: residential units of each block
+        how (str): 'compute' or 'max'
+        top_hh_size (float): people per unit with how='max'
+
+        Output:
+        -------
+        Array of people per row.
+    """
+
+    if how not in ('compute', 'max'):
+        raise Exception('kwarg how ' + how + ' is invalid')
+
+    units = np.asarray(units, dtype=float)
+    if how == 'max':
+        return top_hh_size*units
+
+    kernel = compiled(resunit_shares_loop)
+    if kernel is not None:
+        return kernel(np.asarray(offsets, dtype=np.int64), units,
+                      np.asarray(block_pop, dtype=float),
+                      np.asarray(total_units, dtype=float))
+
+    counts = np.diff(offsets)
+    return (np.repeat(block_pop, counts)*units
+            / np.repeat(total_units, counts))
+
+
+def resunit_shares_loop(offsets, units, block_pop, total_units):
+    """ resunit_shares with how='compute', one block at a time. Compiled
+        by Numba.
+    """
+
+    numpeople = np.empty(len(units))
+    for i in range(len(offsets) - 1):
+        for j in range(offsets[i], offsets[i + 1]):
+            numpeople[j] = block_pop[i]*units[j]/total_units[i]
+
+    return numpeople
+
+
+def area_shares(offsets, area, block_pop, allowed=None):
+    """ People each parcel gets from its block in
+        Dasymetry.disaggregate_leftover. Within a block, each parcel in turn
+        takes its share of the block's area times the people its block has
+        left, capped at what it is allowed (when allowed is given); a lone
+        parcel takes exactly what it is allowed. Blocks are given in CSR
+        layout as in resunit_shares.
+
+        Input:
+        ------
+        offsets: array of nblocks + 1 row offsets
+        area: lot area of each row's parcel
+        block_pop: population of each block
+        allowed: people each row's parcel can still take. Default None
+        doesn't cap.
+
+        Output:
+        -------
+        Array of people per row.
+    """
+
+    area = np.asarray(area, dtype=float)
+    block_pop = np.asarray(block_pop, dtype=float)
+    capped = allowed is not None
+    allowed = np.asarray(allowed if capped else [], dtype=float)
+
+    kernel = compiled(area_shares_loop)
+    if kernel is not None:
+        return kernel(np.asarray(offsets, dtype=np.int64), area, block_pop,
+                      allowed, capped)
+
+    # Without Numba, we step through the positions within the blocks
+    # instead, handling that position for every block in one array
+    # operation.
+    counts = np.diff(offsets)
+    block = np.repeat(np.arange(len(counts)), counts)
+    total_area = np.bincount(block, weights=area, minlength=len(counts))
+    areaprop = area/total_area[block]
+
+    rank = np.arange(len(area)) - offsets[:-1][block]
+    order = np.argsort(rank, kind='stable')
+    bounds = np.searchsorted(rank[order], np.arange(counts.max(initial=0)
+                                                    + 1))
+
+    remaining = block_pop.copy()
+    numpeople = np.zeros(len(area))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        pos = order[start:stop]
+        transfer = areaprop[pos]*remaining[block[pos]]
+        if capped:
+            transfer = np.where(transfer < allowed[pos], transfer,
+                                allowed[pos])
+            single = counts[block[pos]] == 1
+            transfer[single] = allowed[pos][single]
+
+        numpeople[pos] = transfer
+        remaining[block[pos]] = remaining[block[pos]] - transfer
+
+    return numpeople
+
+
+def area_shares_loop(offsets, area, block_pop, allowed, capped):
+    """ area_shares one block at a time. Compiled by Numba. """
+
+    numpeople = np.zeros(len(area))
+    for i in range(len(offsets) - 1):
+        start = offsets[i]
+        stop = offsets[i + 1]
+
+        total_area = 0.0
+        for j in range(start, stop):
+            total_area += area[j]
+
+        remaining = block_pop[i]
+        for j in range(start, stop):
+            transfer = area[j]/total_area*remaining
+            if capped and (stop - start == 1 or not transfer < allowed[j]):
+                transfer = allowed[j]
+            numpeople[j] = transfer
+            remaining = remaining - transfer
+
+    return numpeople
+
+
+def compiled(function):
+    """ function compiled by Numba, or None when Numba isn't installed
+        or USE_NUMBA is False. Kernels are compiled on first use, so that
+        importing dasymetry doesn't import Numba.
+    """
+
+    if numba is None or not USE_NUMBA:
+        return None
+
+    return jit(function)
+
+
+@functools.lru_cache(maxsize=None)
+def jit(function):
+    """ Compiles function with Numba, once. Returns None if Numba can't
+        be imported (e.g. it doesn't support the installed NumPy).
+    """
+
+    try:
+        # error_model='numpy' divides by zero as NumPy does, into inf or NaN
+        return numba.njit(cache=True, nogil=True,
+                          error_model='numpy')(function)
+    except ImportError:
+        return None
+
+
+def output_frame(parcels, configdict, subset=None, rows=None,
+                 geometry=False, partition_by=None):
+    """ Selects the columns and rows of parcels to write, see
+        Dasymetry.writeOutput. A partition_by column is always kept.
+    """
+
+    if subset is None:
+        columns = count_fields(configdict)
+    elif isinstance(subset, str) and subset == 'all':
+        columns = [name for name in parcels.columns
+                   if name != parcels.geometry.name]
+    elif isinstance(subset, str):
+        columns = [subset]
+    else:
+        columns = list(subset)
+
+    if isinstance(partition_by, str) and partition_by not in columns:
+        columns = columns + [partition_by]
+    if geometry:
+        columns = columns + [parcels.geometry.name]
+    if rows is not None:
+        parcels = parcels.loc[rows]
+
+    return parcels[columns]
+
+
+def count_fields(configdict):
+    """ Names of the count variables to disaggregate: pop_name, followed by
+        every other non-geometry field in block_fields.
+    """
+
+    pop_name = configdict['pop_name']
+    others = [field for field in configdict['block_fields']
+              if field not in (pop_name, 'geometry')]
+
+    return [pop_name] + others
+
+
+def layer_crs(filename):
+    """ CRS of a vector file, read from its metadata without loading the
+        features. None if the file has none, or it can't be read this way.
+    """
+
+    filename = Path(filename)
+    if filename.suffix.lower() in ('.parquet', '.geoparquet'):
+        if pq is None:
+            return None
+        geo = json.loads(pq.read_schema(filename).metadata[b'geo'])
+        crs = geo['columns'][geo['primary_column']].get('crs', 'OGC:CRS84')
+    elif pyogrio is not None:
+        crs = pyogrio.read_info(filename)['crs']
+    else:
+        return None
+
+    return None if crs is None else pyproj.CRS.from_user_input(crs)
+
+
+def layer_info(filename):
+    """ CRS, total bounds and number of features of a vector file, read
+        from its metadata without loading the features.
+    """
+
+    filename = Path(filename)
+    if filename.suffix.lower() in ('.parquet', '.geoparquet'):
+        metadata = pq.read_metadata(filename)
+        geo = json.loads(metadata.metadata[b'geo'])
+        column = geo['columns'][geo['primary_column']]
+
+        # The bbox is optional in GeoParquet metadata
+        if 'bbox' not in column:
+            df = gpd.read_parquet(filename, columns=[geo['primary_column']])
+            return df.crs, df.total_bounds, metadata.num_rows
+
+        # A missing crs means OGC:CRS84, a null one an unknown CRS
+        crs = column.get('crs', 'OGC:CRS84')
+        if crs is not None:
+            crs = pyproj.CRS.from_user_input(crs)
+
+        return crs, column['bbox'], metadata.num_rows
+
+    if pyogrio is None:
+        raise Exception('Reading ' + filename.name + ' in chunks needs '
+                        'pyogrio, or a GeoParquet input')
+
+    info = pyogrio.read_info(filename, force_total_bounds=True)
+
+    return info['crs'], info['total_bounds'], info['features']
+
+
+def run_partition(configdict, parcel_df, block_df, relation, membership,
+                  engine='vectorized', overpop=True, integer=False):
+    """ Runs blocksToOverpop, disaggregate and disaggregate_leftover on one
+        partition made by Dasymetry.partition, and round_counts with
+        integer=True. Used as the process pool task of
+        Dasymetry.disaggregate_partitioned, and of Dasymetry.sweep with
+        overpop=False to skip blocksToOverpop.
+
+        Output:
+        -------
+        Tuple of the parcel populations (DataFrame with a column per count
+        variable), the remaining blocks (DataFrame with population and
+        residential unit columns) and the partition's TransferLedger.
+    """
+
+    dasy = Dasymetry(configdict['run_dir'])
+    dasy.configdict = configdict
+    dasy.res_units = configdict['res_units']
+    dasy.parcel_df = parcel_df
+    dasy.block_df = block_df
+    dasy.relation = relation
+    dasy.membership = membership
+
+    fields = count_fields(configdict)
+
+    # Keep the per-stage progress prints of the partitions quiet
+    with contextlib.redirect_stdout(io.StringIO()):
+        if overpop:
+            dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+        dasy.disaggregate(dasy.parcel_df, dasy.block_df, engine=engine)
+        dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df,
+                                   engine=engine)
+        if integer:
+            dasy.round_counts(dasy.parcel_df, dasy.block_df)
+
+    block_columns = [column for column in
+                     fields + list(Dasymetry.scratch_columns)
+                     if column in dasy.block_df]
+
+    return (dasy.parcel_df[fields], dasy.block_df[block_columns],
+            dasy.ledger)
@@ -0,0 +1,475 @@
+""" Reads and checks namelist.config files, see Config. Uses the standard
+    library only, so that it loads fast: checking a namelist, or planning
+    a run, doesn't import the geospatial stack.
+
+    Usage:
+    ------
+    python namelist.py validate RUNDIR
+    python namelist.py plan RUNDIR --memory-limit 8000
+    RUNDIR is the run directory holding namelist.config, or the path of a
+    namelist file. --set key=value replaces a namelist parameter.
+"""
+
+import argparse
+import contextlib
+import json
+import re
+import sqlite3
+import struct
+import sys
+from pathlib import Path
+
+# Allowed densities are given in people/acre, parcel areas in sq. ft
+SQFT_PER_ACRE = 43560
+
+# Peak memory (MB) and run time (s) of preprocess plus the three
+# disaggregation steps, measured with benchmark.py: a fixed part, plus a
+# part per million parcels. Reading shapefiles takes longer than GeoParquet
+# or GeoPackage files.
+BASE_MB = 240
+MB_PER_MILLION = {'full': 910, 'lean': 530}
+SECONDS_PER_MILLION = 5
+SHAPEFILE_SECONDS_PER_MILLION = 3
+
+
+class Config:
+
+    """ Parameters of a namelist.config file, read into typed attributes
+        and checked as they are read. An invalid namelist (a missing or
+        malformed parameter, a key given twice with different values,
+        lot_types, lot_codes_N and top_den_allowed of different lengths,
+        ...) raises an Exception listing every problem found. Keys given
+        twice with the same value, and unknown keys, only add to
+        self.warnings. See check_inputs for the checks of the input files.
+
+        The parameters are:
+        run_dir, input_dir, output_dir (Path)
+        parcels_file, parcels_fid, res_units, population_file,
+        population_fid, pop_name (str)
+        parcel_fields, block_fields, lot_types (list of str)
+        lot_codes (list of lists of str, from lot_codes_1, lot_codes_2, ...)
+        top_hh_size (float)
+        top_den_allowed (list of float, in people/acre)
+        study_area_bbox (list of 4 floats), study_area_crs,
+        study_area_mask (str), optional, None when not given
+        extra (dict of any other parameters, as str)
+    """
+
+    __slots__ = ('path', 'run_dir', 'input_dir', 'output_dir',
+                 'parcels_file', 'parcels_fid', 'res_units',
+                 'population_file', 'population_fid', 'pop_name',
+                 'parcel_fields', 'block_fields', 'lot_types', 'lot_codes',
+                 'top_hh_size', 'top_den_allowed', 'study_area_bbox',
+                 'study_area_crs', 'study_area_mask', 'extra', 'warnings')
+
+    paths = ('run_dir', 'input_dir', 'output_dir')
+    strings = ('parcels_file', 'parcels_fid', 'res_units', 'population_file',
+               'population_fid', 'pop_name', 'study_area_crs',
+               'study_area_mask')
+    lists = ('parcel_fields', 'block_fields', 'lot_types')
+    numbers = ('top_hh_size',)
+    number_lists = ('top_den_allowed', 'study_area_bbox')
+    optional = ('study_area_bbox', 'study_area_crs', 'study_area_mask')
+
+    # Parcel fields the pipeline uses by name, besides res_units
+    parcel_columns = ('numfloors', 'landuse', 'lotarea', 'geometry')
+
+    def __init__(self, params, path=None, warnings=None):
+        """ Input:
+            ------
+            params (dict): parameters as str, as written in a namelist file
+            path: the namelist file, if any
+            warnings (list): problems found while reading the file
+        """
+
+        self.path = path
+        self.warnings = list(warnings or [])
+        self.extra = {}
+        errors = []
+
+        known = (self.paths + self.strings + self.lists + self.numbers
+                 + self.number_lists)
+        lot_codes = {}
+        for key, value in params.items():
+            match = re.fullmatch(r'lot_codes_(\d+)', key)
+            if match:
+                lot_codes[int(match.group(1))] = split_list(value)
+            elif key not in known:
+                self.warnings.append('unknown parameter ' + key)
+                self.extra[key] = value
+
+        for key in known:
+            value = params.get(key, '')
+            if value == '':
+                if key not in self.optional:
+                    errors.append('missing parameter ' + key)
+                setattr(self, key, None)
+                continue
+            try:
+                setattr(self, key, convert(key, value))
+            except ValueError:
+                errors.append(key + ' must be a number or list of numbers, '
+                              'not ' + repr(value))
+                setattr(self, key, None)
+
+        self.lot_codes = []
+        if self.lot_types is not None:
+            for n, lot in enumerate(self.lot_types):
+                if n + 1 not in lot_codes:
+                    errors.append('missing parameter lot_codes_' + str(n + 1)
+                                  + ' (codes of lot type ' + lot + ')')
+                self.lot_codes.append(lot_codes.pop(n + 1, []))
+            for n in sorted(lot_codes):
+                self.warnings.append('lot_codes_' + str(n) + ' has no lot '
+                                     'type')
+            if (self.top_den_allowed is not None
+                    and len(self.top_den_allowed) != len(self.lot_types)):
+                errors.append('top_den_allowed has '
+                              + str(len(self.top_den_allowed))
+                              + ' values for ' + str(len(self.lot_types))
+                              + ' lot_types')
+
+        if self.top_hh_size is not None and self.top_hh_size <= 0:
+            errors.append('top_hh_size must be positive')
+        if self.top_den_allowed is not None and min(self.top_den_allowed) < 0:
+            errors.append('top_den_allowed must not be negative')
+
+        if self.study_area_bbox is not None:
+            bbox = self.study_area_bbox
+            if len(bbox) != 4 or bbox[0] >= bbox[2] or bbox[1] >= bbox[3]:
+                errors.append('study_area_bbox must be xmin, ymin, xmax, '
+                              'ymax')
+
+        if self.parcel_fields is not None:
+            wanted = self.parcel_columns + (self.res_units or '',)
+            for field in wanted:
+                if field and field not in self.parcel_fields:
+                    errors.append('parcel_fields must include ' + field)
+        if self.block_fields is not None:
+            for field in (self.pop_name, 'geometry'):
+                if field and field not in self.block_fields:
+                    errors.append('block_fields must include ' + field)
+
+        if errors:
+            name = 'namelist' if path is None else str(path)
+            raise Exception(name + ' is invalid:\n  ' + '\n  '.join(errors))
+
+        return None
+
+    @classmethod
+    def read(cls, rundir, overrides=None):
+        """ Reads a namelist file. Lines are key = value, lists are comma
+            separated, and lines starting with # are comments.
+
+            Input:
+            ------
+            rundir: running directory containing the file 'namelist.config',
+            or the path of a namelist file
+            overrides (dict): parameters that replace (or add to) those in the
+            file, written as in the file, e.g. {'top_den_allowed': '55, 5, 5'}
+
+            Output:
+            -------
+            Config
+        """
+
+        path = Path(rundir)
+        if path.is_dir():
+            path = path / 'namelist.config'
+
+        params = {}
+        warnings = []
+        errors = []
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                if '=' not in line:
+                    errors.append('line ' + str(number) + ' is not '
+                                  'key = value: ' + line)
+                    continue
+
+                key, value = (part.strip() for part in line.split('=', 1))
+                if key in params and params[key] != value:
+                    errors.append('line ' + str(number) + ' sets ' + key
+                                  + ' again, to a different value')
+                elif key in params:
+                    warnings.append(key + ' is set twice (line '
+                                    + str(number) + ')')
+                params[key] = value
+
+        if errors:
+            raise Exception(str(path) + ' is invalid:\n  '
+                            + '\n  '.join(errors))
+
+        for key, value in (overrides or {}).items():
+            if isinstance(value, (list, tuple)):
+                value = ', '.join(str(item) for item in value)
+            params[key] = str(value).strip()
+
+        return cls(params, path=path, warnings=warnings)
+
+    def to_dict(self):
+        """ The parameters as the configdict used by Dasymetry: paths as Path,
+            top_den_allowed in people/sq. ft, the codes of every lot type as
+            <lot>_codes, and the study area keys only when given.
+        """
+
+        configdict = {}
+        for key in (self.paths + self.strings + self.lists + self.numbers
+                    + self.number_lists):
+            value = getattr(self, key)
+            if value is not None or key not in self.optional:
+                configdict[key] = value
+
+        configdict['top_den_allowed'] = [value/SQFT_PER_ACRE for value
+                                         in self.top_den_allowed]
+        for lot, codes in zip(self.lot_types, self.lot_codes):
+            configdict[lot + '_codes'] = list(codes)
+
+        for key, value in self.extra.items():
+            value = [item.strip() for item in value.split(',')]
+            configdict[key] = value[0] if len(value) == 1 else value
+
+        return configdict
+
+    def inputs(self):
+        """ Paths of the input files: parcels, population and, when given,
+            the study area mask.
+        """
+
+        directory = self.run_dir / self.input_dir
+        files = {'parcels': directory / self.parcels_file,
+                 'population': directory / self.population_file}
+        if self.study_area_mask is not None:
+            files['study_area_mask'] = directory / self.study_area_mask
+
+        return files
+
+    def check_inputs(self):
+        """ Checks that the input files exist, and that they have the fields
+            listed in parcel_fields and block_fields (for shapefiles,
+            GeoPackages and, with pyarrow installed, GeoParquet files).
+            Field names are compared ignoring case, as they are loaded.
+
+            Output:
+            -------
+            List of problems found, empty if none
+        """
+
+        problems = []
+        if not self.run_dir.is_dir():
+            problems.append('run_dir ' + str(self.run_dir) + ' does not '
+                            'exist')
+
+        wanted = {'parcels': [self.parcels_fid] + self.parcel_fields,
+                  'population': [self.population_fid] + self.block_fields}
+        for name, path in self.inputs().items():
+            if not path.exists():
+                problems.append(name + ' file ' + str(path) + ' does not '
+                                'exist')
+                continue
+
+            fields, count = layer_summary(path)
+            if fields is None or name not in wanted:
+                continue
+            fields = [field.lower() for field in fields]
+            missing = [field for field in wanted[name]
+                       if field != 'geometry' and field.lower() not in fields]
+            if missing:
+                problems.append(name + ' file ' + path.name + ' has no '
+                                + ', '.join(missing) + ' field')
+
+        return problems
+
+    def plan(self, memory_limit=None):
+        """ Estimates the peak memory use and run time of preprocess plus
+            the three disaggregation steps, from the number of parcels in the
+            input files (or, when it can't be read, their size), and picks
+            the way to run that fits in memory_limit.
+
+            Input:
+            ------
+            memory_limit (float): memory available, in MB
+
+            Output:
+            -------
+            Dict with the feature counts and file sizes (MB) of the inputs,
+            estimated peak memory (MB) full and lean, estimated time (s), and
+            the suggested mode: 'full', 'lean' or 'streaming', with
+            chunk_size for streaming. Estimates are None if the parcels
+            can't be counted.
+        """
+
+        plan = {}
+        for name, path in self.inputs().items():
+            plan[name + '_mb'] = (path.stat().st_size/2**20 if path.exists()
+                                  else None)
+            plan[name + '_count'] = (layer_summary(path)[1]
+                                     if path.exists() else None)
+
+        parcels = plan['parcels_count']
+        if parcels is None:
+            plan.update({'memory_mb': None, 'lean_memory_mb': None,
+                         'time_s': None, 'mode': None})
+            return plan
+
+        millions = parcels/1e6
+        plan['memory_mb'] = BASE_MB + MB_PER_MILLION['full']*millions
+        plan['lean_memory_mb'] = BASE_MB + MB_PER_MILLION['lean']*millions
+        seconds = SECONDS_PER_MILLION
+        if self.inputs()['parcels'].suffix.lower() == '.shp':
+            seconds += SHAPEFILE_SECONDS_PER_MILLION
+        plan['time_s'] = seconds*millions
+
+        plan['mode'] = 'full'
+        if memory_limit is not None and plan['memory_mb'] > memory_limit:
+            plan['mode'] = 'lean'
+        if memory_limit is not None and plan['lean_memory_mb'] > memory_limit:
+            # disaggregate_streaming holds about two tiles at a time
+            per_parcel = MB_PER_MILLION['full']/1e6
+            chunk_size = (memory_limit - BASE_MB)/(2*per_parcel)
+            plan['mode'] = 'streaming'
+            plan['chunk_size'] = max(int(chunk_size // 10000)*10000, 10000)
+
+        return plan
+
+
+def split_list(value):
+    """ Items of a comma separated list, without blanks and empty items. """
+
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+def convert(key, value):
+    """ Converts the str value of parameter key to its type, see Config. """
+
+    if key in Config.paths:
+        return Path(value)
+    if key in Config.lists:
+        return split_list(value)
+    if key in Config.numbers:
+        return float(value)
+    if key in Config.number_lists:
+        return [float(item) for item in split_list(value)]
+
+    return value
+
+
+def layer_summary(filename):
+    """ Field names and number of features of a vector file, read from its
+        header without loading it: the .dbf of shapefiles, the SQLite
+        tables of GeoPackages, and the footer of GeoParquet files (this one
+        needs pyarrow, imported only then).
+
+        Output:
+        -------
+        (fields, count), each None if it can't be read
+    """
+
+    filename = Path(filename)
+    suffix = filename.suffix.lower()
+    try:
+        if suffix == '.shp':
+            with open(filename.with_suffix('.dbf'), 'rb') as f:
+                count, header_size = struct.unpack('<IH', f.read(32)[4:10])
+                descriptors = f.read(header_size - 32)
+            fields = []
+            for start in range(0, len(descriptors) - 31, 32):
+                name = descriptors[start:start + 11].split(b'\x00')[0]
+                fields.append(name.decode('latin-1'))
+
+            return fields, count
+
+        if suffix == '.gpkg':
+            uri = filename.resolve().as_uri() + '?mode=ro'
+            with contextlib.closing(sqlite3.connect(uri, uri=True)) as db:
+                table, = db.execute("SELECT table_name FROM gpkg_contents "
+                                    "WHERE data_type = 'features' "
+                                    "LIMIT 1").fetchone()
+                fields = [row[1] for row in db.execute(
+                    'PRAGMA table_info("' + table + '")')]
+                count, = db.execute('SELECT COUNT(*) FROM "' + table
+                                    + '"').fetchone()
+
+            return fields, count
+
+        if suffix in ('.parquet', '.geoparquet'):
+            import pyarrow.parquet as pq
+
+            metadata = pq.read_metadata(filename)
+            fields = list(metadata.schema.to_arrow_schema().names)
+
+            return fields, metadata.num_rows
+    except (ImportError, OSError, ValueError, TypeError, struct.error,
+            sqlite3.Error):
+        pass
+
+    return None, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('command', choices=['validate', 'plan'],
+                        help='validate: check the namelist and the input '
+                        'files. plan: also estimate memory use and run time')
+    parser.add_argument('rundir', help='run directory holding '
+                        'namelist.config, or a namelist file')
+    parser.add_argument('--set', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='replace a namelist parameter, can be repeated')
+    parser.add_argument('--memory-limit', type=float, default=None,
+                        help='memory available to the run, in MB')
+    parser.add_argument('--json', action='store_true',
+                        help='print the plan as JSON')
+    args = parser.parse_args()
+
+    overrides = dict(item.split('=', 1) for item in args.set)
+    try:
+        config = Config.read(args.rundir, overrides=overrides)
+    except Exception as error:
+        print(error)
+        sys.exit(1)
+
+    problems = config.check_inputs()
+    for warning in config.warnings:
+        print('Warning: ' + warning)
+    for problem in problems:
+        print('Error: ' + problem)
+    if problems:
+        sys.exit(1)
+    if args.command == 'validate':
+        print(str(config.path) + ' is valid')
+        return None
+
+    plan = config.plan(memory_limit=args.memory_limit)
+    if args.json:
+        print(json.dumps(plan))
+        return None
+
+    for name in config.inputs():
+        count = plan[name + '_count']
+        print(name + ': ' + ('unknown number of' if count is None
+                             else format(count, ',')) + ' features, '
+              + format(plan[name + '_mb'], ',.1f') + ' MB')
+    if plan['mode'] is None:
+        print('Cannot count the parcels, no estimate')
+        return None
+
+    print('Estimated peak memory: ' + format(plan['memory_mb'], ',.0f')
+          + ' MB, lean: ' + format(plan['lean_memory_mb'], ',.0f') + ' MB')
+    print('Estimated run time: ' + format(plan['time_s'], ',.1f') + ' s')
+    if plan['mode'] == 'lean':
+        print('Use preprocess(configdict, lean=True) to fit in '
+              + format(args.memory_limit, ',.0f') + ' MB')
+    elif plan['mode'] == 'streaming':
+        print('Use disaggregate_streaming(configdict, outfile, chunk_size='
+              + str(plan['chunk_size']) + ') to fit in '
+              + format(args.memory_limit, ',.0f') + ' MB')
+
+    return None
+
+
+if __name__ == '__main__':
+    main()
@@ -17,12 +17,29 @@ import matplotlib.pyplot as plt
 
 dasy = dasy.Dasymetry(workdir)
 dasy.load_namelist(dasy.rundir)
-dasy.load_source_files(dasy.configdict)
 
-# Pre-process blocks and lots for disaggregation
-dasy.getOverpopParcels(dasy.parcel_df, dasy.block_df)
+# Optionally, record time, memory, rows and population of every stage, see
+# writeProfile below. profile=True also runs the stages under cProfile.
+# dasy.startProfiling(profile=False)
 
-dasy.assignParcels(dasy.parcel_df, dasy.block_df)
+# Load and pre-process blocks and lots for disaggregation. This runs
+# load_source_files, buildSpatialRelation, getOverpopParcels and
+# assignParcels, and caches the result in output_dir so that reruns on the
+# same inputs (e.g. with a different top_hh_size) skip straight to the
+# disaggregation.
+dasy.preprocess(dasy.configdict)
+
+# On large datasets, lean=True roughly halves the peak memory use: parcels
+# are loaded in chunks and only their centroids kept, and fields are stored
+# in the smallest dtypes that hold them. The counts are unchanged.
+# dasy.preprocess(dasy.configdict, lean=True)
+
+# To compare parameter sets, sweep them before disaggregating. The spatial
+# pre-processing is shared; each column of the result is one scenario.
+# sweep = dasy.sweep({'low': {'top_hh_size': 6},
+#                     'high': {'top_hh_size': 10,
+#                              'top_den_allowed': [110, 10, 10]}})
+# sweep.to_csv('test_sweep.csv')
 
 # print('Total CB population:')
 # print(dasy.block_df['pop10'].sum())
@@ -32,6 +49,38 @@ dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
 dasy.disaggregate(dasy.parcel_df, dasy.block_df)
 dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df)
 
+# Optionally, round the counts to whole numbers that add up to each block's
+# count exactly (no 0.25 cutoff losses)
+# dasy.round_counts(dasy.parcel_df, dasy.block_df)
+
+# Alternatively, run the three steps above per county in a process pool
+# dasy.disaggregate_partitioned(dasy.parcel_df, dasy.block_df, by='county')
+
+
+# For datasets that don't fit in memory, replace everything from preprocess
+# on with a streaming run, which loads, disaggregates and writes the output
+# one tile of ~chunk_size parcels at a time
+# dasy.disaggregate_streaming(dasy.configdict, 'test.csv', chunk_size=200000)
 
 # Write output
 dasy.writeOutput('test.csv', dasy.parcel_df)
+
+# Or e.g. as GeoParquet with geometries and a few diagnostics, one
+# directory per borough (first digit of the BBL). Needs pyarrow.
+# dasy.writeOutput('test.parquet', dasy.parcel_df,
+#                  subset=['totpop_e', 'unitsres', 'overpopulated'],
+#                  geometry=True, compression='zstd', partition_by=1)
+
+# Save the run state, so that after a few parcels or blocks change, the next
+# run can replace the three disaggregation steps with an incremental update
+# dasy.writeState('test_state.pkl')
+# dasy.disaggregate_incremental(dasy.parcel_df, dasy.block_df,
+#                               'test_state.pkl',
+#                               changed_parcels=[1000010001],
+#                               changed_blocks=['360050001001000'])
+
+# Optionally, write every block to parcel transfer for auditing
+# dasy.writeLedger('test_ledger.csv')
+
+# Write the stage report as JSON (and test_profile.prof with profile=True)
+# dasy.writeProfile('test_profile.json')
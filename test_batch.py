@@ -0,0 +1,53 @@
+""" Tests of batch.py on a small manifest of the synthetic city of
+    benchmark.py. Run with python -m pytest test_batch.py.
+"""
+
+import json
+import os
+
+import pandas as pd
+
+import batch
+import benchmark
+
+
+def test_resume(tmp_path, capsys):
+    run_dir = benchmark.make_run_dir(tmp_path, 1000)
+    manifest = tmp_path / 'manifest.csv'
+    # The failing job comes first in the group, so the other has to run
+    # after it
+    manifest.write_text('name, namelist, population_file\n'
+                        'bad, ' + str(run_dir) + ', missing.parquet\n'
+                        'good, ' + str(run_dir) + ',\n')
+    results = tmp_path / 'manifest_results.jsonl'
+
+    assert batch.run(manifest) == 1
+    latest = batch.read_results(results)
+    assert latest['bad']['status'] == 'failed'
+    assert 'FileNotFoundError' in latest['bad']['error']
+    assert latest['good']['status'] == 'done'
+    output = pd.read_csv(run_dir / 'out' / 'good.csv', index_col=0)
+    assert output['totpop_e'].sum() > 0
+
+    # A rerun skips the finished job, and retries the failed one
+    capsys.readouterr()
+    assert batch.run(manifest, resume=True) == 1
+    assert '1 of 2 jobs already done' in capsys.readouterr().out
+    with open(results) as f:
+        names = [json.loads(line)['name'] for line in f]
+    assert names == ['bad', 'good', 'bad']
+
+    # A changed input file changes the hash of the jobs reading it
+    jobs = {job['name']: job for job in batch.read_manifest(manifest)}
+    before = batch.job_hash(jobs['good'])
+    population = run_dir / 'in' / 'blocks.parquet'
+    stat = os.stat(population)
+    os.utime(population, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert batch.job_hash(jobs['good']) != before
+    assert not batch.finished(jobs['good'], batch.read_results(results))
+
+    assert batch.run(manifest, resume=True) == 1
+    assert '0 of 2 jobs already done' in capsys.readouterr().out
+    latest = batch.read_results(results)
+    assert latest['good']['status'] == 'done'
+    assert latest['good']['hash'] == batch.job_hash(jobs['good'])
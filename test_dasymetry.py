@@ -0,0 +1,863 @@
+""" Regression tests of the pipeline, run on the synthetic city of
+    benchmark.py. Run with python -m pytest test_dasymetry.py.
+"""
+
+import json
+import os
+import pstats
+
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+import benchmark
+import dasymetry
+from namelist import Config, SQFT_PER_ACRE
+
+NPARCELS = 3000
+
+
+@pytest.fixture(scope='module')
+def run_dir(tmp_path_factory):
+    """ Inputs shared by the tests that don't modify them. """
+    return benchmark.make_run_dir(tmp_path_factory.mktemp('city'), NPARCELS)
+
+
+def preprocessed(run_dir, overrides=None, **kwargs):
+    """ A Dasymetry on run_dir, loaded and pre-processed without the cache.
+    """
+
+    dasy = dasymetry.Dasymetry(run_dir)
+    dasy.load_namelist(run_dir, overrides=overrides)
+    dasy.preprocess(dasy.configdict, cache=False, **kwargs)
+
+    return dasy
+
+
+def disaggregated(run_dir, engine='vectorized', overrides=None):
+    """ A Dasymetry on run_dir after the three disaggregation steps. """
+
+    dasy = preprocessed(run_dir, overrides=overrides)
+    dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+    dasy.disaggregate(dasy.parcel_df, dasy.block_df, engine=engine)
+    dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df, engine=engine)
+
+    return dasy
+
+
+@pytest.fixture(scope='module')
+def monolithic(run_dir):
+    """ Result of a plain run on the whole dataset. """
+    return disaggregated(run_dir)
+
+
+def test_city_has_overpopulated_parcels(monolithic):
+    # The merged elevator lots of make_city, each over two blocks, take
+    # the people of both
+    parcel_df = monolithic.parcel_df
+    pop_name = monolithic.configdict['pop_name']
+
+    assert parcel_df['overpopulated'].sum() > 0
+    assert parcel_df.loc[parcel_df['overpopulated'], pop_name].sum() > 0
+
+
+# Parcel order (user-004)
+
+def test_relation_matches_brute_force(run_dir):
+    dasy = preprocessed(run_dir)
+    relation = dasy.relation
+
+    parcels = np.asarray(dasy.parcel_df.geometry.values)
+    blocks = np.asarray(dasy.block_df.geometry.values)
+    points = shapely.points(relation.parcel_xy)
+    block_pos, parcel_pos = np.nonzero(
+        shapely.intersects(blocks[:, None], points[None, :]))
+
+    # np.nonzero lists the pairs by block, then by parcel
+    np.testing.assert_array_equal(relation.parcels_in_blocks[0], block_pos)
+    np.testing.assert_array_equal(relation.parcels_in_blocks[1], parcel_pos)
+
+    points = shapely.points(relation.block_xy)
+    parcel_pos, block_pos = np.nonzero(
+        shapely.intersects(parcels[:, None], points[None, :]))
+    np.testing.assert_array_equal(relation.blocks_in_parcels[0], parcel_pos)
+    np.testing.assert_array_equal(relation.blocks_in_parcels[1], block_pos)
+
+
+def test_membership_follows_parcel_order(run_dir):
+    # Reversing the parcels reverses the parcels of every block
+    dasy = preprocessed(run_dir)
+    parcel_df = dasy.parcel_df.iloc[::-1]
+    reversed_dasy = preprocessed(run_dir, parcel_df=parcel_df)
+
+    for blockid in dasy.block_df.index:
+        parcels = dasy.membership.parcels_in(blockid)
+        assert list(parcels) == sorted(parcels)
+        assert (list(reversed_dasy.membership.parcels_in(blockid))
+                == list(parcels[::-1]))
+
+
+def test_engines_agree(run_dir, monolithic):
+    legacy = disaggregated(run_dir, engine='legacy')
+    pop_name = monolithic.configdict['pop_name']
+
+    np.testing.assert_allclose(legacy.parcel_df[pop_name],
+                               monolithic.parcel_df[pop_name], rtol=1e-9)
+    np.testing.assert_allclose(legacy.block_df[pop_name],
+                               monolithic.block_df[pop_name], atol=1e-9)
+
+
+# BlockMembership (user-005)
+
+@pytest.fixture
+def membership():
+    block_index = pd.Index(['a', 'b', 'c', 'd'])
+    parcel_index = pd.Index([10, 11, 12, 13, 14, 15])
+    block_pos = np.array([2, 0, 2, 0, 3, 2])
+    parcel_pos = np.array([0, 1, 2, 3, 4, 5])
+    return dasymetry.BlockMembership.from_pairs(block_index, parcel_index,
+                                                block_pos, parcel_pos)
+
+
+def test_membership_layout(membership):
+    np.testing.assert_array_equal(membership.offsets, [0, 2, 2, 5, 6])
+    np.testing.assert_array_equal(membership.counts, [2, 0, 3, 1])
+    np.testing.assert_array_equal(membership.has_parcels,
+                                  [True, False, True, True])
+    assert list(membership.parcels_in('a')) == [11, 13]
+    assert list(membership.parcels_in('b')) == []
+    assert list(membership.parcels_in('c')) == [10, 12, 15]
+
+
+def test_membership_pairs(membership):
+    block_pos, parcel_pos = membership.pairs()
+    np.testing.assert_array_equal(block_pos, [0, 0, 2, 2, 2, 3])
+    np.testing.assert_array_equal(parcel_pos, [1, 3, 0, 2, 5, 4])
+
+    block_pos, parcel_pos = membership.pairs([3, 1, 0])
+    np.testing.assert_array_equal(block_pos, [3, 0, 0])
+    np.testing.assert_array_equal(parcel_pos, [4, 1, 3])
+
+
+def test_membership_sum(membership):
+    values = np.array([1.0, 2.0, 4.0, 8.0, 16.0, 32.0])
+    np.testing.assert_array_equal(membership.sum(values),
+                                  [10.0, 0.0, 37.0, 16.0])
+
+
+def test_membership_take(membership):
+    taken = membership.take([2, 1])
+    assert list(taken.block_index) == ['c', 'b']
+    np.testing.assert_array_equal(taken.counts, [3, 0])
+    assert list(taken.parcels_in('c')) == [10, 12, 15]
+    assert taken.matches(pd.DataFrame(index=['c', 'b']))
+    assert not taken.matches(pd.DataFrame(index=['b', 'c']))
+
+
+def test_membership_of_run(monolithic):
+    # The same pairs as a plain dict of block -> parcels
+    relation = monolithic.relation
+    overpopulated = monolithic.parcel_df['overpopulated'].values
+    expected = {}
+    for block, parcel in zip(*relation.parcels_in_blocks):
+        if not overpopulated[parcel]:
+            expected.setdefault(relation.block_index[block], []).append(
+                relation.parcel_index[parcel])
+
+    membership = monolithic.membership
+    for blockid in monolithic.block_df.index:
+        assert (list(membership.parcels_in(blockid))
+                == expected.get(blockid, []))
+
+
+# largest_remainder (user-016)
+
+def test_largest_remainder_ties_and_empty_groups():
+    group = np.array([0, 0, 0, 1, 1, 2, 2, 3, 3])
+    weights = np.array([1.0, 1.0, 1.0, 2.0, 0.0, 0.0, 0.0, 1.0, 3.0])
+    totals = np.array([2.0, 3.0, 5.0, 0.0])
+    tiebreak = np.array([2, 1, 0, 0, 1, 0, 1, 0, 1])
+
+    parts = dasymetry.largest_remainder(group, weights, totals, tiebreak)
+
+    # Equal fractions go to the smallest tiebreak; groups without weight
+    # or without a total get nothing
+    np.testing.assert_array_equal(parts, [0, 1, 1, 3, 0, 0, 0, 0, 0])
+    assert parts.dtype == np.int64
+
+
+def test_largest_remainder_conserves_totals():
+    rng = np.random.default_rng(0)
+    group = np.sort(rng.integers(0, 50, 1000))
+    weights = rng.random(1000)*(rng.random(1000) > 0.2)
+    totals = rng.integers(0, 100, 50).astype(float)
+    tiebreak = rng.permutation(1000)
+
+    parts = dasymetry.largest_remainder(group, weights, totals, tiebreak)
+
+    weight_sum = np.bincount(group, weights=weights, minlength=50)
+    sums = np.bincount(group, weights=parts, minlength=50)
+    np.testing.assert_array_equal(sums, np.where(weight_sum > 0, totals, 0))
+
+    # Nobody is more than one away from its quota
+    quota = totals[group]*weights/weight_sum[group]
+    assert np.all(np.abs(parts - quota) < 1)
+
+
+def test_round_counts_conserves_blocks(run_dir):
+    dasy = disaggregated(run_dir)
+    pop_name = dasy.configdict['pop_name']
+    before = dasy.parcel_df[pop_name].sum() + dasy.block_df[pop_name].sum()
+
+    dasy.round_counts(dasy.parcel_df, dasy.block_df)
+
+    assert dasy.parcel_df[pop_name].dtype.kind == 'i'
+    after = dasy.parcel_df[pop_name].sum() + dasy.block_df[pop_name].sum()
+    assert abs(after - before) < 0.5*len(dasy.block_df) + 1e-6
+
+
+# Config (user-021)
+
+@pytest.fixture
+def namelist(tmp_path):
+    """ Writes a namelist with the given extra lines, returning its path.
+    """
+
+    def write(*lines, drop=()):
+        text = benchmark.NAMELIST.format(run_dir=tmp_path,
+                                         parcels_file='parcels.parquet',
+                                         population_file='blocks.parquet')
+        text = [line for line in text.splitlines()
+                if not line.startswith(tuple(drop))]
+        path = tmp_path / 'namelist.config'
+        path.write_text('\n'.join(text + list(lines)) + '\n')
+        return path
+
+    return write
+
+
+def test_config_to_dict(namelist):
+    config = Config.read(namelist())
+    configdict = config.to_dict()
+
+    assert config.warnings == []
+    assert configdict['top_hh_size'] == 2.8
+    assert configdict['top_den_allowed'] == [55/SQFT_PER_ACRE,
+                                             5/SQFT_PER_ACRE,
+                                             5/SQFT_PER_ACRE]
+    assert configdict['residential_codes'] == ['01', '02', '03', '04']
+    assert configdict['misc_codes'] == ['08']
+    assert configdict['parks_codes'] == ['09', '11']
+    assert 'study_area_bbox' not in configdict
+
+
+def test_config_duplicate_keys(namelist):
+    config = Config.read(namelist('top_hh_size = 2.8'))
+    assert config.warnings == ['top_hh_size is set twice (line 21)']
+
+    with pytest.raises(Exception, match='sets top_hh_size again'):
+        Config.read(namelist('top_hh_size = 3'))
+
+
+def test_config_errors(namelist):
+    with pytest.raises(Exception, match='missing parameter lot_codes_2'):
+        Config.read(namelist(drop=['lot_codes_2']))
+    with pytest.raises(Exception, match='missing parameter pop_name'):
+        Config.read(namelist(drop=['pop_name']))
+    with pytest.raises(Exception, match='top_hh_size must be a number'):
+        Config.read(namelist('top_hh_size = many', drop=['top_hh_size']))
+    with pytest.raises(Exception, match='top_den_allowed has 2 values'):
+        Config.read(namelist('top_den_allowed = 55, 5',
+                             drop=['top_den_allowed']))
+    with pytest.raises(Exception, match='is not key = value'):
+        Config.read(namelist('top_hh_size 2.8', drop=['top_hh_size']))
+
+
+def test_config_unknown_keys(namelist):
+    config = Config.read(namelist('scenario = low'))
+    assert config.warnings == ['unknown parameter scenario']
+    assert config.to_dict()['scenario'] == 'low'
+
+
+def test_config_overrides(namelist):
+    config = Config.read(namelist(), overrides={'top_den_allowed':
+                                                [110, 10, 10]})
+    assert config.top_den_allowed == [110, 10, 10]
+
+
+# Preprocessing cache (user-006)
+
+needs_pyarrow = pytest.mark.skipif(
+    not dasymetry.PreprocessCache.available(), reason='needs pyarrow')
+
+
+@pytest.fixture
+def own_run_dir(tmp_path):
+    """ Inputs for a test that modifies them. """
+    return benchmark.make_run_dir(tmp_path, NPARCELS)
+
+
+@needs_pyarrow
+def test_cache_reloads_changed_inputs(own_run_dir, capsys):
+    dasy = dasymetry.Dasymetry(own_run_dir)
+    dasy.load_namelist(own_run_dir)
+    configdict = dasy.configdict
+    pop_name = configdict['pop_name']
+
+    dasy.preprocess(configdict)
+    dasy.preprocess(configdict)
+    assert 'Loaded pre-processed inputs from cache' in capsys.readouterr().out
+
+    blocks_file = own_run_dir / 'in' / configdict['population_file']
+    block_df = dasymetry.gpd.read_parquet(blocks_file)
+    block_df[pop_name] = 2*block_df[pop_name]
+    block_df.to_parquet(blocks_file)
+
+    dasy.preprocess(configdict)
+    assert 'from cache' not in capsys.readouterr().out
+    assert dasy.block_df[pop_name].sum() == block_df[pop_name].sum()
+
+
+@needs_pyarrow
+def test_cache_key_fingerprints_inputs(own_run_dir):
+    dasy = dasymetry.Dasymetry(own_run_dir)
+    dasy.load_namelist(own_run_dir, overrides={'study_area_mask':
+                                               'mask.shp'})
+    configdict = dasy.configdict
+    inputs = own_run_dir / 'in'
+
+    parcel_df, block_df = benchmark.make_city(1000)
+    mask = dasymetry.gpd.GeoDataFrame(
+        {'name': ['all']}, geometry=[shapely.box(*block_df.total_bounds)],
+        crs=block_df.crs)
+    mask.to_file(inputs / 'mask.shp')
+
+    store = dasymetry.PreprocessCache(own_run_dir / 'out' / 'cache')
+    keys = [store.key(configdict), store.key(configdict, lean=True)]
+
+    # Any file of the mask, not only the .shp, changes the key, as do the
+    # parcels and the population
+    for filename in ('mask.dbf', 'mask.shp', configdict['parcels_file'],
+                     configdict['population_file']):
+        stat = os.stat(inputs / filename)
+        os.utime(inputs / filename, ns=(stat.st_atime_ns,
+                                        stat.st_mtime_ns + 10**9))
+        keys.append(store.key(configdict))
+
+    assert len(set(keys)) == len(keys)
+
+
+# Partitioned and streaming runs (user-008, user-009)
+
+# Tiles of one column of blocks, which cut every merged lot in two
+BLOCK_TILE = benchmark.BLOCK_WIDTH + benchmark.STREET_WIDTH
+
+
+def overpop_tiles(dasy, tile_size):
+    """ Number of tiles of tile_size that the blocks of each overpopulated
+        parcel fall in.
+    """
+
+    relation = dasy.relation
+    parcel_pos, block_pos = relation.blocks_in_parcels
+    keep = dasy.parcel_df['overpopulated'].values[parcel_pos]
+    tiles = pd.DataFrame(
+        {'parcel': parcel_pos[keep],
+         'x': np.floor(relation.block_xy[block_pos[keep], 0]/tile_size),
+         'y': np.floor(relation.block_xy[block_pos[keep], 1]/tile_size)})
+
+    return tiles.drop_duplicates().groupby('parcel').size()
+
+
+@pytest.mark.parametrize('by, tile_size, processes',
+                         [('county', None, 1), ('tile', 2000.0, 1),
+                          ('tile', BLOCK_TILE, 1), ('tile', BLOCK_TILE, 2)])
+def test_partitioned_matches_monolithic(run_dir, monolithic, by, tile_size,
+                                        processes):
+    dasy = preprocessed(run_dir)
+    if tile_size == BLOCK_TILE:
+        assert (overpop_tiles(dasy, tile_size) > 1).all()
+
+    dasy.disaggregate_partitioned(dasy.parcel_df, dasy.block_df, by=by,
+                                  tile_size=tile_size, processes=processes)
+
+    for name in dasymetry.count_fields(dasy.configdict):
+        np.testing.assert_allclose(dasy.parcel_df[name],
+                                   monolithic.parcel_df[name], rtol=1e-9,
+                                   atol=1e-9)
+    pd.testing.assert_index_equal(dasy.block_df.index,
+                                  monolithic.block_df.index)
+    pop_name = dasy.configdict['pop_name']
+    np.testing.assert_allclose(dasy.block_df[pop_name],
+                               monolithic.block_df[pop_name], atol=1e-9)
+
+
+@pytest.mark.parametrize('chunk_size, prefetch',
+                         [(400, True), (400, False), (1500, True)])
+def test_streaming_matches_monolithic(run_dir, monolithic, chunk_size,
+                                      prefetch, capsys):
+    dasy = dasymetry.Dasymetry(run_dir)
+    dasy.load_namelist(run_dir)
+    filename = 'stream_' + str(chunk_size) + '_' + str(prefetch) + '.csv'
+    dasy.disaggregate_streaming(dasy.configdict, filename,
+                                chunk_size=chunk_size, prefetch=prefetch)
+
+    # With 400 parcels per tile, some merged lots cross a tile edge, and
+    # their blocks are set aside for the end
+    straddling = 'blocks on tile boundaries' in capsys.readouterr().out
+    assert straddling == (chunk_size == 400)
+
+    output_dir = dasy.configdict['output_dir']
+    streamed = pd.read_csv(output_dir / filename, index_col=0).sort_index()
+    expected = dasymetry.output_frame(monolithic.parcel_df,
+                                      monolithic.configdict)
+    expected = expected.sort_index()
+
+    pd.testing.assert_index_equal(streamed.index, expected.index,
+                                  check_names=False)
+    for name in expected.columns:
+        np.testing.assert_allclose(streamed[name], expected[name],
+                                   rtol=1e-9, atol=1e-9)
+        assert streamed[name].sum() == pytest.approx(expected[name].sum())
+
+    overpopulated = monolithic.parcel_df.index[
+        monolithic.parcel_df['overpopulated']]
+    pop_name = dasy.configdict['pop_name']
+    np.testing.assert_allclose(streamed.loc[overpopulated, pop_name],
+                               expected.loc[overpopulated, pop_name])
+
+
+# Kernels (user-020)
+
+def csr_blocks(seed=0, nblocks=200):
+    """ Random blocks in CSR layout, with empty and single-parcel blocks,
+        parcels without area, and caps equal to the uncapped transfer.
+    """
+
+    rng = np.random.default_rng(seed)
+    counts = rng.integers(0, 6, nblocks)
+    counts[:10] = 1
+    offsets = np.zeros(nblocks + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    nrows = offsets[-1]
+
+    # Every block but the empty ones keeps some area
+    area = rng.random(nrows)*1000
+    area[rng.random(nrows) < 0.1] = 0
+    area[offsets[:-1][counts > 0]] += 1
+    units = rng.integers(0, 20, nrows).astype(float)
+    block_pop = rng.random(nblocks)*50
+    allowed = rng.random(nrows)*10
+
+    # A last block of two parcels of the same area, the first allowed
+    # exactly its share
+    offsets = np.append(offsets, nrows + 2)
+    area = np.append(area, [1.0, 1.0])
+    units = np.append(units, [1.0, 1.0])
+    block_pop = np.append(block_pop, 10.0)
+    allowed = np.append(allowed, [5.0, 5.0])
+    nblocks += 1
+
+    total_units = np.bincount(np.repeat(np.arange(nblocks), np.diff(offsets)),
+                              weights=units, minlength=nblocks)
+    total_units[total_units == 0] = 1
+
+    return offsets, area, units, block_pop, allowed, total_units
+
+
+@pytest.fixture
+def without_numba(monkeypatch):
+    monkeypatch.setattr(dasymetry, 'USE_NUMBA', False)
+
+
+def test_resunit_shares_loop(without_numba):
+    offsets, area, units, block_pop, allowed, total_units = csr_blocks()
+
+    expected = dasymetry.resunit_shares(offsets, units, block_pop,
+                                        total_units)
+    np.testing.assert_allclose(
+        dasymetry.resunit_shares_loop(offsets, units, block_pop,
+                                      total_units), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('capped', [False, True])
+def test_area_shares_loop(without_numba, capped):
+    offsets, area, units, block_pop, allowed, total_units = csr_blocks()
+    allowed = allowed if capped else None
+
+    expected = dasymetry.area_shares(offsets, area, block_pop,
+                                     allowed=allowed)
+    result = dasymetry.area_shares_loop(
+        offsets, area, block_pop,
+        np.asarray(allowed if capped else [], dtype=float), capped)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-12)
+    if capped:
+        assert list(result[-2:]) == [5.0, 2.5]
+
+
+def test_area_shares_blocks_without_area(without_numba):
+    # No area at all divides by zero, into NaN, in both versions
+    offsets = np.array([0, 2, 3])
+    area = np.array([0.0, 0.0, 10.0])
+    block_pop = np.array([4.0, 6.0])
+
+    with np.errstate(invalid='ignore'):
+        expected = dasymetry.area_shares(offsets, area, block_pop)
+        result = dasymetry.area_shares_loop(offsets, area, block_pop,
+                                            np.zeros(0), False)
+
+    np.testing.assert_array_equal(result, expected)
+    assert np.isnan(result[:2]).all() and result[2] == 6.0
+
+
+@pytest.mark.parametrize('capped', [False, True])
+def test_compiled_kernels(monkeypatch, capped):
+    pytest.importorskip('numba')
+    monkeypatch.setattr(dasymetry, 'USE_NUMBA', True)
+
+    offsets, area, units, block_pop, allowed, total_units = csr_blocks()
+    allowed = np.asarray(allowed if capped else [], dtype=float)
+
+    kernel = dasymetry.compiled(dasymetry.area_shares_loop)
+    np.testing.assert_array_equal(
+        kernel(offsets, area, block_pop, allowed, capped),
+        dasymetry.area_shares_loop(offsets, area, block_pop, allowed,
+                                   capped))
+
+    kernel = dasymetry.compiled(dasymetry.resunit_shares_loop)
+    np.testing.assert_array_equal(
+        kernel(offsets, units, block_pop, total_units),
+        dasymetry.resunit_shares_loop(offsets, units, block_pop,
+                                      total_units))
+
+
+# Transfer ledger (user-003)
+
+@pytest.mark.parametrize('engine', ['vectorized', 'legacy'])
+def test_ledger_adds_up_to_parcels(run_dir, engine):
+    dasy = disaggregated(run_dir, engine=engine)
+    dasy.writeLedger('ledger_' + engine + '.csv')
+    pop_name = dasy.configdict['pop_name']
+
+    ledger = pd.read_csv(dasy.configdict['output_dir']
+                         / ('ledger_' + engine + '.csv'))
+    transfers = dasy.ledger.to_frame(aggregate=False)
+    assert list(ledger.columns) == ['stage', 'block', 'parcel', 'numpeople']
+    assert len(ledger) == len(transfers.drop_duplicates(
+        ['stage', 'block', 'parcel']))
+    assert 'blocksToOverpop' in set(ledger['stage'])
+
+    # Parcels start out empty, so what they hold all came through the
+    # ledger
+    received = ledger.groupby('parcel')['numpeople'].sum()
+    received = received.reindex(dasy.parcel_df.index, fill_value=0)
+    np.testing.assert_allclose(received, dasy.parcel_df[pop_name],
+                               rtol=1e-9, atol=1e-9)
+
+
+def test_empty_ledger():
+    ledger = dasymetry.TransferLedger('totpop_e')
+    transfers = ledger.to_frame()
+    assert len(transfers) == 0
+    assert list(transfers.columns) == ['stage', 'block', 'parcel',
+                                       'numpeople']
+
+
+# Incremental runs (user-012)
+
+def test_incremental_matches_full_rerun(own_run_dir):
+    dasy = disaggregated(own_run_dir)
+    dasy.writeState('state.pkl')
+    configdict = dasy.configdict
+    pop_name = configdict['pop_name']
+    inputs = own_run_dir / 'in'
+
+    # Change 20 parcels, an overpopulated one among them, remove one, and
+    # change 10 blocks, one of them under a merged lot
+    parcel_df = dasymetry.gpd.read_parquet(inputs
+                                           / configdict['parcels_file'])
+    overpopulated = dasy.parcel_df.index[dasy.parcel_df['overpopulated']]
+    changed_parcels = [overpopulated[0]] + list(parcel_df['bbl'][100:2000:100])
+    changed = parcel_df['bbl'].isin(changed_parcels)
+    parcel_df.loc[changed, 'unitsres'] += 7
+    removed = parcel_df['bbl'].iloc[2500]
+    parcel_df = parcel_df[parcel_df['bbl'] != removed]
+    parcel_df.to_parquet(inputs / configdict['parcels_file'])
+
+    block_df = dasymetry.gpd.read_parquet(inputs
+                                          / configdict['population_file'])
+    relation = dasy.relation
+    parcel_pos, block_pos = relation.blocks_in_parcels
+    under_lot = relation.block_index[block_pos[
+        relation.parcel_index[parcel_pos] == overpopulated[0]][0]]
+    changed_blocks = [under_lot] + list(block_df['geoid'][5:200:21])
+    changed = block_df['geoid'].isin(changed_blocks)
+    block_df.loc[changed, pop_name] += 13
+    block_df.to_parquet(inputs / configdict['population_file'])
+
+    full = disaggregated(own_run_dir)
+
+    incremental = preprocessed(own_run_dir)
+    incremental.disaggregate_incremental(
+        incremental.parcel_df, incremental.block_df, 'state.pkl',
+        changed_parcels=changed_parcels + [removed],
+        changed_blocks=changed_blocks)
+
+    pd.testing.assert_index_equal(incremental.parcel_df.index,
+                                  full.parcel_df.index)
+    pd.testing.assert_index_equal(incremental.block_df.index,
+                                  full.block_df.index)
+    np.testing.assert_allclose(incremental.parcel_df[pop_name],
+                               full.parcel_df[pop_name], rtol=1e-12)
+    np.testing.assert_allclose(incremental.block_df[pop_name],
+                               full.block_df[pop_name], atol=1e-12)
+
+    with pytest.raises(AssertionError, match='disaggregate_incremental'):
+        incremental.round_counts(incremental.parcel_df,
+                                 incremental.block_df)
+
+
+# Lean mode (user-017)
+
+def test_lean_matches_monolithic(run_dir, monolithic):
+    dasy = preprocessed(run_dir, lean=True, chunk_size=700)
+    assert dasy.parcel_df['landuse'].dtype == 'category'
+    assert dasy.parcel_df['overpopulated'].sum() > 0
+
+    dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+    dasy.disaggregate(dasy.parcel_df, dasy.block_df)
+    dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df)
+
+    pop_name = dasy.configdict['pop_name']
+    pd.testing.assert_index_equal(dasy.parcel_df.index,
+                                  monolithic.parcel_df.index)
+    pd.testing.assert_index_equal(dasy.block_df.index,
+                                  monolithic.block_df.index)
+    np.testing.assert_allclose(dasy.parcel_df[pop_name],
+                               monolithic.parcel_df[pop_name], rtol=1e-12)
+    np.testing.assert_allclose(dasy.block_df[pop_name],
+                               monolithic.block_df[pop_name], atol=1e-12)
+
+    for column in dasymetry.Dasymetry.scratch_columns:
+        assert column not in dasy.block_df
+        assert column in monolithic.block_df
+
+
+def test_lean_partitioned_drops_scratch(run_dir, monolithic):
+    dasy = preprocessed(run_dir, lean=True)
+    dasy.disaggregate_partitioned(dasy.parcel_df, dasy.block_df,
+                                  by='tile', tile_size=BLOCK_TILE,
+                                  processes=1)
+
+    pop_name = dasy.configdict['pop_name']
+    np.testing.assert_allclose(dasy.parcel_df[pop_name],
+                               monolithic.parcel_df[pop_name], rtol=1e-9)
+    for column in dasymetry.Dasymetry.scratch_columns:
+        assert column not in dasy.block_df
+
+    dasy.writeState('lean_state.pkl')
+
+
+# Parameter sweeps (user-011)
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_sweep_matches_full_runs(run_dir, monolithic, processes):
+    dasy = preprocessed(run_dir)
+    parcel_df = dasy.parcel_df.copy()
+    block_df = dasy.block_df.copy()
+
+    scenarios = {'base': {},
+                 'small': {'top_hh_size': 2},
+                 'dense': {'top_hh_size': 4,
+                           'top_den_allowed': [110, 10, 10]}}
+    table = dasy.sweep(scenarios, processes=processes)
+
+    pop_name = dasy.configdict['pop_name']
+    np.testing.assert_allclose(table['base'], monolithic.parcel_df[pop_name],
+                               rtol=1e-12)
+    for name in ('small', 'dense'):
+        full = disaggregated(run_dir, overrides=scenarios[name])
+        np.testing.assert_allclose(table[name], full.parcel_df[pop_name],
+                                   rtol=1e-12)
+    assert not np.allclose(table['small'], table['dense'])
+
+    pd.testing.assert_frame_equal(dasy.parcel_df, parcel_df)
+    pd.testing.assert_frame_equal(dasy.block_df, block_df)
+
+
+# Several count variables (user-010)
+
+def test_split_counts_add_up(own_run_dir):
+    population_file = own_run_dir / 'in' / 'blocks.parquet'
+    block_df = dasymetry.gpd.read_parquet(population_file)
+    block_df['children'] = np.floor(0.3*block_df['totpop_e'])
+    block_df['adults'] = block_df['totpop_e'] - block_df['children']
+    block_df.to_parquet(population_file)
+
+    overrides = {'block_fields': 'totpop_e, children, adults, geometry'}
+    serial = disaggregated(own_run_dir, overrides=overrides)
+    partitioned = preprocessed(own_run_dir, overrides=overrides)
+    partitioned.disaggregate_partitioned(
+        partitioned.parcel_df, partitioned.block_df, by='tile',
+        tile_size=BLOCK_TILE, processes=1)
+
+    for dasy in (serial, partitioned):
+        parcel_df = dasy.parcel_df
+        assert parcel_df['children'].sum() > 0
+        np.testing.assert_allclose(
+            parcel_df['children'] + parcel_df['adults'],
+            parcel_df['totpop_e'], rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(
+            dasy.block_df['children'] + dasy.block_df['adults'],
+            dasy.block_df['totpop_e'], rtol=1e-9, atol=1e-9)
+
+    for name in ('totpop_e', 'children', 'adults'):
+        np.testing.assert_allclose(partitioned.parcel_df[name],
+                                   serial.parcel_df[name], rtol=1e-9)
+
+
+# Output (user-015)
+
+def test_write_csv_subset_rows(monolithic):
+    dasy = monolithic
+    parcel_df = dasy.parcel_df
+    subset = ['totpop_e', 'unitsres', 'overpopulated']
+    rows = parcel_df['totpop_e'] > 10
+
+    dasy.writeOutput('subset.csv', parcel_df, subset=subset, rows=rows)
+    written = pd.read_csv(dasy.configdict['output_dir'] / 'subset.csv',
+                          index_col=0)
+
+    pd.testing.assert_frame_equal(written, pd.DataFrame(parcel_df.loc[
+        rows, subset]), check_exact=False, rtol=1e-12)
+
+
+def test_write_csv_gz(monolithic):
+    dasy = monolithic
+    dasy.writeOutput('counts.csv.gz', dasy.parcel_df)
+    outfile = dasy.configdict['output_dir'] / 'counts.csv.gz'
+
+    with open(outfile, 'rb') as f:
+        assert f.read(2) == b'\x1f\x8b'
+    written = pd.read_csv(outfile, index_col=0)
+    pd.testing.assert_frame_equal(written, pd.DataFrame(
+        dasy.parcel_df[['totpop_e']]), check_exact=False, rtol=1e-12)
+
+
+@needs_pyarrow
+def test_write_geoparquet(monolithic):
+    dasy = monolithic
+    parcel_df = dasy.parcel_df
+    dasy.writeOutput('parcels.parquet', parcel_df, subset='all',
+                     geometry=True, compression='zstd')
+
+    written = dasymetry.gpd.read_parquet(dasy.configdict['output_dir']
+                                         / 'parcels.parquet')
+    assert written.crs == parcel_df.crs
+    assert written.geometry.geom_equals_exact(parcel_df.geometry, 0).all()
+    pd.testing.assert_frame_equal(pd.DataFrame(written.drop(
+        columns='geometry')), pd.DataFrame(parcel_df.drop(
+            columns='geometry')))
+
+
+@needs_pyarrow
+def test_write_partitioned_by_id(monolithic):
+    dasy = monolithic
+    parcel_df = dasy.parcel_df
+    dasy.writeOutput('by_id.parquet', parcel_df, partition_by=2)
+    outdir = dasy.configdict['output_dir'] / 'by_id.parquet'
+
+    folders = sorted(folder.name for folder in outdir.iterdir())
+    assert folders == sorted(
+        'bbl_2=' + key for key in parcel_df.index.astype(str).str[:2].unique())
+
+    written = pd.concat(
+        pd.read_parquet(folder).assign(prefix=folder.name[len('bbl_2='):])
+        for folder in outdir.iterdir()).sort_index()
+    assert (written.index.astype(str).str[:2] == written['prefix']).all()
+    pd.testing.assert_frame_equal(written[['totpop_e']],
+                                  pd.DataFrame(parcel_df[['totpop_e']]))
+
+
+def test_write_partitioned_by_column(monolithic):
+    dasy = monolithic
+    parcel_df = dasy.parcel_df
+    dasy.writeOutput('by_landuse.csv', parcel_df,
+                     subset=['totpop_e', 'unitsres'], partition_by='landuse')
+    outdir = dasy.configdict['output_dir'] / 'by_landuse.csv'
+
+    parts = []
+    for folder in outdir.iterdir():
+        assert folder.name.startswith('landuse=')
+        for part in folder.iterdir():
+            part = pd.read_csv(part, index_col=0, dtype={'landuse': str})
+            assert 'landuse' not in part
+            parts.append(part.assign(landuse=folder.name[len('landuse='):]))
+    written = pd.concat(parts).sort_index()
+
+    expected = pd.DataFrame(parcel_df[['totpop_e', 'unitsres', 'landuse']])
+    pd.testing.assert_frame_equal(written, expected, check_exact=False,
+                                  rtol=1e-12)
+
+
+@needs_pyarrow
+@pytest.mark.parametrize('background', [False, True])
+def test_write_chunks(monolithic, tmp_path, background):
+    parcel_df = dasymetry.output_frame(monolithic.parcel_df,
+                                       monolithic.configdict)
+    writer = dasymetry.ParcelWriter(tmp_path / 'chunks.parquet',
+                                    background=background)
+    for start in range(0, len(parcel_df), 1000):
+        writer.write(parcel_df.iloc[start:start + 1000])
+    writer.close()
+
+    written = pd.read_parquet(tmp_path / 'chunks.parquet')
+    pd.testing.assert_frame_equal(written, pd.DataFrame(parcel_df))
+
+
+# Stage profiler (user-013)
+
+def test_profile(run_dir):
+    dasy = dasymetry.Dasymetry(run_dir)
+    dasy.load_namelist(run_dir)
+    dasy.startProfiling(profile=True)
+    dasy.preprocess(dasy.configdict, cache=False)
+    dasy.blocksToOverpop(dasy.parcel_df, dasy.block_df)
+    dasy.disaggregate(dasy.parcel_df, dasy.block_df)
+    dasy.disaggregate_leftover(dasy.parcel_df, dasy.block_df)
+    dasy.writeOutput('profiled.csv', dasy.parcel_df)
+    dasy.writeProfile('profile.json')
+    assert dasy.profiler is None
+
+    outfile = dasy.configdict['output_dir'] / 'profile.json'
+    with open(outfile) as f:
+        report = json.load(f)
+    stages = [(record['stage'], record['depth'])
+              for record in report['stages']]
+
+    # The relation is built once, within preprocess, and the later calls
+    # that reuse it aren't stages
+    assert stages == [('preprocess', 0), ('load_source_files', 1),
+                      ('buildSpatialRelation', 1), ('getOverpopParcels', 1),
+                      ('assignParcels', 1), ('blocksToOverpop', 0),
+                      ('disaggregate', 0), ('disaggregate_leftover', 0),
+                      ('writeOutput', 0)]
+
+    records = {record['stage']: record for record in report['stages']}
+    assert records['blocksToOverpop']['conserved']
+    assert records['disaggregate_leftover']['conserved']
+    assert records['disaggregate']['transfers'] > 0
+    assert records['disaggregate']['blocks_out'] < records[
+        'disaggregate']['blocks_in']
+    assert report['total_wall_time_s'] == pytest.approx(sum(
+        record['wall_time_s'] for record in report['stages']
+        if record['depth'] == 0))
+    for record in report['stages']:
+        if record['rss_start_mb'] is not None:
+            assert record['peak_rss_mb'] >= record['rss_start_mb']
+
+    stats = pstats.Stats(str(outfile.with_suffix('.prof')))
+    functions = {function for _, _, function in stats.stats}
+    assert {'disaggregate', 'disaggregate_leftover'} <= functions